@@ -0,0 +1,330 @@
+"""
+    Micro-benchmarks for the pipeline's hot functions. Offline and without a
+    browser: fpds, Teams and Chromium are replaced by synthetic data. Every
+    case runs at several dataset sizes and reports throughput and peak
+    allocations; the card posting cases run on one 1 MB card and count
+    bytes as items.
+
+    python3 bench_pipeline.py             print results
+    python3 bench_pipeline.py --save      write them to bench_baseline.json
+    python3 bench_pipeline.py --compare   flag slowdowns against the baseline
+"""
+
+import argparse
+import json
+import logging
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+import urllib3
+
+import client
+import client.api_client
+import search
+from client import rest
+from client.rest import RESTClientObject
+
+BASELINE = "bench_baseline.json"
+# Items per dataset: cells, actions, watchlist entries or text blocks
+SIZES = (10, 100, 1000)
+# Serialized size of the card the posting cases send
+CARD_BYTES = (1_000_000,)
+
+
+class Benchmark:
+    # pytest-benchmark style fixture: benchmark(fn, *args) times repeated
+    # calls, then profiles allocations of one more call
+
+    def __init__(self, min_rounds: int = 5, min_time: float = 0.5) -> None:
+        self.min_rounds = min_rounds
+        self.min_time = min_time
+        self.stats = None
+
+    def __call__(self, fn, *args, **kwargs):
+        result = fn(*args, **kwargs)
+        times = []
+
+        while len(times) < self.min_rounds or sum(times) < self.min_time:
+            start = time.perf_counter()
+            fn(*args, **kwargs)
+            times.append(time.perf_counter() - start)
+
+        tracemalloc.start()
+        fn(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        self.stats = {
+            "rounds": len(times),
+            "min_ms": min(times) * 1000,
+            "median_ms": statistics.median(times) * 1000,
+            "peak_kib": peak / 1024,
+        }
+        return result
+
+
+class FakeCell:
+    # Stands in for the Playwright locator get_value() walks
+
+    def __init__(self, text: str) -> None:
+        self.text = text
+
+    def nth(self, index: int) -> "FakeCell":
+        return self
+
+    def locator(self, selector: str) -> "FakeCell":
+        return self
+
+    def inner_text(self) -> str:
+        return self.text
+
+
+class FakePoolManager:
+    # urllib3 pool that answers every request locally
+
+    def request(self, method: str, url: str, **kwargs) -> urllib3.HTTPResponse:
+        return urllib3.HTTPResponse(
+            body=b"1", status=200, headers={"Content-Type": "text/plain"}
+        )
+
+
+def make_detail(n: int) -> dict:
+    return {
+        "date": "02/25/2024",
+        "company": f"Test Company {n}",
+        "company_url": search.build_company_url(f"Test Company {n}"),
+        "obligation": "$50",
+        "piid": f"C{n}",
+        "idv": "",
+        "mod": "P00001",
+        "naics": "541512",
+        "reason": "Exercise An Option",
+        "desc": "This exercises option year.\nFunding added.",
+    }
+
+
+def make_raw_results(size: int) -> list[dict]:
+    # `size` actions spread over ten watchlist entries
+    entries = max(1, min(10, size))
+    return [
+        {
+            "contract_no": f"C{i}",
+            "contract_nm": f"Contract {i}",
+            "url": "https://example.com",
+            "index": i + 1,
+            "contract_details": [make_detail(n) for n in range(i, size, entries)],
+        }
+        for i in range(entries)
+    ]
+
+
+def make_card(size: int) -> dict:
+    items = search.format_results(make_raw_results(size))
+    items += [search.build_textblock("")] * max(0, size - len(items))
+    return search.build_card(items)
+
+
+def make_large_card(nbytes: int) -> dict:
+    # Teams card whose JSON is about `nbytes`, of repeated result blocks
+    items = search.format_results(make_raw_results(1000))
+    block_bytes = len(json.dumps(items)) / len(items)
+    count = int(nbytes / block_bytes)
+    return search.build_card([items[n % len(items)] for n in range(count)])
+
+
+def card_api(nbytes: int) -> tuple[client.MsApi, dict]:
+    # MsApi answered by a local pool, and a card of `nbytes` to post with it
+    api_client = client.ApiClient(client.Configuration())
+    api_client.rest_client.pool_manager = FakePoolManager()
+    return client.MsApi(api_client), make_large_card(nbytes)
+
+
+def bench_get_value(benchmark: Benchmark, size: int) -> None:
+    cells = [FakeCell(f"  value {n}\n") for n in range(size)]
+    benchmark(lambda: [search.get_value(cell) for cell in cells])
+
+
+def bench_format_results(benchmark: Benchmark, size: int) -> None:
+    raw_results = make_raw_results(size)
+    benchmark(search.format_results, raw_results)
+
+
+def bench_process_search(benchmark: Benchmark, size: int) -> None:
+    # `size` watchlist contracts, batched and routed, with a fake search()
+    contract_list = ",".join(f"C{n}: Contract {n}" for n in range(size))
+    settings = search.SearchSettings(
+        concurrency=1,
+        cache_path="",
+        state_path="",
+        rate_limit=0,
+        blocked_resources="",
+        blocked_hosts="",
+    )
+
+    def fake_search(criteria, yday, session, settings, state):
+        contract_nos = criteria.get("contract_nos") or [criteria["contract_no"]]
+        details = [make_detail(c[1:]) for c in contract_nos]
+        return details, search.build_search_url(criteria, yday)
+
+    real_search = search.search
+    search.search = fake_search
+
+    try:
+        benchmark(search.process_search, contract_list, "", settings)
+    finally:
+        search.search = real_search
+
+
+def bench_sanitize_for_serialization(benchmark: Benchmark, size: int) -> None:
+    # Teams card of `size` text blocks
+    api_client = client.ApiClient(client.Configuration())
+    body = make_card(size)
+    benchmark(api_client.sanitize_for_serialization, body)
+
+
+def bench_rest_request(benchmark: Benchmark, size: int) -> None:
+    # JSON POST of a `size` text block card, answered by a local pool
+    rest = RESTClientObject(client.Configuration())
+    rest.pool_manager = FakePoolManager()
+    body = make_card(size)
+    benchmark(rest.request, "POST", "https://example.com/webhook", body=body)
+
+
+def bench_post_card(benchmark: Benchmark, size: int) -> None:
+    # teams_post of a card dict: native check, then the fastest encoder
+    api, body = card_api(size)
+    benchmark(api.teams_post, body=body)
+
+
+def bench_post_card_stdlib_json(benchmark: Benchmark, size: int) -> None:
+    # teams_post of a card dict as without orjson installed
+    api, body = card_api(size)
+    encoder, rest.orjson = rest.orjson, None
+
+    try:
+        benchmark(api.teams_post, body=body)
+    finally:
+        rest.orjson = encoder
+
+
+def bench_post_card_walked(benchmark: Benchmark, size: int) -> None:
+    # teams_post of a card dict as before the native check and orjson: the
+    # recursive sanitize walk, then json.dumps
+    api, body = card_api(size)
+    module = client.api_client
+    native, module.is_json_native = module.is_json_native, lambda obj: False
+    encoder, rest.orjson = rest.orjson, None
+
+    try:
+        benchmark(api.teams_post, body=body)
+    finally:
+        module.is_json_native = native
+        rest.orjson = encoder
+
+
+def bench_post_card_bytes(benchmark: Benchmark, size: int) -> None:
+    # teams_post of a card serialized beforehand, e.g. while packing
+    api, body = card_api(size)
+    body = rest.dumps(body)
+    benchmark(api.teams_post, body=body)
+
+
+CASES = (
+    (bench_get_value, SIZES),
+    (bench_format_results, SIZES),
+    (bench_process_search, SIZES),
+    (bench_sanitize_for_serialization, SIZES),
+    (bench_rest_request, SIZES),
+    (bench_post_card_walked, CARD_BYTES),
+    (bench_post_card, CARD_BYTES),
+    (bench_post_card_stdlib_json, CARD_BYTES),
+    (bench_post_card_bytes, CARD_BYTES),
+)
+
+
+def run() -> dict:
+    # Run every case at every size, printing one line per run
+    results = {}
+
+    for case, sizes in CASES:
+        name = case.__name__.removeprefix("bench_")
+
+        for size in sizes:
+            benchmark = Benchmark()
+            case(benchmark, size)
+            stats = benchmark.stats
+            # Best round: the least disturbed by other work on the machine
+            stats["items_per_s"] = size / (stats["min_ms"] / 1000)
+            results[f"{name}[{size}]"] = stats
+            print(
+                f"{name + f'[{size}]':<38} {stats['min_ms']:>10.3f} ms"
+                f" {stats['items_per_s']:>14,.0f} items/s"
+                f" {stats['peak_kib']:>10.1f} KiB peak"
+            )
+
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> bool:
+    # Report throughput against the baseline, True if nothing slowed down
+    ok = True
+
+    for key, stats in results.items():
+        before = baseline["results"].get(key)
+
+        if before is None:
+            continue
+
+        ratio = stats["items_per_s"] / before["items_per_s"]
+        slower = ratio < 1 - tolerance
+        ok = ok and not slower
+        print(
+            f"{key:<38} {ratio:>6.2f}x throughput"
+            f" {stats['peak_kib'] - before['peak_kib']:>+10.1f} KiB peak"
+            f"{'  SLOWER' if slower else ''}"
+        )
+
+    return ok
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--save", action="store_true", help=f"write {BASELINE}")
+    parser.add_argument("--compare", action="store_true", help=f"compare to {BASELINE}")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="throughput drop reported as a slowdown (default 0.2)",
+    )
+    args = parser.parse_args()
+
+    # Per-search and per-request info logs would drown the report
+    logging.disable(logging.INFO)
+    results = run()
+
+    if args.compare:
+        with open(BASELINE, encoding="utf-8") as f:
+            baseline = json.load(f)
+
+        print(f"\nAgainst {BASELINE} ({baseline['python']}):")
+
+        if not compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+    if args.save:
+        with open(BASELINE, "w", encoding="utf-8") as f:
+            json.dump(
+                {"python": platform.python_version(), "results": results},
+                f,
+                indent=2,
+                sort_keys=True,
+            )
+            f.write("\n")
+
+
+if __name__ == "__main__":
+    main()
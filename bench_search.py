@@ -0,0 +1,211 @@
+"""
+    Benchmarks for search.py. Run locally with a chromium install
+    (playwright install chromium), no fpds access needed:
+
+    python3 bench_search.py [criteria-count]
+
+    The formatting benchmark alone needs no browser:
+
+    python3 bench_search.py format
+
+    End-to-end runs of each engine against the local fpds stand-in server:
+
+    python3 bench_search.py standin [criteria-count]
+"""
+
+import sys
+import time
+
+from playwright.sync_api import sync_playwright
+
+import search
+from fpds_standin import StandinFpds
+
+
+RESULT_HTML = """
+<table class="resultbox1"><tr>
+<td><span>Date Signed:</span></td><td>02/25/2024</td>
+<td><span>Legal Business Name:</span></td><td>Test Company</td>
+<td><span>Action Obligation:</span></td><td>$50</td>
+</tr></table>
+"""
+
+
+def report(name: str, elapsed: float, n: int) -> None:
+    # Print per-criterion cost
+    print(f"{name:<28} {n:>5} criteria {elapsed * 1000 / n:>10.1f} ms/criterion")
+
+
+def bench_launch_per_criterion(n: int) -> float:
+    # Previous behaviour: cold browser start for every criterion
+    start = time.perf_counter()
+
+    for _ in range(n):
+        with sync_playwright() as p:
+            browser = p.chromium.launch(headless=True)
+            page = browser.new_page()
+            page.set_content(RESULT_HTML)
+            browser.close()
+
+    return time.perf_counter() - start
+
+
+def bench_shared_session(n: int) -> float:
+    # One browser per run, fresh context per criterion
+    start = time.perf_counter()
+
+    with search.BrowserSession() as session:
+        for _ in range(n):
+            page = session.new_page()
+            page.set_content(RESULT_HTML)
+            page.context.close()
+
+    return time.perf_counter() - start
+
+
+def locator_rows(page) -> list[dict]:
+    # Previous extraction: several browser round-trips per table
+    rows = []
+    tables = page.locator(search.RESULT_TABLES)
+
+    for i in range(tables.count()):
+        table = tables.nth(i)
+        rows.append(
+            {
+                key: search.get_value(
+                    table.locator(f'td:has(span:has-text("{label}"))')
+                )
+                for key, label in search.ROW_LABELS.items()
+            }
+        )
+        table.locator(search.VIEW_LINK).nth(0).get_attribute("href")
+
+    return rows
+
+
+def bench_extraction(tables: int = 100, repeat: int = 5) -> None:
+    # Locator-based vs single evaluate() extraction on a results page
+    with open("fixtures/ezsearch_results.html", encoding="utf-8") as f:
+        fixture = f.read()
+
+    first = fixture.index("<table")
+    last = fixture.index("</table>") + len("</table>")
+    html = f"<html><body>{fixture[first:last] * tables}</body></html>"
+
+    with search.BrowserSession() as session:
+        page = session.new_page()
+        page.set_content(html)
+
+        for name, extract in (
+            ("locator extraction", locator_rows),
+            ("evaluate extraction", search.extract_rows),
+        ):
+            start = time.perf_counter()
+
+            for _ in range(repeat):
+                assert len(extract(page)) == tables
+
+            elapsed = (time.perf_counter() - start) / repeat
+            print(f"{name:<28} {tables:>5} tables   {elapsed * 1000:>10.1f} ms/page")
+
+
+def legacy_split_textblock(item: dict, budget: int) -> list[dict]:
+    # Previous splitter: serializes the growing block after every paragraph
+    if search.json_size(item) <= budget:
+        return [item]
+
+    blocks = []
+    text = ""
+
+    for part in item["text"].split("\n\n"):
+        candidate = f"{text}\n\n{part}" if text else part
+
+        if text and search.json_size(search.build_textblock(candidate)) > budget:
+            blocks.append(search.build_textblock(text))
+            candidate = part
+
+        text = candidate
+
+    blocks.append(search.build_textblock(text))
+    return blocks
+
+
+def bench_format_results(details: int = 10000, repeat: int = 5) -> None:
+    # Formatting and card packing of one huge NAICS day
+    detail = {
+        "date": "02/25/2024",
+        "company": "Test Company",
+        "company_url": search.build_company_url("Test Company"),
+        "reason": "Exercise An Option",
+        "obligation": "$50",
+        "desc": "This exercises option year.\nFunding added.",
+    }
+    raw_results = [
+        {
+            "naics": "541512",
+            "agency": "Agency Name",
+            "url": "https://example.com",
+            "index": 1,
+            "contract_details": [detail] * details,
+        }
+    ]
+    items = search.format_results(raw_results)
+    budget = search.SearchSettings().card_max_bytes
+    assert legacy_split_textblock(items[2], budget) == search.split_textblock(
+        items[2], budget
+    )
+
+    for name, run in (
+        ("format_results", lambda: search.format_results(raw_results)),
+        ("legacy split_textblock", lambda: legacy_split_textblock(items[2], budget)),
+        ("split_textblock", lambda: search.split_textblock(items[2], budget)),
+        ("pack_cards", lambda: list(search.pack_cards(items, budget))),
+    ):
+        start = time.perf_counter()
+
+        for _ in range(repeat):
+            run()
+
+        elapsed = (time.perf_counter() - start) / repeat
+        print(f"{name:<28} {details:>5} details  {elapsed * 1000:>10.1f} ms/run")
+
+
+def bench_standin(
+    n: int, tables: int = 30, pages: int = 2, latency: float = 0.05
+) -> None:
+    # Whole searches, result pages and detail pages, against a local server
+    # answering each request after `latency` plus up to `latency` jitter
+    contract_list = ",".join(f"{100000000 + i}: Contract {i}" for i in range(n))
+
+    with StandinFpds(tables, pages, latency, latency) as standin:
+        for name, overrides in (
+            ("stand-in browser engine", {}),
+            ("stand-in http details", {"detail_mode": "http"}),
+            ("stand-in http engine", {"engine": "http"}),
+        ):
+            settings = search.SearchSettings(
+                base_url=standin.base_url,
+                cache_path="",
+                state_path="",
+                rate_limit=0,
+                **overrides,
+            )
+            start = time.perf_counter()
+            search.process_search(contract_list, "", settings)
+            report(name, time.perf_counter() - start, n)
+
+
+def main(n: int) -> None:
+    report("launch per criterion", bench_launch_per_criterion(n), n)
+    report("shared browser session", bench_shared_session(n), n)
+    bench_extraction()
+    bench_format_results()
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["format"]:
+        bench_format_results()
+    elif sys.argv[1:2] == ["standin"]:
+        bench_standin(int(sys.argv[2]) if len(sys.argv) > 2 else 5)
+    else:
+        main(int(sys.argv[1]) if len(sys.argv) > 1 else 20)
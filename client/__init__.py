@@ -1,6 +1,28 @@
 from __future__ import absolute_import
 
-from client.api.ms_api import MsApi
-from client.api_client import ApiClient
-from client.configuration import Configuration
-from client.models.ms_channel_dto import MsChannelDto
+import importlib
+
+# Exported names and the modules they live in. They are imported on first
+# access, so `import client` or `client.metrics` alone does not load
+# urllib3, six, dateutil or multiprocessing.
+_EXPORTS = {
+    "MsApi": "client.api.ms_api",
+    "ApiClient": "client.api_client",
+    "Configuration": "client.configuration",
+    "MsChannelDto": "client.models.ms_channel_dto",
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    value = getattr(importlib.import_module(_EXPORTS[name]), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_EXPORTS))
@@ -39,6 +39,17 @@ class MsApi(object):
             (data) = self.teams_post_with_http_info(**kwargs)
             return data
 
+    async def teams_post_async(self, **kwargs):
+        """Posts data to Teams channel over the client's asyncio transport.
+
+        >>> result = await api.teams_post_async(body=card)
+
+        :param str body
+        :return: MsChannelDto
+        """
+        kwargs['_return_http_data_only'] = True
+        return await self.teams_post_with_http_info_async(**kwargs)
+
     def teams_post_with_http_info(self, **kwargs):
         """Posts data to Teams channel.
 
@@ -53,6 +64,24 @@ class MsApi(object):
                  If the method is called asynchronously,
                  returns the request thread.
         """
+        params = self.__teams_post_params(kwargs)
+        return self.api_client.call_api(
+            async_req=params.pop('async_req'), **params)
+
+    async def teams_post_with_http_info_async(self, **kwargs):
+        """Posts data to Teams channel over the client's asyncio transport.
+
+        >>> result = await api.teams_post_with_http_info_async(body=card)
+
+        :param str body
+        :return: MsChannelDto, or (MsChannelDto, status, headers)
+        """
+        params = self.__teams_post_params(kwargs)
+        params.pop('async_req')
+        return await self.api_client.call_api_async(**params)
+
+    def __teams_post_params(self, kwargs):
+        """Checks teams_post keyword arguments, returning call_api's."""
         all_params = ['body']
         all_params.append('async_req')
         all_params.append('_return_http_data_only')
@@ -90,11 +119,12 @@ class MsApi(object):
 
         auth_settings = []
 
-        return self.api_client.call_api(
-            '', 'POST',
-            path_params,
-            query_params,
-            header_params,
+        return dict(
+            resource_path='',
+            method='POST',
+            path_params=path_params,
+            query_params=query_params,
+            header_params=header_params,
             body=body_params,
             post_params=form_params,
             files=local_var_files,
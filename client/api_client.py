@@ -1,5 +1,6 @@
 from __future__ import absolute_import
 
+import atexit
 import datetime
 import json
 import mimetypes
@@ -15,6 +16,32 @@ from client.configuration import Configuration
 import client.models
 from client import rest
 
+# Exact types json encoders take without help; bool is listed since type()
+# checks ignore subclassing
+JSON_SCALARS = frozenset((str, int, float, bool, type(None)))
+
+
+def is_json_native(obj):
+    """True if obj is made of dicts with str keys, lists, str, int, float,
+    bool and None only, so it can be encoded without sanitizing."""
+    stack = [obj]
+
+    while stack:
+        value = stack.pop()
+        kind = type(value)
+
+        if kind is dict:
+            for key in value:
+                if type(key) is not str:
+                    return False
+            stack.extend(value.values())
+        elif kind is list:
+            stack.extend(value)
+        elif kind not in JSON_SCALARS:
+            return False
+
+    return True
+
 
 class ApiClient(object):
     """Generic API client.
@@ -25,6 +52,14 @@ class ApiClient(object):
         the API.
     :param cookie: a cookie to include in the header when making calls
         to the API
+
+    Requests made with async_req=True run on a thread pool of
+    configuration.pool_threads threads, created on the first such request.
+    Call close(), or use the client as a context manager, to shut it down.
+
+    call_api_async() is awaitable and runs on an asyncio transport with
+    its own keep-alive connections; close them with aclose(), or use the
+    client as an async context manager.
     """
 
     PRIMITIVE_TYPES = (float, bool, bytes, six.text_type) + six.integer_types
@@ -36,6 +71,8 @@ class ApiClient(object):
                             'date': datetime.date,
                             'datetime': datetime.datetime,
                             'object': object,}
+    _pool = None
+    _async_rest_client = None
 
     def __init__(self, configuration=None, header_name=None, 
                  header_value=None, cookie=None):
@@ -44,7 +81,6 @@ class ApiClient(object):
             configuration = Configuration()
         
         self.configuration = configuration
-        self.pool = ThreadPool()
         self.rest_client = rest.RESTClientObject(configuration)
         self.default_headers = {}
 
@@ -54,9 +90,52 @@ class ApiClient(object):
         self.cookie = cookie
         self.user_agent = 'Swagger-Codegen/1.0.0/python'
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Waits for async requests to finish and stops the thread pool."""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+            atexit.unregister(self.close)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.aclose()
+        self.close()
+
+    async def aclose(self):
+        """Closes the asyncio transport's connections."""
+        if self._async_rest_client is not None:
+            await self._async_rest_client.close()
+            self._async_rest_client = None
+
     def __del__(self):
-        self.pool.close()
-        self.pool.join()
+        self.close()
+
+    @property
+    def pool(self):
+        """Thread pool for async requests, created on first use so
+        synchronous clients never start threads."""
+        if self._pool is None:
+            atexit.register(self.close)
+            self._pool = ThreadPool(self.configuration.pool_threads)
+        return self._pool
+
+    @property
+    def async_rest_client(self):
+        """asyncio transport for call_api_async(), created on first use."""
+        if self._async_rest_client is None:
+            from client.async_rest import AsyncRESTClientObject
+            self._async_rest_client = AsyncRESTClientObject(self.configuration)
+        return self._async_rest_client
 
     @property
     def user_agent(self):
@@ -77,6 +156,44 @@ class ApiClient(object):
             _return_http_data_only=None, collection_formats=None,
             _preload_content=True, _request_timeout=None):
 
+        url, params = self.__prepare_request(
+            resource_path, path_params, query_params, header_params, body,
+            post_params, files, auth_settings, collection_formats)
+
+        # perform request and return response
+        response_data = self.request(
+            method, url, _preload_content=_preload_content,
+            _request_timeout=_request_timeout, **params)
+
+        return self.__handle_response(response_data, response_type,
+                                      _return_http_data_only, _preload_content)
+
+    async def call_api_async(
+            self, resource_path, method, path_params=None,
+            query_params=None, header_params=None, body=None, post_params=None,
+            files=None, response_type=None, auth_settings=None,
+            _return_http_data_only=None, collection_formats=None,
+            _preload_content=True, _request_timeout=None):
+        """Awaitable call_api() on the asyncio transport.
+
+        Takes the arguments of call_api() except async_req and returns the
+        deserialized data, or (data, status, headers).
+        """
+        url, params = self.__prepare_request(
+            resource_path, path_params, query_params, header_params, body,
+            post_params, files, auth_settings, collection_formats)
+
+        response_data = await self.async_rest_client.request(
+            method, url, _preload_content=_preload_content,
+            _request_timeout=_request_timeout, **params)
+
+        return self.__handle_response(response_data, response_type,
+                                      _return_http_data_only, _preload_content)
+
+    def __prepare_request(self, resource_path, path_params, query_params,
+                          header_params, body, post_params, files,
+                          auth_settings, collection_formats):
+        """Returns the request url and its request() keyword arguments."""
         config = self.configuration
 
         # header parameters
@@ -122,14 +239,12 @@ class ApiClient(object):
 
         # request url
         url = self.configuration.host + resource_path
-        
-        # perform request and return response
-        response_data = self.request(
-            method, url, query_params=query_params, headers=header_params,
-            post_params=post_params, body=body,
-            _preload_content=_preload_content,
-            _request_timeout=_request_timeout)
-        
+
+        return url, dict(query_params=query_params, headers=header_params,
+                         post_params=post_params, body=body)
+
+    def __handle_response(self, response_data, response_type,
+                          _return_http_data_only, _preload_content):
         self.last_response = response_data
 
         return_data = response_data
@@ -149,6 +264,8 @@ class ApiClient(object):
     def sanitize_for_serialization(self, obj):
         """Builds a JSON POST object.
 
+        JSON-native objects, such as adaptive card bodies, are returned as
+        is after a walk that only checks types, otherwise:
         If obj is None, return None.
         If obj is str, int, long, float, bool, return directly.
         If obj is datetime.datetime, datetime.date
@@ -160,16 +277,21 @@ class ApiClient(object):
         :param obj: The data to serialize.
         :return: The serialized form of data.
         """
+        if is_json_native(obj):
+            return obj
+
+        return self.__sanitize(obj)
+
+    def __sanitize(self, obj):
+        """Recursive walk of sanitize_for_serialization()."""
         if obj is None:
             return None
         elif isinstance(obj, self.PRIMITIVE_TYPES):
             return obj
         elif isinstance(obj, list):
-            return [self.sanitize_for_serialization(sub_obj)
-                    for sub_obj in obj]
+            return [self.__sanitize(sub_obj) for sub_obj in obj]
         elif isinstance(obj, tuple):
-            return tuple(self.sanitize_for_serialization(sub_obj)
-                         for sub_obj in obj)
+            return tuple(self.__sanitize(sub_obj) for sub_obj in obj)
         elif isinstance(obj, (datetime.datetime, datetime.date)):
             return obj.isoformat()
 
@@ -185,7 +307,7 @@ class ApiClient(object):
                         for attr, _ in six.iteritems(obj.types)
                         if getattr(obj, attr) is not None}
 
-        return {key: self.sanitize_for_serialization(val)
+        return {key: self.__sanitize(val)
                 for key, val in six.iteritems(obj_dict)}
 
     def deserialize(self, response, response_type):
@@ -0,0 +1,339 @@
+"""
+    asyncio transport behind ApiClient.call_api_async(). Requests go out
+    through aiohttp's connection pool when it is installed, else as HTTP/1.1
+    over asyncio streams. Either way keep-alive connections are reused per
+    host, so awaiting a request never hands work to a thread. Use one
+    transport from one event loop.
+"""
+
+from __future__ import absolute_import
+
+import asyncio
+import logging
+import re
+import ssl
+import time
+
+import certifi
+from six.moves.urllib.parse import urlencode, urlsplit
+
+from client.rest import ApiException, dumps, record_request
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+logger = logging.getLogger("rest")
+
+# Connection errors, timeouts and malformed responses of either client
+TRANSPORT_ERRORS = (OSError, EOFError, ValueError, asyncio.TimeoutError)
+if aiohttp is not None:
+    TRANSPORT_ERRORS += (aiohttp.ClientError,)
+
+# Methods a server may see twice without harm, RFC 9110 section 9.2.2
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+
+
+class ClosedByPeer(ConnectionError):
+    """The server dropped the connection before answering. On an idle
+    keep-alive connection the request is resent on a fresh one if it was
+    never written, or if it is idempotent."""
+
+
+class AsyncRESTResponse(object):
+
+    def __init__(self, status, reason, headers, data):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.data = data
+
+    def getheaders(self):
+        """Returns a dictionary of the response headers."""
+        return dict(self.headers)
+
+    def getheader(self, name, default=None):
+        """Returns a given response header."""
+        for key, value in self.headers:
+            if key.lower() == name.lower():
+                return value
+        return default
+
+
+class AsyncRESTClientObject(object):
+
+    def __init__(self, configuration, maxsize=None):
+        if configuration.proxy:
+            raise ValueError("The asyncio transport does not support proxies")
+
+        self.ssl_context = ssl.create_default_context(
+            cafile=configuration.ssl_ca_cert or certifi.where())
+        if configuration.cert_file:
+            self.ssl_context.load_cert_chain(
+                configuration.cert_file, configuration.key_file)
+        if not configuration.verify_ssl:
+            self.ssl_context.check_hostname = False
+            self.ssl_context.verify_mode = ssl.CERT_NONE
+        elif configuration.assert_hostname is False:
+            self.ssl_context.check_hostname = False
+
+        # Connections open at once per host, as urllib3's pool maxsize
+        if maxsize is None:
+            maxsize = configuration.connection_pool_maxsize or 4
+        self.maxsize = maxsize
+        self.timeout = configuration.async_request_timeout
+        # (scheme, host, port) -> idle (reader, writer) pairs
+        self._idle = {}
+        self._slots = {}
+        # aiohttp session, opened on the first request's event loop
+        self._session = None
+
+    async def request(self, method, url, query_params=None, headers=None,
+                      body=None, post_params=None, _preload_content=True,
+                      _request_timeout=None):
+        """Perform requests.
+
+        Takes the arguments of RESTClientObject.request(). Bodies are sent
+        as JSON, or as is when given as str or pre-serialized bytes; form
+        and multipart posts need the urllib3 transport. The response body is always read.
+
+        :param _request_timeout: total seconds for the request, or a
+                                 (connection, read) pair. Defaults to the
+                                 configuration's async_request_timeout.
+        """
+        method = method.upper()
+        assert method in ['GET', 'HEAD', 'DELETE', 'POST', 'PUT',
+                          'PATCH', 'OPTIONS']
+
+        if post_params:
+            raise ApiException(
+                status=0,
+                reason="The asyncio transport cannot send form parameters")
+
+        headers = dict(headers or {})
+        if 'Content-Type' not in headers:
+            headers['Content-Type'] = 'application/json'
+
+        if query_params:
+            url += ('&' if '?' in url else '?') + urlencode(query_params)
+
+        request_body = None
+        if method in ['POST', 'PUT', 'PATCH', 'OPTIONS', 'DELETE']:
+            if re.search('json', headers['Content-Type'], re.IGNORECASE):
+                if body is None:
+                    request_body = '{}'
+                elif isinstance(body, bytes):
+                    request_body = body
+                else:
+                    request_body = dumps(body)
+            elif isinstance(body, str):
+                request_body = body
+            elif body is not None:
+                raise ApiException(
+                    status=0,
+                    reason="Cannot prepare a request message for provided "
+                           "arguments. Please check that your arguments "
+                           "match declared content type.")
+            logger.info(f'{method}')
+        else:
+            logger.info(f'{method} {url}')
+
+        total, connect, read = self.timeouts(_request_timeout)
+        start = time.monotonic()
+
+        try:
+            r = await asyncio.wait_for(
+                self._send(method, url, headers, request_body, connect, read),
+                total)
+        except ssl.SSLError as e:
+            record_request(method, url, "error", start, request_body)
+            msg = "{0}\n{1}".format(type(e).__name__, str(e))
+            raise ApiException(status=0, reason=msg)
+        except TRANSPORT_ERRORS as e:
+            record_request(method, url, "error", start, request_body)
+            msg = "{0}\n{1}".format(type(e).__name__, str(e))
+            raise ApiException(status=0, reason=msg)
+
+        record_request(method, url, r.status, start, request_body)
+
+        if not 200 <= r.status <= 299:
+            raise ApiException(http_resp=r)
+
+        return r
+
+    def timeouts(self, _request_timeout):
+        """(total, connect, read) seconds, None where unlimited."""
+        if _request_timeout is None:
+            return self.timeout, None, None
+        if isinstance(_request_timeout, tuple) and len(_request_timeout) == 2:
+            return None, _request_timeout[0], _request_timeout[1]
+        return _request_timeout, None, None
+
+    async def _send(self, method, url, headers, body, connect_timeout,
+                    read_timeout):
+        if aiohttp is not None:
+            return await self._send_aiohttp(method, url, headers, body,
+                                            connect_timeout, read_timeout)
+
+        parts = urlsplit(url)
+        https = parts.scheme == 'https'
+        key = (parts.scheme, parts.hostname, parts.port or (443 if https else 80))
+        host = parts.netloc.rpartition('@')[2]
+        target = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+        if body is None or isinstance(body, bytes):
+            data = body or b''
+        else:
+            data = body.encode('utf-8')
+
+        head = [f'{method} {target} HTTP/1.1', f'Host: {host}']
+        head += [f'{name}: {value}' for name, value in headers.items()]
+        if body is not None:
+            head.append(f'Content-Length: {len(data)}')
+        message = ('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + data
+
+        if key not in self._slots:
+            self._slots[key] = asyncio.Semaphore(self.maxsize)
+
+        async with self._slots[key]:
+            while True:
+                reused, (reader, writer) = await self._connection(
+                    key, connect_timeout)
+                written = False
+
+                try:
+                    try:
+                        writer.write(message)
+                        await writer.drain()
+                    except ConnectionError as e:
+                        raise ClosedByPeer(str(e))
+
+                    written = True
+                    response, keep_alive = await asyncio.wait_for(
+                        self._read_response(reader, method), read_timeout)
+                except ClosedByPeer:
+                    writer.close()
+                    # An idle connection the server already closed. Once
+                    # written, a POST may have been acted on before the close,
+                    # so only idempotent requests are sent again.
+                    if reused and (not written or method in IDEMPOTENT_METHODS):
+                        continue
+                    raise
+                except BaseException:
+                    writer.close()
+                    raise
+
+                if keep_alive:
+                    self._idle.setdefault(key, []).append((reader, writer))
+                else:
+                    writer.close()
+
+                return response
+
+    async def _send_aiohttp(self, method, url, headers, body,
+                            connect_timeout, read_timeout):
+        if self._session is None:
+            connector = aiohttp.TCPConnector(
+                limit=0, limit_per_host=self.maxsize, ssl=self.ssl_context)
+            self._session = aiohttp.ClientSession(connector=connector)
+
+        timeout = aiohttp.ClientTimeout(
+            total=None, sock_connect=connect_timeout, sock_read=read_timeout)
+
+        async with self._session.request(method, url, headers=headers,
+                                         data=body, timeout=timeout) as r:
+            data = await r.read()
+            return AsyncRESTResponse(r.status, r.reason,
+                                     list(r.headers.items()), data)
+
+    async def _connection(self, key, connect_timeout):
+        """(reused, (reader, writer)) for key, idle connections first."""
+        idle = self._idle.get(key)
+
+        while idle:
+            reader, writer = idle.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return True, (reader, writer)
+            writer.close()
+
+        scheme, host, port = key
+        connection = await asyncio.wait_for(
+            asyncio.open_connection(
+                host, port, ssl=self.ssl_context if scheme == 'https' else None),
+            connect_timeout)
+        return False, connection
+
+    async def _read_response(self, reader, method):
+        """(response, whether the connection can be reused)"""
+        while True:
+            status_line = await reader.readline()
+            if not status_line:
+                raise ClosedByPeer("Connection closed before a response")
+
+            version, status, reason = (
+                status_line.decode('latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+            status = int(status)
+            headers = await self._read_headers(reader)
+
+            # Interim responses precede the real one
+            if not 100 <= status < 200:
+                break
+
+        fields = {name.lower(): value for name, value in headers}
+        keep_alive = (version == 'HTTP/1.1' and
+                      fields.get('connection', '').lower() != 'close')
+
+        if method == 'HEAD' or status in (204, 304):
+            data = b''
+        elif 'chunked' in fields.get('transfer-encoding', '').lower():
+            data = await self._read_chunked(reader)
+        elif 'content-length' in fields:
+            data = await reader.readexactly(int(fields['content-length']))
+        else:
+            # Body runs until the server closes the connection
+            data = await reader.read()
+            keep_alive = False
+
+        return AsyncRESTResponse(status, reason, headers, data), keep_alive
+
+    async def _read_headers(self, reader):
+        headers = []
+
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n'):
+                return headers
+            if not line:
+                raise ConnectionResetError("Connection closed in the headers")
+
+            name, _, value = line.decode('latin-1').partition(':')
+            headers.append((name.strip(), value.strip()))
+
+    async def _read_chunked(self, reader):
+        chunks = []
+
+        while True:
+            size = int((await reader.readline()).split(b';')[0].strip(), 16)
+            if size == 0:
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+
+        # Trailers end with a blank line
+        await self._read_headers(reader)
+        return b''.join(chunks)
+
+    async def close(self):
+        """Closes the idle keep-alive connections."""
+        session, self._session = self._session, None
+        if session is not None:
+            await session.close()
+
+        idle, self._idle, self._slots = self._idle, {}, {}
+        writers = [writer for pairs in idle.values() for _, writer in pairs]
+
+        for writer in writers:
+            writer.close()
+
+        await asyncio.gather(*(writer.wait_closed() for writer in writers),
+                             return_exceptions=True)
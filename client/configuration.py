@@ -82,6 +82,14 @@ class Configuration(six.with_metaclass(TypeWithDefault, object)):
         # cpu_count * 5 is used as default value to increase performance.
         self.connection_pool_maxsize = multiprocessing.cpu_count() * 5
 
+        # Threads running ApiClient requests made with async_req=True. The
+        # pool is only started by the first such request.
+        self.pool_threads = 1
+
+        # Seconds a request on the asyncio transport (ApiClient.call_api_async)
+        # may take when no _request_timeout is given, None waits forever
+        self.async_request_timeout = 60
+
         # Proxy URL
         self.proxy = None
         # Safe chars for path_param
@@ -0,0 +1,208 @@
+"""
+    Counters, gauges and histograms kept by the REST client and search.py,
+    rendered in the Prometheus text exposition format at the end of a run.
+"""
+
+import threading
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Seconds
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Bytes; Teams rejects webhook payloads over 28 KB
+SIZE_BUCKETS = (256, 1024, 4096, 8192, 16384, 28000, 65536, 262144, 1048576)
+
+
+def escape(value):
+    """Escapes a label value for the exposition format."""
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+
+    if not pairs:
+        return ""
+
+    return "{" + ",".join(f'{n}="{escape(v)}"' for n, v in pairs) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    """One metric family; each distinct set of label values is one series."""
+
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(
+                f"{self.name} takes labels {self.labelnames}, got {tuple(labels)}"
+            )
+
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def value(self, **labels):
+        """Current value of one series, None if it was never set."""
+        with self._lock:
+            return self._series.get(self._key(labels))
+
+    def clear(self):
+        with self._lock:
+            self._series = {}
+
+    def samples(self):
+        """Yields (suffix, label values, extra labels, value) per sample."""
+        with self._lock:
+            series = dict(self._series)
+
+        for key in sorted(series):
+            yield "", key, (), series[key]
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {escape(self.documentation)}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+
+        for suffix, key, extra, value in self.samples():
+            labels = format_labels(self.labelnames, key, extra)
+            lines.append(f"{self.name}{suffix}{labels} {format_value(value)}")
+
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+
+class Gauge(Metric):
+
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+
+        with self._lock:
+            self._series[key] = value
+
+
+class Histogram(Metric):
+    """Observations counted into fixed, cumulative upper bounds."""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+
+        with self._lock:
+            # [count per bucket..., sum]
+            series = self._series.setdefault(key, [0] * len(self.buckets) + [0.0])
+
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+
+            series[-1] += value
+
+    def value(self, **labels):
+        """(count, sum) of one series, None if nothing was observed."""
+        series = super(Histogram, self).value(**labels)
+        return None if series is None else (sum(series[:-1]), series[-1])
+
+    def samples(self):
+        for _, key, _, series in super(Histogram, self).samples():
+            count = 0
+
+            for bound, n in zip(self.buckets, series):
+                count += n
+                yield "_bucket", key, (("le", format_value(float(bound))),), count
+
+            yield "_sum", key, (), series[-1]
+            yield "_count", key, (), count
+
+
+class Registry(object):
+    """Named metrics of one process. Asking twice for a name returns the
+    metric created first, so modules can declare what they record."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, *args, **kwargs):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = cls(name, *args, **kwargs)
+
+            return self._metrics[name]
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._get(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._get(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._get(Histogram, name, documentation, labelnames, buckets)
+
+    def clear(self):
+        """Drops every recorded value, keeping the metrics."""
+        for metric in list(self._metrics.values()):
+            metric.clear()
+
+    def render(self):
+        """Every metric in the text exposition format."""
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+    def write(self, path):
+        """Writes the exposition, e.g. for the node exporter textfile collector."""
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(self.render())
+
+    def push(self, url, timeout=10):
+        """POSTs the exposition to a Pushgateway style endpoint, e.g.
+        http://localhost:9091/metrics/job/contract_alerts"""
+        import urllib3
+
+        response = urllib3.PoolManager().request(
+            "POST",
+            url,
+            body=self.render().encode("utf-8"),
+            headers={"Content-Type": CONTENT_TYPE},
+            timeout=timeout,
+        )
+
+        if not 200 <= response.status <= 299:
+            raise urllib3.exceptions.HTTPError(
+                f"Metrics push to {url} returned HTTP {response.status}"
+            )
+
+
+REGISTRY = Registry()
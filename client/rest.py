@@ -6,20 +6,72 @@ import json
 import logging
 import re
 import ssl
+import time
 
 import certifi
 import six
-from six.moves.urllib.parse import urlencode
+from six.moves.urllib.parse import urlencode, urlsplit
 
 try:
     import urllib3
 except ImportError:
     raise ImportError('Python client requires urllib3.')
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+from client.metrics import REGISTRY, SIZE_BUCKETS
 
 logger = logging.getLogger("rest")
 logger.setLevel(logging.INFO)
 
+REQUESTS = REGISTRY.counter(
+    "http_client_requests_total",
+    "Requests sent by the REST client by response status, error if none came",
+    ("method", "host", "status"),
+)
+LATENCY = REGISTRY.histogram(
+    "http_client_request_duration_seconds",
+    "Time until the REST client had a response",
+    ("method", "host"),
+)
+BODY_SIZE = REGISTRY.histogram(
+    "http_client_request_body_bytes",
+    "Size of request bodies sent by the REST client",
+    ("method", "host"),
+    SIZE_BUCKETS,
+)
+
+
+def dumps(body):
+    """Serializes a request body to JSON, with orjson when installed.
+
+    orjson writes compact UTF-8 where json.dumps adds spaces and escapes
+    non-ASCII text, so its output is never the larger of the two.
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(body)
+        except TypeError:
+            # e.g. ints beyond 64 bits or non-str keys
+            pass
+
+    return json.dumps(body)
+
+
+def record_request(method, url, status, start, body):
+    """Counts a finished request in the client metrics."""
+    host = urlsplit(url).hostname or ""
+    REQUESTS.inc(method=method, host=host, status=status)
+    LATENCY.observe(time.monotonic() - start, method=method, host=host)
+
+    if body is not None:
+        size = len(body if isinstance(body, bytes) else body.encode("utf-8"))
+        BODY_SIZE.observe(size, method=method, host=host)
+
 
 class RESTResponse(io.IOBase):
 
@@ -102,7 +154,8 @@ class RESTClientObject(object):
         :param url: http request url
         :param query_params: query parameters in the url
         :param headers: http request headers
-        :param body: request json body, for `application/json`
+        :param body: request json body, for `application/json`, or its
+                     pre-serialized bytes
         :param post_params: request post parameters,
                             `application/x-www-form-urlencoded`
                             and `multipart/form-data`
@@ -138,6 +191,9 @@ class RESTClientObject(object):
         if 'Content-Type' not in headers:
             headers['Content-Type'] = 'application/json'
 
+        start = time.monotonic()
+        request_body = None
+
         try:
             # For `POST`, `PUT`, `PATCH`, `OPTIONS`, `DELETE`
             if method in ['POST', 'PUT', 'PATCH', 'OPTIONS', 'DELETE']:
@@ -145,8 +201,11 @@ class RESTClientObject(object):
                     url += '?' + urlencode(query_params)
                 if re.search('json', headers['Content-Type'], re.IGNORECASE):
                     request_body = '{}'
-                    if body is not None:
-                        request_body = json.dumps(body)
+                    if isinstance(body, bytes):
+                        # Pre-serialized JSON goes out as is
+                        request_body = body
+                    elif body is not None:
+                        request_body = dumps(body)
                     logger.info(f'{method}')
                     r = self.pool_manager.request(
                         method, url,
@@ -205,8 +264,14 @@ class RESTClientObject(object):
                                               timeout=timeout,
                                               headers=headers)
         except urllib3.exceptions.SSLError as e:
+            record_request(method, url, "error", start, request_body)
             msg = "{0}\n{1}".format(type(e).__name__, str(e))
             raise ApiException(status=0, reason=msg)
+        except urllib3.exceptions.HTTPError:
+            record_request(method, url, "error", start, request_body)
+            raise
+
+        record_request(method, url, r.status, start, request_body)
 
         if _preload_content:
             r = RESTResponse(r)
@@ -0,0 +1,236 @@
+"""
+    Local stand-in for the FPDS ezsearch portal, for end-to-end runs and
+    benchmarks of search.py without fpds.gov access. Serves result pages of
+    resultbox tables, a "Next" pager and the matching detail pages, with
+    optional latency and jitter per request.
+
+    Point search.py at it through its base url setting:
+
+    python3 fpds_standin.py [tables] [pages] [latency] [jitter]
+    FPDS_BASE_URL=http://127.0.0.1:8000/ezsearch/fpdsportal?q= python3 search.py ...
+"""
+
+import collections
+import html
+import random
+import re
+import sys
+import threading
+import time
+from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, urlsplit
+
+RESULTS_PATH = "/ezsearch/fpdsportal"
+DETAIL_PATH = "/ezsearch/jsp/viewLinkController.jsp"
+REASONS = (
+    "Exercise An Option",
+    "Funding Only Action",
+    "Other Administrative Action",
+    "Supplemental Agreement For Work Within Scope",
+)
+
+RESULT_TABLE = """<table class="resultbox{parity}" width="100%" cellspacing="0" cellpadding="2">
+  <tr>
+    <td class="ez_header"><span class="results_title_text">Award ID:</span></td>
+    <td class="results_text">{piid} <a title="View" href="{view}" target="_blank">(View)</a></td>
+    <td class="ez_header"><span class="results_title_text">Referenced IDV ID:</span></td>
+    <td class="results_text">{idv}</td>
+    <td class="ez_header"><span class="results_title_text">Modification Number:</span></td>
+    <td class="results_text">{mod}</td>
+  </tr>
+  <tr>
+    <td class="ez_header"><span class="results_title_text">Date Signed:</span></td>
+    <td class="results_text">{signed}</td>
+    <td class="ez_header"><span class="results_title_text">Legal Business Name:</span></td>
+    <td class="results_text">{company}</td>
+    <td class="ez_header"><span class="results_title_text">Action Obligation:</span></td>
+    <td class="results_text">{obligation}</td>
+  </tr>
+  <tr>
+    <td class="ez_header"><span class="results_title_text">NAICS Code:</span></td>
+    <td class="results_text">{naics}</td>
+  </tr>
+</table>
+"""
+
+DETAIL_PAGE = """<!DOCTYPE html>
+<html>
+<head><title>Contract Action Report</title></head>
+<body>
+<form name="contractForm" method="post">
+<table>
+  <tr>
+    <td>Reason For Modification:</td>
+    <td><input type="text" name="reasonForModification" value="{reason}" readonly="readonly" size="40"></td>
+  </tr>
+  <tr>
+    <td>Description of Requirement:</td>
+    <td><textarea id="descriptionOfContractRequirement" name="descriptionOfContractRequirement" rows="4" cols="60" readonly>
+{desc}</textarea></td>
+  </tr>
+</table>
+</form>
+</body>
+</html>
+"""
+
+
+def query_terms(q: str) -> tuple[list[str], list[str]]:
+    # Contract numbers and NAICS codes an ezsearch query asks for
+    naics = re.findall(r'PRINCIPAL_NAICS_CODE:"(\w+)"', q)
+
+    if naics or "CONTRACTING_AGENCY_NAME" in q:
+        return [], naics
+
+    terms = re.findall(r"[\w-]+", q.split("SIGNED_DATE")[0])
+    return [term for term in terms if term != "OR"], []
+
+
+class StandinFpds:
+    # Threaded HTTP server answering ezsearch and detail page requests. Every
+    # query has `pages` pages of `tables` actions; use as a context manager
+    # or call start() and stop().
+
+    def __init__(
+        self,
+        tables: int = 30,
+        pages: int = 1,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ) -> None:
+        self.tables = tables
+        self.pages = pages
+        self.latency = latency
+        self.jitter = jitter
+        self.requests = collections.Counter()
+        self._server = ThreadingHTTPServer((host, port), StandinHandler)
+        self._server.daemon_threads = True
+        self._server.standin = self
+        self._thread = None
+
+    def __enter__(self) -> "StandinFpds":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def base_url(self) -> str:
+        # Value for SearchSettings.base_url / FPDS_BASE_URL
+        return f"{self.url}{RESULTS_PATH}?q="
+
+    def start(self) -> "StandinFpds":
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def delay(self) -> None:
+        pause = self.latency + random.uniform(0, self.jitter)
+
+        if pause > 0:
+            time.sleep(pause)
+
+    def results_page(self, q: str, start: int) -> str:
+        # One page of resultbox tables, with a pager while pages remain
+        contracts, naics = query_terms(q)
+        number = start // max(1, self.tables)
+        tables = []
+
+        for n in range(start, start + self.tables):
+            piid = contracts[n % len(contracts)] if contracts else f"STANDIN{n:06d}"
+            mod = f"P{n:05d}"
+            view = f"{DETAIL_PATH}?agencyID=7529&PIID={quote(piid)}&modNumber={mod}&contractType=AWARD"
+            tables.append(
+                RESULT_TABLE.format(
+                    parity=n % 2 + 1,
+                    piid=html.escape(piid),
+                    view=html.escape(view),
+                    idv="",
+                    mod=mod,
+                    signed=date.today().strftime("%m/%d/%Y"),
+                    company=f"Stand-in Vendor {n % 97} &amp; Sons",
+                    obligation=f"${n * 125 % 100000:,}.00",
+                    naics=naics[n % len(naics)] if naics else "541512",
+                )
+            )
+
+        pager = f"<span>Page {number + 1} of {self.pages}</span>"
+
+        if number + 1 < self.pages:
+            next_href = f"{RESULTS_PATH}?q={quote(q)}&start={start + self.tables}"
+            pager += f'\n<a href="{html.escape(next_href)}" title="Next Page">Next &gt;</a>'
+
+        return (
+            "<!DOCTYPE html>\n<html>\n<head><title>FPDS-NG ezSearch</title></head>\n"
+            f"<body>\n{''.join(tables)}<div class=\"pagination\">\n{pager}\n</div>\n"
+            "</body>\n</html>\n"
+        )
+
+    def detail_page(self, piid: str, mod: str) -> str:
+        n = int(mod[1:]) if mod[1:].isdigit() else 0
+        desc = f"Stand-in action {piid} {mod}.\nFunds option year {n % 5 + 1} & more."
+        return DETAIL_PAGE.format(
+            reason=html.escape(REASONS[n % len(REASONS)]), desc=html.escape(desc)
+        )
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    # Routes GETs to the owning StandinFpds
+
+    def do_GET(self) -> None:
+        standin = self.server.standin
+        parts = urlsplit(self.path)
+        query = parse_qs(parts.query)
+        standin.requests[parts.path] += 1
+        standin.delay()
+
+        if parts.path == RESULTS_PATH:
+            start = int(query.get("start", ["0"])[0])
+            body = standin.results_page(query.get("q", [""])[0], start)
+        elif parts.path == DETAIL_PATH:
+            body = standin.detail_page(
+                query.get("PIID", [""])[0], query.get("modNumber", [""])[0]
+            )
+        else:
+            self.send_error(404)
+            return
+
+        data = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=UTF-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format: str, *args) -> None:
+        # Keep benchmark and test output clean
+        pass
+
+
+def main(args: list[str]) -> None:
+    tables, pages = (int(a) for a in (args + ["30", "1"])[:2])
+    latency, jitter = (float(a) for a in (args[2:] + ["0", "0"])[:2])
+
+    with StandinFpds(tables, pages, latency, jitter, port=8000) as standin:
+        print(f"Serving {pages} x {tables} actions per query at {standin.base_url}")
+
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -3,93 +3,2049 @@
     from fpds and post results to MS Teams. 
 """
 
+from __future__ import annotations
+
+import asyncio
+import collections
+import contextvars
+import functools
+import json
 import logging
+import os
+import random
+import re
+import sqlite3
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import aclosing, closing, contextmanager, nullcontext
+from dataclasses import dataclass, fields
 from datetime import date, datetime, timedelta
+from html.parser import HTMLParser
+from typing import TYPE_CHECKING, AsyncIterator, Callable, Iterable, Iterator
+from urllib.parse import parse_qs, urljoin, urlsplit
+
+# Playwright, urllib3 and the client's REST stack are imported where first
+# used, so runs with nothing to search or post start quickly. The client
+# package itself loads its modules lazily.
+import client
+from client.metrics import REGISTRY
+import time
+
+if TYPE_CHECKING:
+    from playwright.async_api import Locator as AsyncLocator
+    from playwright.async_api import Page as AsyncPage
+    from playwright.sync_api import Locator, Page
+
+    from client.rest import RESTClientObject
+
+
+log = logging.getLogger("search")
+logging.basicConfig(level=logging.INFO)
+
+BASE_URL = "https://www.fpds.gov/ezsearch/fpdsportal?q="
+QUERY_SUFFIX = "&templateName=1.5.3&indexName=awardfull&sortBy=SIGNED_DATE&desc=Y"
+
+
+@dataclass
+class SearchSettings:
+    # Run tunables. Each field can be overridden by an FPDS_<NAME> env var.
+
+    # ezsearch endpoint queries are appended to, e.g. a local stand-in server
+    base_url: str = BASE_URL
+    # Criteria searched at once; 1 runs the sequential sync engine
+    concurrency: int = 2
+    # Worker pages resolving "(View)" detail pages within one search
+    detail_workers: int = 4
+    # "browser" renders detail pages in Chromium, "http" fetches them directly
+    detail_mode: str = "browser"
+    # "browser" drives Chromium, "http" parses ezsearch result pages directly
+    engine: str = "browser"
+    # Comma separated resource types aborted before download, "" disables
+    blocked_resources: str = "image,font,media"
+    # Comma separated analytics/tracking hosts aborted before download
+    blocked_hosts: str = "google-analytics.com,googletagmanager.com,doubleclick.net"
+    # Comma separated url fragments that are never blocked
+    allowed_urls: str = ""
+    # Contract numbers combined into one OR query, 1 searches each on its own
+    contract_batch_size: int = 20
+    # NAICS codes of one agency combined into one OR query, 1 disables
+    naics_batch_size: int = 20
+    # Longest ezsearch url a batched query may produce
+    max_url_length: int = 2000
+    # Result pages read per query before giving up on the rest
+    max_pages: int = 10
+    # SQLite file caching detail page fields between runs, "" disables
+    cache_path: str = "fpds_cache.sqlite3"
+    # Days a cached detail stays valid
+    cache_ttl_days: float = 30.0
+    # Cached details kept after eviction, newest first
+    cache_max_entries: int = 20000
+    # SQLite file holding per-criterion watermarks and posted actions, ""
+    # searches a fixed one day window every run
+    state_path: str = "fpds_state.sqlite3"
+    # Furthest back a watermark can reach after missed runs
+    max_lookback_days: int = 14
+    # Largest serialized Teams card; a card is posted as soon as it fills
+    card_max_bytes: int = 27000
+    # Teams posts in flight at once. Channels show cards in arrival order,
+    # so only 1 guarantees reading order.
+    post_concurrency: int = 1
+    # "thread" posts to Teams from the client's thread pool, "asyncio" on
+    # the run's event loop, where posts overlap with the concurrent engine's
+    # searches without thread hops
+    post_transport: str = "thread"
+    # Fpds navigations (result and detail pages) started per second, 0 disables
+    rate_limit: float = 2.0
+    # Navigations that may start back to back after an idle spell
+    rate_burst: int = 4
+    # Floor the rate backs off to while the portal times out or returns 5xx
+    min_rate_limit: float = 0.2
+    # Responses quicker than this let a backed off rate recover
+    slow_response_seconds: float = 5.0
+    # Extra attempts per navigation after a timeout, connection error or 5xx
+    retries: int = 3
+    # First retry waits up to this long, doubling per attempt
+    retry_backoff_seconds: float = 2.0
+    # Consecutive failed navigations that stop all fpds traffic, 0 disables
+    breaker_threshold: int = 5
+    # Seconds fpds is left alone once the breaker has tripped
+    breaker_cooldown_seconds: float = 120.0
+    # JSON file the run's per stage and per criterion timings are written
+    # to, "-" logs them, "" disables timing
+    timings_path: str = ""
+    # File the run's metrics are written to in the Prometheus text format,
+    # e.g. for the node exporter textfile collector, "" disables
+    metrics_path: str = ""
+    # Pushgateway url the metrics are POSTed to, "" disables
+    metrics_push_url: str = ""
+
+    @classmethod
+    def from_env(cls, environ: dict | None = None) -> "SearchSettings":
+        # Build settings from FPDS_* environment variables
+        environ = os.environ if environ is None else environ
+        overrides = {}
+
+        for field in fields(cls):
+            value = environ.get(f"FPDS_{field.name.upper()}")
+
+            if value is None:
+                continue
+
+            if isinstance(field.default, bool):
+                overrides[field.name] = value.strip().lower() in ("1", "true", "yes")
+            elif isinstance(field.default, (int, float)):
+                overrides[field.name] = type(field.default)(value)
+            else:
+                overrides[field.name] = value
+
+        return cls(**overrides)
+
+
+def split_list(value: str) -> list[str]:
+    # Parse a comma separated setting
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+# Watchlist entries the running search covers, for attributing its spans
+CURRENT_CRITERIA = contextvars.ContextVar("criteria", default=None)
+
+
+class Timings:
+    # Wall time per stage of the run, and per stage of each criterion's
+    # search. Filled by span() blocks while enabled.
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.stages = {}
+        self.criteria = {}
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def enable(self) -> None:
+        # Start a fresh recording
+        with self._lock:
+            self.enabled = True
+            self.stages = {}
+            self.criteria = {}
+            self.started = time.perf_counter()
+
+    def disable(self) -> None:
+        self.enabled = False
+
+    def record(self, stage: str, elapsed: float) -> None:
+        criteria = CURRENT_CRITERIA.get()
+
+        with self._lock:
+            # [count, total, longest]
+            stats = self.stages.setdefault(stage, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+
+            if criteria is not None:
+                per_stage = self.criteria.setdefault(criteria, {})
+                per_stage[stage] = per_stage.get(stage, 0.0) + elapsed
+
+    def summary(self) -> dict:
+        # JSON-ready totals in seconds. Stages overlap: concurrent searches
+        # and prefetches run side by side, so totals can exceed the run time.
+        with self._lock:
+            return {
+                "run_s": round(time.perf_counter() - self.started, 4),
+                "stages": {
+                    stage: {
+                        "count": count,
+                        "total_s": round(total, 4),
+                        "max_s": round(longest, 4),
+                    }
+                    for stage, (count, total, longest) in self.stages.items()
+                },
+                "criteria": {
+                    criteria: {stage: round(total, 4) for stage, total in per_stage.items()}
+                    for criteria, per_stage in self.criteria.items()
+                },
+            }
+
+    def write(self, path: str) -> None:
+        # Emit the summary as JSON to a file, or to the log for "-"
+        summary = json.dumps(self.summary(), sort_keys=True)
+
+        if path == "-":
+            log.info("Timings: %s", summary)
+            return
+
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(summary + "\n")
+
+
+TIMINGS = Timings()
+
+
+class Span:
+    # Context manager adding the time spent in its block to a stage
+
+    __slots__ = ("stage", "start")
+
+    def __init__(self, stage: str) -> None:
+        self.stage = stage
+
+    def __enter__(self) -> "Span":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        TIMINGS.record(self.stage, time.perf_counter() - self.start)
+
+
+# Shared by every span() while timings are off, so disabled spans allocate
+# nothing
+NO_SPAN = nullcontext()
+
+# End of items for timed(), which may include None
+NO_ITEM = object()
+
+
+def span(stage: str) -> Span | nullcontext:
+    # Time a block as one stage of the run
+    if not TIMINGS.enabled:
+        return NO_SPAN
+
+    return Span(stage)
+
+
+def timed(stage: str, items: Iterable) -> Iterator:
+    # Pass items on, timing each wait for the next one as a stage but not
+    # the time the consumer spends between them
+    items = iter(items)
+
+    while True:
+        with span(stage):
+            item = next(items, NO_ITEM)
+
+        if item is NO_ITEM:
+            return
+
+        yield item
+
+
+# Run metrics, exported by main(). The REST client adds request counts,
+# latencies and body sizes per host, covering the Teams webhook.
+NAVIGATIONS = REGISTRY.counter(
+    "fpds_navigations_total", "FPDS page loads and fetches started, retries excluded"
+)
+NAVIGATION_FAILURES = REGISTRY.counter(
+    "fpds_navigation_failures_total", "Failed FPDS page load attempts", ("error",)
+)
+FAILED_SEARCHES = REGISTRY.counter(
+    "fpds_failed_searches_total",
+    "Searches broken off by an FPDS error or max_pages, keeping partial results",
+    ("error",),
+)
+RESULT_PAGES = REGISTRY.counter(
+    "fpds_result_pages_total", "ezsearch result pages read", ("engine",)
+)
+ROWS = REGISTRY.counter(
+    "fpds_rows_extracted_total", "Contract actions read from result pages"
+)
+DETAILS = REGISTRY.counter(
+    "fpds_details_total",
+    "Reason and description resolved per new action, by where they came from",
+    ("source",),
+)
+CARDS = REGISTRY.counter("teams_cards_posted_total", "Cards posted to Teams")
+RUN_DURATION = REGISTRY.gauge("fpds_run_duration_seconds", "Duration of the run")
+RUN_SUCCESS = REGISTRY.gauge(
+    "fpds_run_success", "1 if the run posted its results and committed its state"
+)
+
+
+@contextmanager
+def criteria_span(criteria: dict) -> Iterator[None]:
+    # Time a search, attributing the spans inside it to its watchlist entries
+    if not TIMINGS.enabled:
+        yield
+        return
+
+    token = CURRENT_CRITERIA.set(",".join(criteria_keys(criteria)))
+
+    try:
+        with Span("search"):
+            yield
+    finally:
+        CURRENT_CRITERIA.reset(token)
+
+
+class ResourcePolicy:
+    # page.route handler aborting requests extraction never reads. Blocked
+    # requests are counted per resource type; their size is never known since
+    # the body is not downloaded.
+
+    def __init__(
+        self, resource_types: list[str], hosts: list[str], allowed: list[str]
+    ) -> None:
+        self.resource_types = set(resource_types)
+        self.hosts = hosts
+        self.allowed = allowed
+        self.blocked = collections.Counter()
+        self.continued = 0
+
+    @classmethod
+    def from_settings(cls, settings: SearchSettings) -> "ResourcePolicy | None":
+        resource_types = split_list(settings.blocked_resources)
+        hosts = split_list(settings.blocked_hosts)
+
+        if not resource_types and not hosts:
+            return None
+
+        return cls(resource_types, hosts, split_list(settings.allowed_urls))
+
+    def should_block(self, url: str, resource_type: str) -> bool:
+        if any(fragment in url for fragment in self.allowed):
+            return False
+
+        if resource_type in self.resource_types:
+            return True
+
+        host = urlsplit(url).hostname or ""
+        return any(host == h or host.endswith("." + h) for h in self.hosts)
+
+    def handle(self, route) -> None:
+        request = route.request
+
+        if self.should_block(request.url, request.resource_type):
+            self.blocked[request.resource_type] += 1
+            route.abort()
+        else:
+            self.continued += 1
+            route.continue_()
+
+    async def async_handle(self, route) -> None:
+        request = route.request
+
+        if self.should_block(request.url, request.resource_type):
+            self.blocked[request.resource_type] += 1
+            await route.abort()
+        else:
+            self.continued += 1
+            await route.continue_()
+
+    def log_summary(self) -> None:
+        if self.blocked or self.continued:
+            log.info(
+                "Blocked %d of %d requests %s",
+                sum(self.blocked.values()),
+                sum(self.blocked.values()) + self.continued,
+                dict(self.blocked),
+            )
+
+
+class DetailCache:
+    # SQLite store of reason/description per contract action, so re-runs skip
+    # detail pages already read. The file is only opened on first use.
+
+    def __init__(self, path: str, ttl_days: float, max_entries: int) -> None:
+        self.path = path
+        self.ttl = ttl_days * 86400
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._db = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls, settings: SearchSettings) -> "DetailCache | None":
+        if not settings.cache_path:
+            return None
+
+        return cls(settings.cache_path, settings.cache_ttl_days, settings.cache_max_entries)
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS details "
+                "(key TEXT PRIMARY KEY, reason TEXT, desc TEXT, stored REAL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS details_stored ON details (stored)")
+
+        return self._db
+
+    def get(self, key: str) -> tuple[str, str] | None:
+        with self._lock:
+            row = self._connect().execute(
+                "SELECT reason, desc FROM details WHERE key = ? AND stored >= ?",
+                (key, time.time() - self.ttl),
+            ).fetchone()
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            return row
+
+    def put(self, key: str, reason: str, desc: str) -> None:
+        with self._lock:
+            db = self._connect()
+            db.execute(
+                "INSERT OR REPLACE INTO details VALUES (?, ?, ?, ?)",
+                (key, reason, desc, time.time()),
+            )
+            db.commit()
+
+    def evict(self) -> None:
+        # Drop expired entries, then all but the newest max_entries
+        with self._lock:
+            db = self._connect()
+            db.execute("DELETE FROM details WHERE stored < ?", (time.time() - self.ttl,))
+            db.execute(
+                "DELETE FROM details WHERE key NOT IN "
+                "(SELECT key FROM details ORDER BY stored DESC LIMIT ?)",
+                (self.max_entries,),
+            )
+            db.commit()
+
+    def close(self) -> None:
+        if self._db is not None:
+            self.evict()
+            self._db.close()
+            self._db = None
+
+
+def detail_key(contract_info: dict, view_url: str | None) -> str:
+    # Cache and seen key for a contract action: its agency and award ids when
+    # the mod number is known, else its View url. Without the mod number all
+    # mods of one PIID would share a key.
+    if contract_info.get("piid") and contract_info.get("mod"):
+        query = parse_qs(urlsplit(view_url).query) if view_url else {}
+        return ":".join(
+            (
+                query.get("agencyID", [""])[0],
+                contract_info["piid"],
+                contract_info.get("idv", ""),
+                contract_info["mod"],
+            )
+        )
+
+    return view_url or ""
+
+
+def overloaded(error: Exception) -> bool:
+    # True for failures that mean the portal is struggling: timeouts,
+    # network errors and 5xx. 4xx responses and anything else, such as a
+    # KeyError in parsing, say nothing about its load.
+    import urllib3
+    from playwright.sync_api import Error as PlaywrightError
+    from playwright.sync_api import TimeoutError as PlaywrightTimeoutError
+
+    from client.rest import ApiException
+
+    if isinstance(error, ApiException):
+        return not error.status or error.status >= 500
+
+    if isinstance(error, PlaywrightTimeoutError):
+        return True
+
+    if isinstance(error, PlaywrightError):
+        # Chromium reports connection failures as net::ERR_...
+        return "net::ERR_" in error.message
+
+    return isinstance(
+        error, (urllib3.exceptions.HTTPError, ConnectionError, TimeoutError)
+    )
+
+
+def server_error(response) -> bool:
+    # Playwright and urllib3 responses both carry an int status
+    status = getattr(response, "status", None)
+    return isinstance(status, int) and status >= 500
+
+
+class RateLimiter:
+    # Token bucket pacing every fpds navigation across threads and tasks. The
+    # refill rate halves on timeouts and 5xx responses and climbs back by a
+    # tenth of the configured rate per quick response.
+
+    def __init__(
+        self, rate: float, burst: int, min_rate: float, slow_seconds: float
+    ) -> None:
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.min_rate = min(min_rate, rate)
+        self.slow_seconds = slow_seconds
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.waited = 0.0
+        self.backoffs = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls, settings: SearchSettings) -> "RateLimiter | None":
+        if settings.rate_limit <= 0:
+            return None
+
+        return cls(
+            settings.rate_limit,
+            settings.rate_burst,
+            settings.min_rate_limit,
+            settings.slow_response_seconds,
+        )
+
+    def _reserve(self) -> float:
+        # Take a token, returning how long to wait until it is due
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            delay = max(0.0, -self.tokens / self.rate)
+            self.waited += delay
+            return delay
+
+    def record(self, elapsed: float, ok: bool) -> None:
+        with self._lock:
+            if not ok:
+                self.rate = max(self.min_rate, self.rate / 2)
+                self.backoffs += 1
+                log.info("Portal struggling, pacing at %.2f navigations/s", self.rate)
+            elif elapsed < self.slow_seconds:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+    def call(self, navigate, *args, **kwargs):
+        # Run one navigation once a token is available
+        delay = self._reserve()
+
+        if delay:
+            with span("rate_limit_wait"):
+                time.sleep(delay)
+
+        start = time.monotonic()
+
+        try:
+            response = navigate(*args, **kwargs)
+        except Exception as error:
+            self.record(time.monotonic() - start, not overloaded(error))
+            raise
+
+        self.record(time.monotonic() - start, not server_error(response))
+        return response
+
+    async def async_call(self, navigate, *args, **kwargs):
+        # asyncio counterpart of call(), navigate returns an awaitable
+        delay = self._reserve()
+
+        if delay:
+            with span("rate_limit_wait"):
+                await asyncio.sleep(delay)
+
+        start = time.monotonic()
+
+        try:
+            response = await navigate(*args, **kwargs)
+        except Exception as error:
+            self.record(time.monotonic() - start, not overloaded(error))
+            raise
+
+        self.record(time.monotonic() - start, not server_error(response))
+        return response
+
+
+def paced(limiter: RateLimiter | None, navigate, *args, **kwargs):
+    # Run a navigation through the limiter, or straight away without one
+    if limiter is None:
+        return navigate(*args, **kwargs)
+
+    return limiter.call(navigate, *args, **kwargs)
+
+
+async def async_paced(limiter: RateLimiter | None, navigate, *args, **kwargs):
+    if limiter is None:
+        return await navigate(*args, **kwargs)
+
+    return await limiter.async_call(navigate, *args, **kwargs)
+
+
+class CircuitOpenError(Exception):
+    # Raised instead of navigating while the circuit breaker is open
+    pass
+
+
+class ResultsTruncated(Exception):
+    # Raised after the last result page max_pages allows when more follow
+    pass
+
+
+class CircuitBreaker:
+    # Stops every fpds navigation for `cooldown` seconds after `threshold`
+    # consecutive failures. The first call after the cooldown is a trial, one
+    # more failure trips the breaker again.
+
+    def __init__(self, threshold: int, cooldown: float) -> None:
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trips = 0
+        self._lock = threading.Lock()
+
+    def check(self) -> None:
+        with self._lock:
+            if self.opened_at is None:
+                return
+
+            remaining = self.opened_at + self.cooldown - time.monotonic()
+
+            if remaining > 0:
+                raise CircuitOpenError(f"FPDS paused for another {remaining:.0f}s")
+
+            self.opened_at = None
+            self.failures = self.threshold - 1
+
+    def success(self) -> None:
+        with self._lock:
+            self.failures = 0
+
+    def failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+
+            if self.failures >= self.threshold and self.opened_at is None:
+                self.opened_at = time.monotonic()
+                self.trips += 1
+                log.error(
+                    "%d FPDS navigations failed in a row, pausing for %.0fs",
+                    self.failures,
+                    self.cooldown,
+                )
+
+
+class Navigator:
+    # Guards every fpds navigation: paced by the rate limiter, retried with
+    # jittered exponential backoff and refused while the breaker is open
+
+    def __init__(
+        self,
+        limiter: RateLimiter | None = None,
+        breaker: CircuitBreaker | None = None,
+        retries: int = 0,
+        backoff: float = 0.0,
+    ) -> None:
+        self.limiter = limiter
+        self.breaker = breaker
+        self.retries = retries
+        self.backoff = backoff
+
+    @classmethod
+    def from_settings(cls, settings: SearchSettings) -> "Navigator":
+        breaker = None
+
+        if settings.breaker_threshold > 0:
+            breaker = CircuitBreaker(
+                settings.breaker_threshold, settings.breaker_cooldown_seconds
+            )
+
+        return cls(
+            RateLimiter.from_settings(settings),
+            breaker,
+            max(0, settings.retries),
+            settings.retry_backoff_seconds,
+        )
+
+    def _check(self) -> None:
+        if self.breaker is not None:
+            self.breaker.check()
+
+    def _succeeded(self) -> None:
+        if self.breaker is not None:
+            self.breaker.success()
+
+    def _retry_delay(self, attempt: int, reason) -> float | None:
+        # Record a failed attempt. Returns the pause before the next one, or
+        # None once the retries are used up.
+        if self.breaker is not None:
+            self.breaker.failure()
+
+        NAVIGATION_FAILURES.inc(
+            error=reason if isinstance(reason, str) else type(reason).__name__
+        )
+
+        if attempt >= self.retries:
+            return None
+
+        delay = self.backoff * 2**attempt * random.uniform(0.5, 1.0)
+        log.warning("FPDS navigation failed (%s), retrying in %.1fs", reason, delay)
+        return delay
+
+    def call(self, navigate, *args, **kwargs):
+        # Run one navigation, retrying timeouts, connection errors and 5xx.
+        # A 5xx response that outlasts the retries is returned as is; any
+        # other error is raised at once without counting as a failure.
+        attempt = 0
+
+        while True:
+            self._check()
+
+            try:
+                response = paced(self.limiter, navigate, *args, **kwargs)
+            except Exception as error:
+                if not overloaded(error):
+                    raise
+
+                delay = self._retry_delay(attempt, error)
+
+                if delay is None:
+                    raise
+            else:
+                if not server_error(response):
+                    self._succeeded()
+                    return response
+
+                delay = self._retry_delay(attempt, f"HTTP {response.status}")
+
+                if delay is None:
+                    return response
+
+            with span("retry_backoff"):
+                time.sleep(delay)
+
+            attempt += 1
+
+    async def async_call(self, navigate, *args, **kwargs):
+        # asyncio counterpart of call(), navigate returns an awaitable
+        attempt = 0
+
+        while True:
+            self._check()
+
+            try:
+                response = await async_paced(self.limiter, navigate, *args, **kwargs)
+            except Exception as error:
+                if not overloaded(error):
+                    raise
+
+                delay = self._retry_delay(attempt, error)
+
+                if delay is None:
+                    raise
+            else:
+                if not server_error(response):
+                    self._succeeded()
+                    return response
+
+                delay = self._retry_delay(attempt, f"HTTP {response.status}")
+
+                if delay is None:
+                    return response
+
+            with span("retry_backoff"):
+                await asyncio.sleep(delay)
+
+            attempt += 1
+
+
+def guarded(navigator: Navigator | None, navigate, *args, **kwargs):
+    # Run a navigation through the navigator, or straight away without one
+    NAVIGATIONS.inc()
+
+    if navigator is None:
+        return navigate(*args, **kwargs)
+
+    return navigator.call(navigate, *args, **kwargs)
+
+
+async def async_guarded(navigator: Navigator | None, navigate, *args, **kwargs):
+    NAVIGATIONS.inc()
+
+    if navigator is None:
+        return await navigate(*args, **kwargs)
+
+    return await navigator.async_call(navigate, *args, **kwargs)
+
+
+@functools.cache
+def navigation_errors() -> tuple[type[Exception], ...]:
+    # Failures a search survives by keeping the actions collected so far.
+    # Only evaluated once a search fails, so the imports cost nothing before.
+    import urllib3
+    from playwright.sync_api import Error as PlaywrightError
+
+    from client.rest import ApiException
+
+    return (
+        PlaywrightError,
+        ApiException,
+        urllib3.exceptions.HTTPError,
+        CircuitOpenError,
+        ResultsTruncated,
+    )
+
+
+def criteria_key(criteria: dict) -> str:
+    # Stable name of a watchlist entry
+    if "contract_no" in criteria:
+        return f'contract_no:{criteria["contract_no"]}'
+
+    return f'naics:{criteria["naics"]}:{criteria["agency"]}'
+
+
+def criteria_keys(criteria: dict) -> list[str]:
+    # Names of the watchlist entries a possibly batched query covers
+    if "contract_nos" in criteria:
+        return [criteria_key({"contract_no": c}) for c in criteria["contract_nos"]]
+
+    if "naics_codes" in criteria:
+        return [
+            criteria_key({"naics": code, "agency": criteria["agency"]})
+            for code in criteria["naics_codes"]
+        ]
+
+    return [criteria_key(criteria)]
+
+
+class Watermarks:
+    # Per-criterion search start dates and the contract actions already
+    # posted, persisted in SQLite. Watermarks are only written by commit(),
+    # which main() calls once a run has finished successfully; store() records
+    # actions as soon as the card carrying them is posted.
+
+    def __init__(self, path: str, max_lookback_days: int) -> None:
+        self.path = path
+        self.max_lookback_days = max_lookback_days
+        self.pending_marks = {}
+        self.pending_seen = set()
+        self._seen = None
+        self._db = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls, settings: SearchSettings) -> "Watermarks | None":
+        if not settings.state_path:
+            return None
+
+        return cls(settings.state_path, settings.max_lookback_days)
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS watermarks (criteria TEXT PRIMARY KEY, since TEXT)"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS seen (key TEXT PRIMARY KEY, stored REAL)"
+            )
+
+        return self._db
+
+    def since(self, criteria: dict, yday: str) -> str:
+        # Search start date: the previous successful run's window start,
+        # bounded by max_lookback_days, else yday
+        key = criteria_key(criteria)
+
+        with self._lock:
+            self.pending_marks[key] = yday
+            row = self._connect().execute(
+                "SELECT since FROM watermarks WHERE criteria = ?", (key,)
+            ).fetchone()
+
+        if row is None:
+            return yday
+
+        earliest = (datetime.now() - timedelta(days=self.max_lookback_days)).strftime(
+            "%Y/%m/%d"
+        )
+        return min(max(row[0], earliest), yday)
+
+    def is_seen(self, key: str) -> bool:
+        with self._lock:
+            if self._seen is None:
+                rows = self._connect().execute("SELECT key FROM seen").fetchall()
+                self._seen = {row[0] for row in rows}
+
+        return key in self._seen
+
+    def add(self, key: str) -> None:
+        with self._lock:
+            self.pending_seen.add(key)
+
+    def store(self, keys: list[str]) -> None:
+        # Record posted actions right away, whatever happens to the rest of
+        # the run
+        now = time.time()
+
+        with self._lock:
+            db = self._connect()
+            db.executemany(
+                "INSERT OR REPLACE INTO seen VALUES (?, ?)",
+                ((key, now) for key in keys),
+            )
+            db.commit()
+            self.pending_seen.difference_update(keys)
+
+    def hold(self, criteria: dict) -> None:
+        # Leave the watermarks of a failed query where they were
+        with self._lock:
+            for key in criteria_keys(criteria):
+                self.pending_marks.pop(key, None)
+
+    def commit(self) -> None:
+        # Advance watermarks and record posted actions; old seen keys that no
+        # search window can reach any more are pruned
+        now = time.time()
+
+        with self._lock:
+            db = self._connect()
+            db.executemany(
+                "INSERT OR REPLACE INTO watermarks VALUES (?, ?)",
+                self.pending_marks.items(),
+            )
+            db.executemany(
+                "INSERT OR REPLACE INTO seen VALUES (?, ?)",
+                ((key, now) for key in self.pending_seen),
+            )
+            db.execute(
+                "DELETE FROM seen WHERE stored < ?",
+                (now - (self.max_lookback_days + 1) * 86400,),
+            )
+            db.commit()
+            self.pending_marks.clear()
+            self.pending_seen.clear()
+
+    def close(self) -> None:
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+class RunState:
+    # Resources shared by every search in one run. Without settings, as for a
+    # standalone search() call, nothing is cached or tracked.
+
+    def __init__(self, settings: SearchSettings | None = None) -> None:
+        self.cache = DetailCache.from_settings(settings) if settings else None
+        self.watermarks = Watermarks.from_settings(settings) if settings else None
+        self.navigator = Navigator.from_settings(settings) if settings else None
+        self.loop = None
+        # Whether result rows carry the NAICS codes agency OR queries are
+        # routed by, None until one such query has returned actions
+        self.naics_routable = None
+        # Action line -> seen keys of the actions it reports, until posted
+        self.unposted = {}
+
+    def event_loop(self) -> asyncio.AbstractEventLoop:
+        # Event loop shared by the async engine and asyncio Teams posts,
+        # created on first use
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+
+        return self.loop
+
+    def since(self, criteria: dict, yday: str) -> str:
+        # Start date of the search window for a watchlist entry
+        if self.watermarks is None:
+            return yday
+
+        return self.watermarks.since(criteria, yday)
+
+    def is_new(self, contract_info: dict, view_url: str | None) -> bool:
+        # False for actions already posted by an earlier run
+        key = detail_key(contract_info, view_url)
+
+        if self.watermarks is None or not key:
+            return True
+
+        return not self.watermarks.is_seen(key)
+
+    def mark_seen(
+        self, contract_details: list[dict], view_urls: list[str | None]
+    ) -> None:
+        # Record fully resolved actions so commit() stores them as posted
+        if self.watermarks is None:
+            return
+
+        for contract_info, view_url in zip(contract_details, view_urls):
+            key = detail_key(contract_info, view_url)
+
+            if key:
+                self.watermarks.add(key)
+
+    def track(self, results: Iterable[dict]) -> Iterator[dict]:
+        # Pass results on, noting the seen key behind each action line so
+        # card_posted() can store it once a card carrying the line is posted
+        for result in results:
+            if self.watermarks is not None:
+                for detail in result["contract_details"]:
+                    if key := detail_key(detail, detail.get("view_url")):
+                        self.unposted.setdefault(
+                            format_detail(detail), collections.deque()
+                        ).append(key)
+
+            yield result
+
+    def card_posted(self, card: list[dict], accepted: bool) -> None:
+        # Store the actions of a card Teams accepted as posted, so a run that
+        # fails on a later card does not post them again. Cards come in
+        # posting order, failed ones included, which keeps identical lines of
+        # different actions matched to the right keys. Actions left unmatched
+        # wait for commit().
+        if self.watermarks is None:
+            return
+
+        keys = []
+
+        for block in card:
+            for line in block["text"].split("\n\n"):
+                if pending := self.unposted.get(line):
+                    keys.append(pending.popleft())
+
+        if accepted and keys:
+            self.watermarks.store(keys)
+
+    def fail(self, criteria: dict, error: Exception) -> None:
+        # A query broke off; its entries are searched from the same date
+        # next run and the rest of this run carries on
+        log.error("Search for %s failed, keeping partial results: %s", criteria, error)
+        FAILED_SEARCHES.inc(error=type(error).__name__)
+
+        if self.watermarks is not None:
+            self.watermarks.hold(criteria)
+
+    def commit(self) -> None:
+        if self.watermarks is not None:
+            self.watermarks.commit()
+
+    def lookup(
+        self, contract_details: list[dict], view_urls: list[str | None]
+    ) -> list[tuple[str, str] | None]:
+        # Cached (reason, desc) per action, None where it must be fetched
+        if self.cache is None:
+            return [None] * len(contract_details)
+
+        return [
+            self.cache.get(key) if (key := detail_key(info, url)) else None
+            for info, url in zip(contract_details, view_urls)
+        ]
+
+    def remember(self, contract_info: dict, view_url: str | None) -> None:
+        key = detail_key(contract_info, view_url)
+
+        if self.cache is not None and key:
+            self.cache.put(key, contract_info["reason"], contract_info["desc"])
+
+    def log_summary(self) -> None:
+        if self.cache is not None:
+            log.info(
+                "Detail cache: %d hits, %d misses", self.cache.hits, self.cache.misses
+            )
+
+        limiter = self.navigator.limiter if self.navigator else None
+        breaker = self.navigator.breaker if self.navigator else None
+
+        if limiter is not None:
+            log.info(
+                "Rate limiter: %.1fs waited, %d backoffs, ended at %.2f navigations/s",
+                limiter.waited,
+                limiter.backoffs,
+                limiter.rate,
+            )
+
+        if breaker is not None and breaker.trips:
+            log.info("Circuit breaker tripped %d times", breaker.trips)
+
+    def close(self) -> None:
+        if self.cache is not None:
+            self.cache.close()
+
+        if self.watermarks is not None:
+            self.watermarks.close()
+
+        if self.loop is not None:
+            self.loop.run_until_complete(self.loop.shutdown_asyncgens())
+            self.loop.close()
+            self.loop = None
+
+
+def get_value(item: Locator) -> str:
+    # Extract value
+    return item.nth(0).locator("xpath=following-sibling::td[1]").inner_text().strip()
+
+
+def build_search_url(criteria: dict, yday: str, base_url: str = BASE_URL) -> str:
+    # Build ezsearch url for a contract number or NAICS/agency search, single or batched
+    if "contract_no" in criteria:
+        contract_no = criteria["contract_no"]
+        return f"{base_url}{contract_no}%20%20SIGNED_DATE%3A%5B{yday}%2C%29{QUERY_SUFFIX}"
+
+    if "contract_nos" in criteria:
+        contract_nos = "+OR+".join(criteria["contract_nos"])
+        return f"{base_url}%28{contract_nos}%29%20%20SIGNED_DATE%3A%5B{yday}%2C%29{QUERY_SUFFIX}"
+
+    agency = criteria["agency"]
+
+    if "naics_codes" in criteria:
+        naics = "+OR+".join(
+            f"PRINCIPAL_NAICS_CODE%3A%22{code}%22" for code in criteria["naics_codes"]
+        )
+        return f"{base_url}CONTRACTING_AGENCY_NAME%3A%22{agency}%22+%28{naics}%29++SIGNED_DATE%3A%5B{yday}%2C%29{QUERY_SUFFIX}"
+
+    naics = criteria["naics"]
+    return f"{base_url}CONTRACTING_AGENCY_NAME%3A%22{agency}%22+PRINCIPAL_NAICS_CODE%3A%22{naics}%22++SIGNED_DATE%3A%5B{yday}%2C%29{QUERY_SUFFIX}"
+
+
+def build_company_url(company: str) -> str:
+    # Build ezsearch url listing all awards for a company
+    company_url_encoded = company.replace(" ", "%20")
+    return f"{BASE_URL}UEI_NAME%3A%22{company_url_encoded}%22{QUERY_SUFFIX}"
+
+
+class BrowserSession:
+    # Single Chromium instance shared by every search in a run. Each search
+    # gets a fresh context so cookies and popups don't leak between criteria.
+
+    def __init__(
+        self, headless: bool = True, policy: ResourcePolicy | None = None
+    ) -> None:
+        self.headless = headless
+        self.policy = policy
+        self._playwright = None
+        self._browser = None
+
+    def __enter__(self) -> "BrowserSession":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def new_page(self) -> Page:
+        # Launch browser on first use so runs with nothing to search stay cheap
+        if self._browser is None:
+            from playwright.sync_api import sync_playwright
+
+            with span("browser_launch"):
+                self._playwright = sync_playwright().start()
+                self._browser = self._playwright.chromium.launch(
+                    headless=self.headless
+                )
+
+        context = self._browser.new_context()
+        context.set_default_timeout(60000)
+
+        if self.policy is not None:
+            context.route("**/*", self.policy.handle)
+
+        return context.new_page()
+
+    def close(self) -> None:
+        if self._browser is not None:
+            self._browser.close()
+            self._browser = None
+
+        if self._playwright is not None:
+            self._playwright.stop()
+            self._playwright = None
+
+
+RESULT_TABLES = 'table[class^="resultbox"]'
+VIEW_LINK = 'a:has-text("(View)")'
+REASON_FIELD = 'input[name="reasonForModification"]'
+DESC_FIELD = "textarea#descriptionOfContractRequirement"
+
+
+def resolve_view_url(page_url: str, href: str | None, onclick: str | None) -> str | None:
+    # Absolute detail url behind a View link, or None if it only works by click
+    if href and not href.lower().startswith("javascript:"):
+        return urljoin(page_url, href)
+
+    for script in (href, onclick):
+        match = re.search(r"""['"]([^'"]+\.jsp[^'"]*)['"]""", script or "")
+
+        if match:
+            return urljoin(page_url, match.group(1))
+
+    return None
+
+
+ROW_LABELS = {
+    "date": "Date Signed:",
+    "company": "Legal Business Name:",
+    "obligation": "Action Obligation:",
+    "piid": "Award ID:",
+    "idv": "Referenced IDV ID:",
+    "mod": "Modification Number:",
+    "naics": "NAICS Code:",
+}
+
+# Same lookup as get_value() for every resultbox table in one browser call
+EXTRACT_ROWS_JS = """
+(labels) => Array.from(document.querySelectorAll('table[class^="resultbox"]'), (table) => {
+    const spans = Array.from(table.querySelectorAll("td span"));
+    const row = {};
+
+    for (const [key, label] of Object.entries(labels)) {
+        const span = spans.find((s) => s.textContent.toLowerCase().includes(label.toLowerCase()));
+        let cell = span ? span.closest("td").nextElementSibling : null;
+
+        while (cell && cell.tagName !== "TD") {
+            cell = cell.nextElementSibling;
+        }
+
+        row[key] = cell ? cell.innerText.trim() : "";
+    }
+
+    const link = Array.from(table.querySelectorAll("a")).find((a) => a.textContent.includes("(View)"));
+    row.href = link ? link.getAttribute("href") : null;
+    row.onclick = link ? link.getAttribute("onclick") : null;
+    return row;
+})
+"""
+
+
+# Absolute url of the results pager's "Next" link, if any
+NEXT_PAGE_JS = r"""
+() => {
+    const link = Array.from(document.querySelectorAll("a")).find(
+        (a) => /^next\b/i.test(a.textContent.trim()) || /^next\b/i.test(a.title || "")
+    );
+    return link && !link.href.toLowerCase().startsWith("javascript:") ? link.href : null;
+}
+"""
+
+
+def extract_rows(page: Page) -> list[dict]:
+    # Read every result table's fields and View link in a single round-trip
+    with span("extract_rows"):
+        return page.evaluate(EXTRACT_ROWS_JS, ROW_LABELS)
+
+
+async def async_extract_rows(page: AsyncPage) -> list[dict]:
+    with span("extract_rows"):
+        return await page.evaluate(EXTRACT_ROWS_JS, ROW_LABELS)
+
+
+def contract_info_from_row(row: dict, view_url: str | None = None) -> dict:
+    # Contract detail fields known before visiting the View page. Award ids
+    # missing from the table are taken from the View link's query string.
+    query = parse_qs(urlsplit(view_url).query) if view_url else {}
+    contract_info = {
+        "date": row["date"],
+        "company": row["company"],
+        "company_url": build_company_url(row["company"]),
+        "obligation": row["obligation"],
+        "view_url": view_url,
+    }
+
+    for key, param in (("piid", "PIID"), ("idv", "idvPIID"), ("mod", "modNumber")):
+        # Id cells may also hold the "(View)" link text
+        value = (row.get(key) or "").split()
+        contract_info[key] = value[0] if value else query.get(param, [""])[0]
+
+    # NAICS cells read "541512 COMPUTER SYSTEMS DESIGN SERVICES"
+    naics = (row.get("naics") or "").split()
+    contract_info["naics"] = naics[0] if naics else ""
+
+    return contract_info
+
+
+def read_detail(page: Page) -> tuple[str, str]:
+    # Extract reason and description from a loaded detail page
+    reason = page.locator(REASON_FIELD).input_value()
+    desc = page.locator(DESC_FIELD).input_value()
+    return reason, desc
+
+
+def open_detail(page: Page, table: Locator) -> tuple[str, str]:
+    # Click through the View link popup, for links without a plain url
+    with page.context.expect_page(timeout=60000) as new_page_info:
+        table.locator(VIEW_LINK).nth(0).click()
+
+    new_page = new_page_info.value
+    new_page.wait_for_load_state("load", timeout=60000)
+    detail = read_detail(new_page)
+    new_page.close()
+    return detail
+
+
+def load_detail(page: Page, url: str) -> tuple[str, str]:
+    # Navigate to one detail page and read it, the unit a retry repeats
+    page.goto(url)
+    return read_detail(page)
+
+
+def fetch_details(
+    context, urls: list[str], width: int, navigator: Navigator | None = None
+) -> list[tuple[str, str]]:
+    # Load detail pages on up to `width` worker pages. Each batch of
+    # navigations is started before any is awaited so pages load side by side.
+    from playwright.sync_api import Error as PlaywrightError
+
+    if not urls:
+        return []
+
+    workers = [context.new_page() for _ in range(max(1, min(width, len(urls))))]
+    details = []
+
+    try:
+        for start in range(0, len(urls), len(workers)):
+            batch = list(zip(workers, urls[start : start + len(workers)]))
+
+            for worker, url in batch:
+                guarded(navigator, worker.goto, url, wait_until="commit")
+
+            for worker, url in batch:
+                try:
+                    worker.wait_for_load_state("load", timeout=60000)
+                    details.append(read_detail(worker))
+                except PlaywrightError as error:
+                    log.warning("Detail page %s failed (%s), reloading", url, error)
+                    details.append(guarded(navigator, load_detail, worker, url))
+
+    finally:
+        for worker in workers:
+            worker.close()
+
+    return details
+
+
+class DetailPageParser(HTMLParser):
+    # Pull the reason and description form values out of detail page html
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.reason = ""
+        self.desc_parts = []
+        self._in_desc = False
+
+    def handle_starttag(self, tag: str, attrs: list) -> None:
+        attrs = dict(attrs)
+
+        if tag == "input" and attrs.get("name") == "reasonForModification":
+            self.reason = attrs.get("value") or ""
+        elif tag == "textarea" and attrs.get("id") == "descriptionOfContractRequirement":
+            self._in_desc = True
+
+    def handle_endtag(self, tag: str) -> None:
+        if tag == "textarea":
+            self._in_desc = False
+
+    def handle_data(self, data: str) -> None:
+        if self._in_desc:
+            self.desc_parts.append(data)
+
+
+def parse_detail_html(html: str) -> tuple[str, str]:
+    # Extract reason and description the way input_value() reports them
+    parser = DetailPageParser()
+    parser.feed(html)
+    parser.close()
+    desc = "".join(parser.desc_parts)
+
+    # Browsers drop the newline directly after <textarea>
+    if desc.startswith("\r\n"):
+        desc = desc[2:]
+    elif desc.startswith("\n"):
+        desc = desc[1:]
+
+    return parser.reason, desc
+
+
+def decode_body(response) -> str:
+    # Decode a response body using its declared charset
+    content_type = response.getheader("Content-Type") or ""
+    match = re.search(r"charset=([\w-]+)", content_type)
+    return response.data.decode(match.group(1) if match else "utf-8", errors="replace")
+
+
+@functools.cache
+def fpds_http() -> RESTClientObject:
+    # Pooled urllib3 client shared by every browserless fpds request
+    from client.rest import RESTClientObject
+
+    return RESTClientObject(client.Configuration())
+
+
+def http_get_html(url: str) -> str:
+    # GET an fpds page over the shared connection pool
+    response = fpds_http().GET(url, headers={"Accept": "text/html"}, _request_timeout=60)
+    return decode_body(response)
+
+
+def http_read_detail(url: str, navigator: Navigator | None = None) -> tuple[str, str]:
+    # Fetch one detail page in a single round-trip, no browser involved
+    return parse_detail_html(guarded(navigator, http_get_html, url))
+
+
+def http_fetch_details(
+    urls: list[str], width: int, navigator: Navigator | None = None
+) -> list[tuple[str, str]]:
+    # Fetch detail pages over up to `width` pooled connections, in url order
+    if not urls:
+        return []
+
+    with ThreadPoolExecutor(max_workers=max(1, min(width, len(urls)))) as executor:
+        return list(
+            executor.map(functools.partial(http_read_detail, navigator=navigator), urls)
+        )
+
+
+class ResultPageParser(HTMLParser):
+    # Collect the cells and links of every resultbox table on a results page
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.tables = []
+        self._depth = 0
+        self._rows = []
+        self._row_count = 0
+        self._cells = []
+        self._spans = 0
+        self._link = None
+        self.next_href = None
+        self._page_link = None
+
+    def handle_starttag(self, tag: str, attrs: list) -> None:
+        attrs = dict(attrs)
+
+        if tag == "a" and not self._depth:
+            # Pager links sit outside the result tables
+            self._page_link = {"href": attrs.get("href"), "text": [attrs.get("title") or ""]}
+            return
+
+        if tag == "table":
+            if self._depth:
+                self._depth += 1
+            elif (attrs.get("class") or "").startswith("resultbox"):
+                self._depth = 1
+                self.tables.append({"cells": [], "links": []})
+
+            return
+
+        if not self._depth:
+            return
+
+        table = self.tables[-1]
+
+        if tag == "tr":
+            self._row_count += 1
+            self._rows.append(self._row_count)
+        elif tag == "td":
+            row = self._rows[-1] if self._rows else 0
+
+            # Tolerate an unclosed sibling td
+            while self._cells and self._cells[-1]["row"] == row:
+                self._cells.pop()
+
+            cell = {"row": row, "text": [], "label": []}
+            table["cells"].append(cell)
+            self._cells.append(cell)
+        elif tag == "span":
+            self._spans += 1
+        elif tag == "a":
+            self._link = {
+                "href": attrs.get("href"),
+                "onclick": attrs.get("onclick"),
+                "text": [],
+            }
+            table["links"].append(self._link)
+        elif tag == "br":
+            self.handle_data("\n")
+
+    def handle_endtag(self, tag: str) -> None:
+        if tag == "a" and self._page_link is not None:
+            href = self._page_link["href"] or ""
+            text = " ".join(self._page_link["text"]).strip()
+
+            if (
+                self.next_href is None
+                and re.match(r"next\b", text, re.IGNORECASE)
+                and not href.lower().startswith("javascript:")
+            ):
+                self.next_href = href
+
+            self._page_link = None
+
+        if not self._depth:
+            return
+
+        if tag == "table":
+            self._depth -= 1
+
+            if not self._depth:
+                self._rows = []
+                self._cells = []
+        elif tag == "tr" and self._rows:
+            row = self._rows.pop()
+
+            while self._cells and self._cells[-1]["row"] == row:
+                self._cells.pop()
+        elif tag == "td" and self._cells:
+            self._cells.pop()
+        elif tag == "span" and self._spans:
+            self._spans -= 1
+        elif tag == "a":
+            self._link = None
+
+    def handle_data(self, data: str) -> None:
+        if self._page_link is not None:
+            self._page_link["text"].append(data)
+
+        if not self._depth:
+            return
+
+        for cell in self._cells:
+            cell["text"].append(data)
+
+        if self._spans and self._cells:
+            self._cells[-1]["label"].append(data)
+
+        if self._link is not None:
+            self._link["text"].append(data)
+
+
+def parse_result_html(html: str) -> list[dict]:
+    # Parse resultbox tables from an ezsearch results page
+    parser = ResultPageParser()
+    parser.feed(html)
+    parser.close()
+    return parser.tables
+
+
+def table_value(table: dict, label: str) -> str:
+    # Text of the cell following the labelled cell, like get_value()
+    cells = table["cells"]
+
+    for i, cell in enumerate(cells):
+        if label.lower() in "".join(cell["label"]).lower():
+            for sibling in cells[i + 1 :]:
+                if sibling["row"] == cell["row"]:
+                    return " ".join("".join(sibling["text"]).split())
+
+            break
+
+    return ""
+
+
+def table_view_url(table: dict, page_url: str) -> str | None:
+    # Detail url behind the table's View link
+    for link in table["links"]:
+        if "(View)" in "".join(link["text"]):
+            return resolve_view_url(page_url, link["href"], link["onclick"])
+
+    return None
+
+
+def http_result_pages(
+    url: str, max_pages: int, navigator: Navigator | None = None
+) -> Iterator[tuple[str, list[dict]]]:
+    # Yield (page url, resultbox tables) per result page. Page N+1 downloads
+    # in the background while the caller handles page N.
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        pending = executor.submit(guarded, navigator, http_get_html, url)
+
+        for number in range(1, max_pages + 1):
+            with span("result_page"):
+                html = pending.result()
+
+            with span("extract_rows"):
+                parser = ResultPageParser()
+                parser.feed(html)
+                parser.close()
+
+            next_url = urljoin(url, parser.next_href) if parser.next_href else None
+            truncated = next_url and number == max_pages
+
+            if truncated:
+                next_url = None
+
+            if next_url:
+                pending = executor.submit(guarded, navigator, http_get_html, next_url)
+
+            RESULT_PAGES.inc(engine="http")
+            yield url, parser.tables
+
+            if truncated:
+                raise ResultsTruncated(f"stopped after {max_pages} result pages")
+
+            if not next_url:
+                return
+
+            url = next_url
+
+
+@dataclass
+class DetailPlan:
+    # New contract actions of one result page, with the table index, View
+    # url and cached (reason, desc) of each, and the View pages to fetch
+    contract_details: list[dict]
+    view_urls: list[str | None]
+    indexes: list[int]
+    known: list[tuple[str, str] | None]
+    urls: list[str]
+
+    @property
+    def popups(self) -> list[int]:
+        # Table indexes of uncached actions whose View link only works by click
+        return [
+            i
+            for i, view_url, hit in zip(self.indexes, self.view_urls, self.known)
+            if hit is None and not view_url
+        ]
+
+
+def plan_details(
+    rows: list[dict], view_urls: list[str | None], state: RunState
+) -> DetailPlan:
+    # Skip actions posted by an earlier run and look the rest up in the cache
+    plan = DetailPlan([], [], [], [], [])
+
+    for i, (row, view_url) in enumerate(zip(rows, view_urls)):
+        contract_info = contract_info_from_row(row, view_url)
+
+        if state.is_new(contract_info, view_url):
+            plan.contract_details.append(contract_info)
+            plan.view_urls.append(view_url)
+            plan.indexes.append(i)
+
+    plan.known = state.lookup(plan.contract_details, plan.view_urls)
+    plan.urls = [u for u, hit in zip(plan.view_urls, plan.known) if u and hit is None]
+    ROWS.inc(len(rows))
+    DETAILS.inc(len(plan.known) - plan.known.count(None), source="cache")
+    DETAILS.inc(len(plan.urls), source="page")
+    return plan
+
+
+def fill_details(
+    plan: DetailPlan,
+    fetched: list[tuple[str, str]],
+    popups: dict[int, tuple[str, str]],
+    state: RunState,
+) -> list[dict]:
+    # Complete the planned actions from the cache, the fetched View pages in
+    # url order and the popups by table index, then record them
+    details = iter(fetched)
+
+    for i, contract_info, view_url, hit in zip(
+        plan.indexes, plan.contract_details, plan.view_urls, plan.known
+    ):
+        if hit:
+            contract_info["reason"], contract_info["desc"] = hit
+            continue
+
+        if view_url:
+            contract_info["reason"], contract_info["desc"] = next(details)
+        elif i in popups:
+            contract_info["reason"], contract_info["desc"] = popups[i]
+        else:
+            log.warning("No detail link for %s", contract_info["company"])
+            DETAILS.inc(source="missing")
+            contract_info["reason"], contract_info["desc"] = "", ""
+            continue
+
+        state.remember(contract_info, view_url)
+
+    state.mark_seen(plan.contract_details, plan.view_urls)
+    return plan.contract_details
+
+
+def http_search(
+    criteria: dict,
+    yday: str,
+    settings: SearchSettings | None = None,
+    state: RunState | None = None,
+) -> tuple[list[dict], str]:
+    # Execute fpds search without a browser, from the server-rendered results
+    settings = settings or SearchSettings()
+    state = state or RunState()
+    url = build_search_url(criteria, yday, settings.base_url)
+    contract_details = []
+
+    with criteria_span(criteria):
+        try:
+            for page_url, tables in http_result_pages(
+                url, settings.max_pages, state.navigator
+            ):
+                rows = [
+                    {
+                        key: table_value(table, label)
+                        for key, label in ROW_LABELS.items()
+                    }
+                    for table in tables
+                ]
+                view_urls = [table_view_url(table, page_url) for table in tables]
+                plan = plan_details(rows, view_urls, state)
+
+                with span("detail_pages"):
+                    fetched = http_fetch_details(
+                        plan.urls, settings.detail_workers, state.navigator
+                    )
 
-from playwright.sync_api import Locator, sync_playwright
-import client
-from client.rest import ApiException
-import time
+                # No browser to click View links that only open a popup
+                contract_details += fill_details(plan, fetched, {}, state)
 
+        except navigation_errors() as error:
+            state.fail(criteria, error)
 
-log = logging.getLogger("search")
-logging.basicConfig(level=logging.INFO)
+    return contract_details, url
 
 
-def get_value(item: Locator) -> str:
-    # Extract value
-    return item.nth(0).locator("xpath=following-sibling::td[1]").inner_text().strip()
+def result_pages(
+    page: Page, url: str, max_pages: int, navigator: Navigator | None = None
+) -> Iterator[tuple[Page, list[dict]]]:
+    # Yield (page, rows) per result page. Page N+1 loads in a second tab
+    # while the caller extracts page N and its details.
+    from playwright.sync_api import Error as PlaywrightError
+
+    with span("result_page"):
+        guarded(navigator, page.goto, url)
+
+    spare = None
+
+    for number in range(1, max_pages + 1):
+        next_url = page.evaluate(NEXT_PAGE_JS)
+        truncated = next_url and number == max_pages
+
+        if truncated:
+            next_url = None
+
+        if next_url:
+            spare = spare or page.context.new_page()
+            guarded(navigator, spare.goto, next_url, wait_until="commit")
+
+        RESULT_PAGES.inc(engine="browser")
+        yield page, extract_rows(page)
+
+        if truncated:
+            raise ResultsTruncated(f"stopped after {max_pages} result pages")
+
+        if not next_url:
+            return
+
+        with span("result_page"):
+            try:
+                spare.wait_for_load_state("load")
+            except PlaywrightError as error:
+                log.warning("Result page %s failed (%s), reloading", next_url, error)
+                guarded(navigator, spare.goto, next_url)
 
+        page, spare = spare, page
 
-def search(criteria: dict, yday: str) -> tuple[list[dict], str]:
+
+def page_details(
+    page: Page, rows: list[dict], settings: SearchSettings, state: RunState
+) -> list[dict]:
+    # Build contract actions for one result page. Cached details are reused,
+    # the rest of the View pages are resolved in parallel.
+    view_urls = [
+        resolve_view_url(page.url, row["href"], row["onclick"]) for row in rows
+    ]
+    plan = plan_details(rows, view_urls, state)
+
+    with span("detail_pages"):
+        if settings.detail_mode == "http":
+            fetched = http_fetch_details(
+                plan.urls, settings.detail_workers, state.navigator
+            )
+        else:
+            fetched = fetch_details(
+                page.context, plan.urls, settings.detail_workers, state.navigator
+            )
+
+    tables = page.locator(RESULT_TABLES)
+    popups = {}
+
+    for i in plan.popups:
+        DETAILS.inc(source="popup")
+
+        with span("detail_popup"):
+            popups[i] = guarded(state.navigator, open_detail, page, tables.nth(i))
+
+    return fill_details(plan, fetched, popups, state)
+
+
+def search(
+    criteria: dict,
+    yday: str,
+    session: BrowserSession | None = None,
+    settings: SearchSettings | None = None,
+    state: RunState | None = None,
+) -> tuple[list[dict], str]:
     # Execute fpds search
 
-    base_url = "https://www.fpds.gov/ezsearch/fpdsportal?q="
+    settings = settings or SearchSettings()
+    state = state or RunState()
 
-    if "contract_no" in criteria:
-        contract_no = criteria["contract_no"]
-        url = f"{base_url}{contract_no}%20%20SIGNED_DATE%3A%5B{yday}%2C%29&templateName=1.5.3&indexName=awardfull&sortBy=SIGNED_DATE&desc=Y"
-    elif "naics" in criteria:
-        naics = criteria["naics"]
-        agency = criteria["agency"]
-        url = f"{base_url}CONTRACTING_AGENCY_NAME%3A%22{agency}%22+PRINCIPAL_NAICS_CODE%3A%22{naics}%22++SIGNED_DATE%3A%5B{yday}%2C%29&templateName=1.5.3&indexName=awardfull&sortBy=SIGNED_DATE&desc=Y"
+    if session is None:
+        policy = ResourcePolicy.from_settings(settings)
 
+        with BrowserSession(policy=policy) as own_session:
+            return search(criteria, yday, own_session, settings, state)
+
+    url = build_search_url(criteria, yday, settings.base_url)
     contract_details = []
 
-    with sync_playwright() as p:
-        browser = p.chromium.launch(headless=True)
-        page = browser.new_page()
-        page.set_default_timeout(60000)
-        page.goto(url)
-        tables = page.locator('table[class^="resultbox"]')
-        count = tables.count()
+    with criteria_span(criteria):
+        page = session.new_page()
 
-        if count > 0:
-            # Updates found
+        try:
+            for result_page, rows in result_pages(
+                page, url, settings.max_pages, state.navigator
+            ):
+                contract_details += page_details(result_page, rows, settings, state)
 
-            for i in range(count):
-                contract_info = {}
-                table = tables.nth(i)
+        except navigation_errors() as error:
+            state.fail(criteria, error)
 
-                # Extract data from table
-                contract_info["date"] = get_value(
-                    table.locator('td:has(span:has-text("Date Signed:"))')
-                )
-                company = get_value(
-                    table.locator('td:has(span:has-text("Legal Business Name:"))')
-                )
-                contract_info["company"] = company
-                company_url_encoded = company.replace(" ", "%20")
-                contract_info["company_url"] = (
-                    f"{base_url}UEI_NAME%3A%22{company_url_encoded}%22&templateName=1.5.3&indexName=awardfull&sortBy=SIGNED_DATE&desc=Y"
-                )
-                contract_info["obligation"] = get_value(
-                    table.locator('td:has(span:has-text("Action Obligation:"))')
+        finally:
+            page.context.close()
+
+    return contract_details, url
+
+
+class AsyncBrowserSession:
+    # asyncio counterpart of BrowserSession used by the concurrent engine
+
+    def __init__(
+        self, headless: bool = True, policy: ResourcePolicy | None = None
+    ) -> None:
+        self.headless = headless
+        self.policy = policy
+        self._playwright = None
+        self._browser = None
+        self._launch_lock = asyncio.Lock()
+
+    async def __aenter__(self) -> "AsyncBrowserSession":
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.close()
+
+    async def new_page(self) -> AsyncPage:
+        # Concurrent first searches must not launch two browsers
+        async with self._launch_lock:
+            if self._browser is None:
+                from playwright.async_api import async_playwright
+
+                with span("browser_launch"):
+                    self._playwright = await async_playwright().start()
+                    self._browser = await self._playwright.chromium.launch(
+                        headless=self.headless
+                    )
+
+        context = await self._browser.new_context()
+        context.set_default_timeout(60000)
+
+        if self.policy is not None:
+            await context.route("**/*", self.policy.async_handle)
+
+        return await context.new_page()
+
+    async def close(self) -> None:
+        if self._browser is not None:
+            await self._browser.close()
+            self._browser = None
+
+        if self._playwright is not None:
+            await self._playwright.stop()
+            self._playwright = None
+
+
+async def async_read_detail(page: AsyncPage) -> tuple[str, str]:
+    # Extract reason and description from a loaded detail page
+    reason = await page.locator(REASON_FIELD).input_value()
+    desc = await page.locator(DESC_FIELD).input_value()
+    return reason, desc
+
+
+async def async_open_detail(page: AsyncPage, table: AsyncLocator) -> tuple[str, str]:
+    # Click through the View link popup, for links without a plain url
+    async with page.context.expect_page(timeout=60000) as new_page_info:
+        await table.locator(VIEW_LINK).nth(0).click()
+
+    new_page = await new_page_info.value
+    await new_page.wait_for_load_state("load", timeout=60000)
+    detail = await async_read_detail(new_page)
+    await new_page.close()
+    return detail
+
+
+async def async_load_detail(page: AsyncPage, url: str) -> tuple[str, str]:
+    # Navigate to one detail page and read it, the unit a retry repeats
+    await page.goto(url)
+    return await async_read_detail(page)
+
+
+async def async_fetch_details(
+    context, urls: list[str], width: int, navigator: Navigator | None = None
+) -> list[tuple[str, str]]:
+    # Load detail pages on up to `width` worker pages, results in url order
+    if not urls:
+        return []
+
+    details = [None] * len(urls)
+    pending = iter(enumerate(urls))
+
+    async def worker() -> None:
+        page = await context.new_page()
+
+        try:
+            for i, url in pending:
+                details[i] = await async_guarded(
+                    navigator, async_load_detail, page, url
                 )
+        finally:
+            await page.close()
+
+    await asyncio.gather(*(worker() for _ in range(max(1, min(width, len(urls))))))
+    return details
+
+
+async def async_result_pages(
+    page: AsyncPage, url: str, max_pages: int, navigator: Navigator | None = None
+) -> AsyncIterator[tuple[AsyncPage, list[dict]]]:
+    # Yield (page, rows) per result page. Page N+1 loads in a second tab
+    # while the caller extracts page N and its details.
+    with span("result_page"):
+        await async_guarded(navigator, page.goto, url)
+
+    spare = None
+
+    for number in range(1, max_pages + 1):
+        next_url = await page.evaluate(NEXT_PAGE_JS)
+        prefetch = None
+        truncated = next_url and number == max_pages
+
+        if truncated:
+            next_url = None
+
+        if next_url:
+            spare = spare or await page.context.new_page()
+            prefetch = asyncio.ensure_future(async_guarded(navigator, spare.goto, next_url))
 
-                # Go to View hyperlink
-                view_link = table.locator('a:has-text("(View)")')
+        RESULT_PAGES.inc(engine="browser")
 
-                with page.context.expect_page(timeout=60000) as new_page_info:
-                    view_link.nth(0).click()
+        try:
+            yield page, await async_extract_rows(page)
 
-                new_page = new_page_info.value
-                new_page.wait_for_load_state("load", timeout=60000)
+            if truncated:
+                raise ResultsTruncated(f"stopped after {max_pages} result pages")
 
-                contract_info["reason"] = new_page.locator(
-                    'input[name="reasonForModification"]'
-                ).input_value()
+            if prefetch is None:
+                return
 
-                contract_info["desc"] = new_page.locator(
-                    "textarea#descriptionOfContractRequirement"
-                ).input_value()
+            with span("result_page"):
+                await prefetch
+        finally:
+            if prefetch is not None and not prefetch.done():
+                prefetch.cancel()
 
-                contract_details.append(contract_info)
+        page, spare = spare, page
 
-        browser.close()
 
-        return contract_details, url
+async def async_page_details(
+    page: AsyncPage, rows: list[dict], settings: SearchSettings, state: RunState
+) -> list[dict]:
+    # Build contract actions for one result page, mirrors page_details()
+    view_urls = [
+        resolve_view_url(page.url, row["href"], row["onclick"]) for row in rows
+    ]
+    plan = plan_details(rows, view_urls, state)
+
+    with span("detail_pages"):
+        if settings.detail_mode == "http":
+            fetched = await asyncio.to_thread(
+                http_fetch_details, plan.urls, settings.detail_workers, state.navigator
+            )
+        else:
+            fetched = await async_fetch_details(
+                page.context, plan.urls, settings.detail_workers, state.navigator
+            )
+
+    tables = page.locator(RESULT_TABLES)
+    popups = {}
+
+    for i in plan.popups:
+        DETAILS.inc(source="popup")
+
+        with span("detail_popup"):
+            popups[i] = await async_guarded(
+                state.navigator, async_open_detail, page, tables.nth(i)
+            )
+
+    return fill_details(plan, fetched, popups, state)
+
+
+async def async_search(
+    criteria: dict,
+    yday: str,
+    session: AsyncBrowserSession,
+    settings: SearchSettings | None = None,
+    state: RunState | None = None,
+) -> tuple[list[dict], str]:
+    # Execute fpds search on the async engine, mirrors search()
+    settings = settings or SearchSettings()
+    state = state or RunState()
+    url = build_search_url(criteria, yday, settings.base_url)
+    contract_details = []
+
+    with criteria_span(criteria):
+        page = await session.new_page()
+
+        try:
+            async with aclosing(
+                async_result_pages(page, url, settings.max_pages, state.navigator)
+            ) as pages:
+                async for result_page, rows in pages:
+                    contract_details += await async_page_details(
+                        result_page, rows, settings, state
+                    )
+
+        except navigation_errors() as error:
+            state.fail(criteria, error)
+
+        finally:
+            await page.context.close()
+
+    return contract_details, url
 
 
 def build_textblock(content: str) -> dict:
@@ -97,145 +2053,737 @@ def build_textblock(content: str) -> dict:
     return {"type": "TextBlock", "text": content, "wrap": True}
 
 
-def format_results(raw_results: list[dict]) -> list:
-    # Format results strings
+def format_detail(detail: dict) -> str:
+    # Line of one contract action in its result's text block
+    desc = detail["desc"].replace("\n", " ")
+    return f'- **Date Signed:** {detail["date"]} | **Company:** [{detail["company"]}]({detail["company_url"]}) | **Reason:** {detail["reason"]} | **Obligation:** {detail["obligation"]} | **Description:** {desc}'
 
-    items = []
 
-    if raw_results:
-        header = f'**{date.today().strftime("%A, %m/%d/%Y")}.** Contract updates.'
-        items += [build_textblock(header), build_textblock("")]
+def iter_format_results(raw_results: Iterable[dict]) -> Iterator[dict]:
+    # Format results strings as the results arrive, header first
 
-        for result in raw_results:
+    for n, result in enumerate(raw_results):
+        if n == 0:
+            header = f'**{date.today().strftime("%A, %m/%d/%Y")}.** Contract updates.'
+            yield build_textblock(header)
+            yield build_textblock("")
 
+        # Timed per result, not across the yields to the consumer
+        with span("format_results"):
             if "contract_no" in result:
                 content = f'**{result["index"]}. {result["contract_nm"]} -** {result["contract_no"]} - [View updates]({result["url"]})'
             elif "naics" in result:
                 agency = result["agency"]
-<<<<<<< HEAD
                 content = f'**{result["index"]}. {agency} - all of NAICS {result["naics"]} - [View updates]({result["url"]})**'
-=======
-                content = f'**{result["index"]}. {agency} -** all of NAICS {result["naics"]} - [View updates]({result["url"]})'
->>>>>>> formatting
 
             for detail in result["contract_details"]:
-                desc = detail["desc"].replace("\n", " ")
-                content += f'\n\n- **Date Signed:** {detail["date"]} | **Company:** [{detail["company"]}]({detail["company_url"]}) | **Reason:** {detail["reason"]} | **Obligation:** {detail["obligation"]} | **Description:** {desc}'
+                content += "\n\n" + format_detail(detail)
 
-            items += [build_textblock(content), build_textblock("")]
+        yield build_textblock(content)
+        yield build_textblock("")
 
-    return items
+
+def format_results(raw_results: list[dict]) -> list:
+    # Format results strings
+    return list(iter_format_results(raw_results))
 
 
-def process_search(contract_list: str, naics_list: str) -> list:
-    # Prepare fpds search and format results
-    contract_pairs = []
-    naics_triplets = []
-    raw_results = []
-    yday = (datetime.now() - timedelta(days=1)).strftime("%Y/%m/%d")
+def parse_criteria(contract_list: str, naics_list: str) -> list[tuple[dict, dict]]:
+    # Split watchlists into (search criteria, result fields) pairs
+    jobs = []
 
     if contract_list:
-        contract_pairs = contract_list.split(",")
+        for pair in contract_list.split(","):
+            contract_no, contract_nm = pair.split(":", 1)
+            contract_no = contract_no.strip()
+            contract_nm = contract_nm.strip()
+            jobs.append(
+                (
+                    {"contract_no": contract_no},
+                    {"contract_no": contract_no, "contract_nm": contract_nm},
+                )
+            )
 
     if naics_list:
-        naics_triplets = naics_list.split(",")
+        for triplet in naics_list.split(","):
+            naics, agency, abbr = triplet.split(":")
+            naics = naics.strip()
+            agency = agency.strip()
+            abbr = abbr.strip()
+            jobs.append(
+                (
+                    {"naics": naics, "agency": agency},
+                    {"naics": naics, "agency": abbr},
+                )
+            )
+
+    return jobs
 
-    for pair in contract_pairs:
+
+def log_criteria(criteria: dict) -> None:
+    if "contract_no" in criteria:
         log.info("Processing contract number search")
+    elif "contract_nos" in criteria:
+        log.info(
+            "Processing contract number search for %d contracts",
+            len(criteria["contract_nos"]),
+        )
+    else:
+        log.info("Processing NAICS search")
 
-        contract_no, contract_nm = pair.split(":", 1)
-        contract_no = contract_no.strip()
-        contract_nm = contract_nm.strip()
-        contract_details, url = search({"contract_no": contract_no}, yday)
 
-        if contract_details:
-            raw_results.append(
-                {
-                    "contract_no": contract_no,
-                    "contract_nm": contract_nm,
-                    "contract_details": contract_details,
-                    "url": url,
-                }
-            )
+def batch_jobs(
+    indexes: list[int],
+    combine,
+    yday: str,
+    max_size: int,
+    max_url_length: int,
+    base_url: str = BASE_URL,
+) -> list[list[int]]:
+    # Split job indexes into batches under the size and url length limits
+    batches = []
+    batch = []
 
-        time.sleep(5)
+    for i in indexes:
+        if batch and (
+            len(batch) >= max_size
+            or len(build_search_url(combine(batch + [i]), yday, base_url))
+            > max_url_length
+        ):
+            batches.append(batch)
+            batch = []
 
-    for triplet in naics_triplets:
-        log.info("Processing NAICS search")
+        batch.append(i)
+
+    if batch:
+        batches.append(batch)
+
+    return batches
+
+
+def plan_queries(
+    jobs: list[tuple[dict, dict]],
+    yday: str,
+    settings: SearchSettings,
+    group_naics: bool = True,
+) -> list[tuple[dict, list[int]]]:
+    # Combine contract numbers, and NAICS codes sharing an agency, into OR
+    # queries. Returns (query criteria, indexes of the jobs it answers).
+    contract_indexes = []
+    agencies = {}
+
+    for i, (criteria, _) in enumerate(jobs):
+        if "contract_no" in criteria:
+            contract_indexes.append(i)
+        else:
+            agencies.setdefault(criteria["agency"], []).append(i)
+
+    def combine_contracts(batch: list[int]) -> dict:
+        return {"contract_nos": [jobs[i][0]["contract_no"] for i in batch]}
+
+    def combine_naics(batch: list[int]) -> dict:
+        return {
+            "naics_codes": [jobs[i][0]["naics"] for i in batch],
+            "agency": jobs[batch[0]][0]["agency"],
+        }
+
+    groups = [(contract_indexes, combine_contracts, settings.contract_batch_size)]
+    groups += [
+        (indexes, combine_naics, settings.naics_batch_size if group_naics else 1)
+        for indexes in agencies.values()
+    ]
+    queries = []
+
+    for indexes, combine, max_size in groups:
+        for batch in batch_jobs(
+            indexes,
+            combine,
+            yday,
+            max_size,
+            settings.max_url_length,
+            settings.base_url,
+        ):
+            criteria = jobs[batch[0]][0] if len(batch) == 1 else combine(batch)
+            queries.append((criteria, batch))
+
+    return queries
+
+
+def detail_matches_contract(detail: dict, contract_no: str) -> bool:
+    # True if the contract action belongs to the watched contract number
+    contract_no = contract_no.upper()
+    return contract_no in (detail.get("piid", "").upper(), detail.get("idv", "").upper())
+
+
+def route_details(
+    contract_nos: list[str], contract_details: list[dict]
+) -> dict[str, list[dict]]:
+    # Split a batched query's actions back out per contract by PIID. Actions
+    # matched only by free text go to every contract number they mention.
+    routed = {contract_no: [] for contract_no in contract_nos}
+
+    for detail in contract_details:
+        owners = [c for c in contract_nos if detail_matches_contract(detail, c)]
+
+        if not owners:
+            text = " ".join(str(value) for value in detail.values()).upper()
+            owners = [c for c in contract_nos if c.upper() in text]
+
+        if not owners:
+            log.warning("Dropping action %s not matching any contract", detail.get("piid"))
+
+        for contract_no in owners:
+            routed[contract_no].append(detail)
+
+    return routed
+
+
+async def async_run_searches(
+    criteria_list: list[dict], yday: str, settings: SearchSettings, state: RunState
+) -> AsyncIterator[tuple[list[dict], str]]:
+    # Run searches with at most `concurrency` in flight, yielding results in
+    # input order as soon as each is done
+    semaphore = asyncio.Semaphore(settings.concurrency)
+    policy = ResourcePolicy.from_settings(settings)
+
+    async with AsyncBrowserSession(policy=policy) as session:
+
+        async def run(criteria: dict) -> tuple[list[dict], str]:
+            async with semaphore:
+                log_criteria(criteria)
+                return await async_search(criteria, yday, session, settings, state)
+
+        tasks = [asyncio.ensure_future(run(criteria)) for criteria in criteria_list]
+
+        try:
+            for task in tasks:
+                yield await task
+        finally:
+            for task in tasks:
+                task.cancel()
+
+            await asyncio.gather(*tasks, return_exceptions=True)
 
-        naics, agency, abbr = triplet.split(":")
-        naics = naics.strip()
-        agency = agency.strip()
-        abbr = abbr.strip()
-        contract_details, url = search({"naics": naics, "agency": agency}, yday)
-
-        if contract_details:
-            raw_results.append(
-                {
-                    "naics": naics,
-                    "agency": abbr,
+    if policy is not None:
+        policy.log_summary()
+
+
+def iter_async(
+    iterator: AsyncIterator, loop: asyncio.AbstractEventLoop | None = None
+) -> Iterator:
+    # Drive an async iterator from sync code, on `loop` or a private event
+    # loop. Work pauses while the caller handles each item, other tasks on
+    # the loop run whenever it does.
+    own_loop = loop is None
+    loop = loop or asyncio.new_event_loop()
+
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(anext(iterator))
+            except StopAsyncIteration:
+                return
+    finally:
+        loop.run_until_complete(iterator.aclose())
+
+        if own_loop:
+            loop.close()
+
+
+def run_http_searches(
+    criteria_list: list[dict], yday: str, settings: SearchSettings, state: RunState
+) -> Iterator[tuple[list[dict], str]]:
+    # Browser-free searches on `concurrency` threads, results in input order
+
+    def run(criteria: dict) -> tuple[list[dict], str]:
+        log_criteria(criteria)
+        return http_search(criteria, yday, settings, state)
+
+    with ThreadPoolExecutor(max_workers=max(1, settings.concurrency)) as executor:
+        yield from executor.map(run, criteria_list)
+
+
+def run_searches(
+    criteria_list: list[dict], yday: str, settings: SearchSettings, state: RunState
+) -> Iterator[tuple[list[dict], str]]:
+    # Dispatch to the http or async engine, or search one criterion at a
+    # time. Results stream out in input order.
+    if settings.engine == "http":
+        yield from run_http_searches(criteria_list, yday, settings, state)
+        return
+
+    if settings.concurrency > 1 and len(criteria_list) > 1:
+        searches = async_run_searches(criteria_list, yday, settings, state)
+        yield from iter_async(searches, state.event_loop())
+        return
+
+    policy = ResourcePolicy.from_settings(settings)
+
+    # One browser for the whole run, launched on first search
+    with BrowserSession(policy=policy) as session:
+        for criteria in criteria_list:
+            log_criteria(criteria)
+            yield search(criteria, yday, session, settings, state)
+
+    if policy is not None:
+        policy.log_summary()
+
+
+def route_naics_details(
+    naics_codes: list[str], contract_details: list[dict]
+) -> dict[str, list[dict]] | None:
+    # Split an agency query's actions back out per NAICS code. Returns None
+    # if any action's NAICS can't be read, so the codes get searched one by one.
+    routed = {code: [] for code in naics_codes}
+
+    for detail in contract_details:
+        if detail.get("naics") not in routed:
+            log.warning("Cannot route action %s by NAICS", detail.get("piid"))
+            return None
+
+        routed[detail["naics"]].append(detail)
+
+    return routed
+
+
+def run_jobs(
+    jobs: list[tuple[dict, dict]], yday: str, settings: SearchSettings, state: RunState
+) -> Iterator[tuple[list[dict], str]]:
+    # Search every watchlist entry from its watermark, yielding results in
+    # job order as soon as they are ready
+    groups = {}
+
+    for i, (criteria, _) in enumerate(jobs):
+        groups.setdefault(state.since(criteria, yday), []).append(i)
+
+    ready = {}
+    next_job = 0
+
+    for since, indexes in groups.items():
+        if since != yday:
+            log.info("Searching %d entries from %s", len(indexes), since)
+
+        group = run_job_group([jobs[i] for i in indexes], since, settings, state)
+
+        for i, result in group:
+            ready[indexes[i]] = result
+
+            while next_job in ready:
+                yield ready.pop(next_job)
+                next_job += 1
+
+
+def route_searches(
+    queries: list[tuple[dict, list[int]]],
+    jobs: list[tuple[dict, dict]],
+    yday: str,
+    settings: SearchSettings,
+    state: RunState,
+    unrouted: list[int],
+) -> Iterator[tuple[int, tuple[list[dict], str]]]:
+    # Run queries and split OR query results back out per job. Jobs of
+    # queries that can't be routed are added to `unrouted`.
+    searches = run_searches([criteria for criteria, _ in queries], yday, settings, state)
+
+    # Searches first, so the engine shuts down once the last result is taken
+    for (contract_details, url), (criteria, indexes) in zip(searches, queries):
+        if len(indexes) == 1:
+            yield indexes[0], (contract_details, url)
+            continue
+
+        if "contract_nos" in criteria:
+            routed = route_details(criteria["contract_nos"], contract_details)
+            key = "contract_no"
+        else:
+            routed = route_naics_details(criteria["naics_codes"], contract_details)
+            key = "naics"
+
+            if routed is None and state.naics_routable is not False:
+                log.warning(
+                    "Result rows carry no NAICS code, searching NAICS codes"
+                    " one at a time for the rest of the run"
+                )
+                state.naics_routable = False
+            elif contract_details and state.naics_routable is None:
+                state.naics_routable = True
+
+        if routed is None:
+            unrouted += indexes
+            continue
+
+        for i in indexes:
+            job_criteria = jobs[i][0]
+            url = build_search_url(job_criteria, yday, settings.base_url)
+            yield i, (routed[job_criteria[key]], url)
+
+
+def run_job_group(
+    jobs: list[tuple[dict, dict]], yday: str, settings: SearchSettings, state: RunState
+) -> Iterator[tuple[int, tuple[list[dict], str]]]:
+    # Search watchlist entries sharing a start date, batched where possible.
+    # Yields (job index, result) as each query is routed.
+    queries = plan_queries(jobs, yday, settings, state.naics_routable is not False)
+    held = []
+
+    if state.naics_routable is None:
+        # Only one agency OR query runs until its rows show whether they can
+        # be routed by NAICS code; the others wait for the answer
+        grouped = [
+            n for n, (criteria, _) in enumerate(queries) if "naics_codes" in criteria
+        ]
+        waiting = set(grouped[1:])
+        held = [queries[n] for n in grouped[1:]]
+        queries = [query for n, query in enumerate(queries) if n not in waiting]
+
+    unrouted = []
+    yield from route_searches(queries, jobs, yday, settings, state, unrouted)
+
+    if held and state.naics_routable is False:
+        unrouted += [i for _, indexes in held for i in indexes]
+    elif held:
+        yield from route_searches(held, jobs, yday, settings, state, unrouted)
+
+    if unrouted:
+        # Fall back to one search per criterion
+        retries = run_searches([jobs[i][0] for i in unrouted], yday, settings, state)
+        yield from ((i, result) for result, i in zip(retries, unrouted))
+
+
+def stream_results(
+    contract_list: str,
+    naics_list: str,
+    settings: SearchSettings | None = None,
+    state: RunState | None = None,
+) -> Iterator[dict]:
+    # Yield numbered results per watchlist entry as soon as its searches are
+    # done. Watermarks only advance when the caller commits the state after
+    # posting.
+    settings = settings or SearchSettings()
+    yday = (datetime.now() - timedelta(days=1)).strftime("%Y/%m/%d")
+    jobs = parse_criteria(contract_list, naics_list)
+    own_state = state is None
+    state = state or RunState(settings)
+    n = 0
+
+    try:
+        job_results = timed("process_search", run_jobs(jobs, yday, settings, state))
+
+        for (contract_details, url), (_, result) in zip(job_results, jobs):
+            if contract_details:
+                n += 1
+                yield {
+                    **result,
                     "contract_details": contract_details,
                     "url": url,
+                    "index": n,
                 }
-            )
-
-        time.sleep(5)
+    finally:
+        state.log_summary()
 
-    if raw_results:
-        # Inject index into results
-        n = 1
+        if own_state:
+            state.close()
 
-        for result in raw_results:
-            result["index"] = n
-            n += 1
 
+def process_search(
+    contract_list: str,
+    naics_list: str,
+    settings: SearchSettings | None = None,
+    state: RunState | None = None,
+) -> list:
+    # Prepare fpds search and format results
+    raw_results = list(stream_results(contract_list, naics_list, settings, state))
     return format_results(raw_results)
 
 
-def teams_post(api_client: client.ApiClient, items: list[dict]) -> None:
-    # Execute MS Teams post
+def build_card(items: list[dict]) -> dict:
+    # Wrap text blocks in the adaptive card message Teams expects
+    return {
+        "type": "message",
+        "attachments": [
+            {
+                "contentType": "application/vnd.microsoft.card.adaptive",
+                "content": {
+                    "type": "AdaptiveCard",
+                    "version": "1.0",
+                    "body": [{"type": "Container", "items": items}],
+                    "msteams": {"width": "Full"},
+                },
+            }
+        ],
+    }
+
+
+def json_size(value) -> int:
+    # Bytes of value as the client serializes it
+    return len(json.dumps(value))
+
+
+def split_textblock(item: dict, budget: int) -> list[dict]:
+    # Break a text block too big for one card at its paragraph breaks. JSON
+    # escapes text character by character, so each paragraph is measured
+    # once and the sizes summed.
+    if json_size(item) <= budget:
+        return [item]
+
+    overhead = json_size(build_textblock(""))
+    blocks = []
+    parts = []
+    size = overhead
+
+    for part in item["text"].split("\n\n"):
+        # Without quotes; the "\n\n" between paragraphs escapes to 4 bytes
+        part_size = json_size(part) - 2
+
+        if parts and size + 4 + part_size > budget:
+            blocks.append(build_textblock("\n\n".join(parts)))
+            parts = []
+            size = overhead
+
+        size += part_size + (4 if parts else 0)
+        parts.append(part)
+
+    blocks.append(build_textblock("\n\n".join(parts)))
+
+    for block in blocks:
+        if json_size(block) > budget:
+            log.warning("Text block of %d bytes exceeds the card limit", json_size(block))
+
+    return blocks
+
+
+def pack_cards(items: Iterable[dict], max_bytes: int) -> Iterator[list[dict]]:
+    # Fill cards with text blocks in reading order, each card's serialized
+    # message staying under max_bytes
+    budget = max_bytes - json_size(build_card([]))
+    card = []
+    size = 0
+
+    for item in items:
+        for block in split_textblock(item, budget):
+            # ", " separates list entries
+            block_size = json_size(block) + 2
+
+            if card and size + block_size > budget:
+                yield card
+                card = []
+                size = 0
+
+            # A spacer is pointless at the top of a card
+            if not card and not block["text"]:
+                continue
+
+            card.append(block)
+            size += block_size
+
+    if card:
+        yield card
+
+
+def teams_post(
+    api_client: client.ApiClient, items: list[dict], async_req: bool = False
+):
+    # Execute MS Teams post. With async_req the request thread is returned,
+    # see wait_post().
+    from client.rest import ApiException
+
     api_instance = client.MsApi(api_client)
 
     try:
-        api_instance.teams_post(
-            body={
-                "type": "message",
-                "attachments": [
-                    {
-                        "contentType": "application/vnd.microsoft.card.adaptive",
-                        "content": {
-                            "type": "AdaptiveCard",
-                            "version": "1.0",
-                            "body": [{"type": "Container", "items": items}],
-                            "msteams": {"width": "Full"},
-                        },
-                    }
-                ],
-            }
-        )
+        if async_req:
+            return api_instance.teams_post(body=build_card(items), async_req=True)
+
+        with span("teams_post"):
+            return api_instance.teams_post(body=build_card(items))
+
+    except ApiException as e:
+        log.exception("Exception when calling MsApi->teams_post: %s\n" % e)
+        raise
+
+
+async def async_teams_post(api_client: client.ApiClient, items: list[dict]):
+    # Awaitable teams_post() on the client's asyncio transport
+    from client.rest import ApiException
+
+    api_instance = client.MsApi(api_client)
+
+    try:
+        with span("teams_post"):
+            return await api_instance.teams_post_async(body=build_card(items))
+
+    except ApiException as e:
+        log.exception("Exception when calling MsApi->teams_post: %s\n" % e)
+        raise
+
+
+def wait_post(thread) -> None:
+    # Wait for a teams_post(async_req=True) request to finish. Only the time
+    # spent blocked here counts towards the teams_post stage.
+    from client.rest import ApiException
+
+    try:
+        with span("teams_post"):
+            thread.get()
 
     except ApiException as e:
         log.exception("Exception when calling MsApi->teams_post: %s\n" % e)
         raise
 
 
-def main(contract_list: str, naics_list: str, ms_webhook_url: str) -> None:
+def post_cards(
+    ms_webhook_url: str,
+    items: Iterable[dict],
+    max_bytes: int,
+    concurrency: int = 1,
+    loop: asyncio.AbstractEventLoop | None = None,
+    on_posted: Callable[[list[dict], bool], None] | None = None,
+) -> int:
+    # Post text blocks to Teams while they stream in, packed into cards under
+    # max_bytes. Up to `concurrency` posts run in the background while later
+    # cards are searched and packed: on the client's thread pool, or as tasks
+    # on `loop` that progress whenever it runs. on_posted is called with each
+    # card sent and whether Teams accepted it, in posting order, also when
+    # the run fails. Returns the number of cards posted.
+    api_client = None
+    in_flight = collections.deque()
+    posted = 0
+
+    def wait(card: list[dict], post) -> None:
+        try:
+            if loop is None:
+                wait_post(post)
+            else:
+                loop.run_until_complete(post)
+        except BaseException:
+            if on_posted is not None:
+                on_posted(card, False)
+            raise
+
+        if on_posted is not None:
+            on_posted(card, True)
+
+    def succeeded(post) -> bool:
+        if loop is None:
+            return post.successful()
+
+        return not post.cancelled() and post.exception() is None
+
+    try:
+        for card in pack_cards(items, max_bytes):
+            if api_client is None:
+                log.info("Process Teams posts")
+                api_config = client.Configuration()
+                api_config.host = ms_webhook_url
+                api_config.pool_threads = max(1, concurrency)
+                api_client = client.ApiClient(api_config)
+
+            if len(in_flight) >= max(1, concurrency):
+                wait(*in_flight.popleft())
+
+            if loop is None:
+                post = teams_post(api_client, card, async_req=True)
+            else:
+                post = loop.create_task(async_teams_post(api_client, card))
+
+            in_flight.append((card, post))
+            CARDS.inc()
+            posted += 1
+
+        while in_flight:
+            wait(*in_flight.popleft())
+
+    finally:
+        # Let posts already sent finish even when the run fails
+        if loop is None:
+            for _, thread in in_flight:
+                thread.wait()
+        elif in_flight:
+            loop.run_until_complete(asyncio.wait([task for _, task in in_flight]))
+
+        if on_posted is not None:
+            for card, post in in_flight:
+                on_posted(card, succeeded(post))
+
+        if api_client is not None:
+            if loop is not None:
+                loop.run_until_complete(api_client.aclose())
+
+            api_client.close()
+
+    return posted
+
+
+def export_metrics(settings: SearchSettings) -> None:
+    # Write and push the run metrics; a failed export never fails the run
+    if settings.metrics_path:
+        try:
+            REGISTRY.write(settings.metrics_path)
+        except OSError as error:
+            log.warning("Writing metrics to %s failed: %s", settings.metrics_path, error)
+
+    if settings.metrics_push_url:
+        import urllib3
+
+        try:
+            REGISTRY.push(settings.metrics_push_url)
+        except urllib3.exceptions.HTTPError as error:
+            log.warning(
+                "Pushing metrics to %s failed: %s", settings.metrics_push_url, error
+            )
+
+
+def main(
+    contract_list: str,
+    naics_list: str,
+    ms_webhook_url: str,
+    settings: SearchSettings | None = None,
+) -> None:
     # Primary processing fuction
 
     log.info("Start processing")
-    contract_results = process_search(contract_list, naics_list)
-
-    if contract_results:
-        log.info("Process Teams posts")
-        api_config = client.Configuration()
-        api_config.host = ms_webhook_url
-        api_client = client.ApiClient(api_config)
-        teams_post(api_client, contract_results)
-    else:
-        log.info("No contract updates found")
+    started = time.monotonic()
+    settings = settings or SearchSettings()
+    state = RunState(settings)
+    RUN_SUCCESS.set(0)
+
+    if settings.timings_path:
+        TIMINGS.enable()
+
+    try:
+        results = stream_results(contract_list, naics_list, settings, state)
+
+        # Searches still running when a post fails shut down here, while the
+        # state's event loop is open
+        with closing(results):
+            items = iter_format_results(state.track(results))
+
+            loop = state.event_loop() if settings.post_transport == "asyncio" else None
+            posted = post_cards(
+                ms_webhook_url,
+                items,
+                settings.card_max_bytes,
+                settings.post_concurrency,
+                loop,
+                state.card_posted,
+            )
+
+        if not posted:
+            log.info("No contract updates found")
+
+        # Next run starts from here
+        state.commit()
+        RUN_SUCCESS.set(1)
+    finally:
+        state.close()
+        RUN_DURATION.set(time.monotonic() - started)
+        export_metrics(settings)
+
+        if TIMINGS.enabled:
+            TIMINGS.write(settings.timings_path)
+            TIMINGS.disable()
 
 
-""" Read in contract_list, naics_list, ms_webhook_url
+""" Read in contract_list, naics_list, ms_webhook_url. Optional tunables
+    come from FPDS_* environment variables, see SearchSettings.
 """
 if __name__ == "__main__":
-    main(sys.argv[1], sys.argv[2], sys.argv[3])
+    main(sys.argv[1], sys.argv[2], sys.argv[3], SearchSettings.from_env())
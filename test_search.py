@@ -2,12 +2,36 @@
     Tests for search.py 
 """
 
-from datetime import date
+import asyncio
+import gc
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from datetime import date, datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 import pytest
+import urllib3
+from playwright.sync_api import Error as PlaywrightError
+from playwright.sync_api import TimeoutError as PlaywrightTimeoutError
 
 import client
+from client import metrics, rest
+from client.rest import ApiException
 import search
+from fpds_standin import DETAIL_PATH, RESULTS_PATH, StandinFpds
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+
+
+@pytest.fixture(autouse=True)
+def run_in_tmp_path(monkeypatch, tmp_path):
+    # Keeps state and cache databases out of the working tree
+    monkeypatch.chdir(tmp_path)
 
 
 @pytest.fixture
@@ -18,6 +42,57 @@ def api_client():
     return client.ApiClient(api_config)
 
 
+@pytest.fixture
+def fpds_standin():
+    # Local ezsearch stand-in: 2 pages of 3 actions per query
+    with StandinFpds(tables=3, pages=2) as standin:
+        yield standin
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    # Keep-alive webhook recording (client address, body) per POST. /fail
+    # answers 500, /slow takes a second, /chunked sends a chunked body.
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self) -> None:
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.posts.append((self.client_address, json.loads(body)))
+
+        if self.path == "/slow":
+            time.sleep(1)
+
+        if self.path == "/chunked":
+            self.send_response(200)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            self.wfile.write(b"1\r\n1\r\n0\r\n\r\n")
+            return
+
+        self.send_response(500 if self.path == "/fail" else 200)
+        self.send_header("Content-Length", "1")
+        self.end_headers()
+        self.wfile.write(b"1")
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+@pytest.fixture
+def webhook():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), WebhookHandler)
+    server.daemon_threads = True
+    server.posts = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def sync_settings():
+    return search.SearchSettings(concurrency=1)
+
+
 def test_get_value(mocker):
     mock_item = mocker.MagicMock()
     mock_locator = mocker.MagicMock()
@@ -95,11 +170,7 @@ def test_format_results():
         },
         {
             "type": "TextBlock",
-<<<<<<< HEAD
             "text": "**2. Test Agency - all of NAICS 541512 - [View updates](https://example.com)**\n\n- **Date Signed:** 02/25/2024 | **Company:** [Test Company](https://example.com) | **Reason:** Exercise An Option | **Obligation:** $50 | **Description:** This exercises option year.",
-=======
-            "text": "**2. Test Agency - all of NAICS 541512 -** [View updates](https://example.com)\n\n- **Date Signed:** 02/25/2024 | **Company:** [Test Company](https://example.com) | **Reason:** Exercise An Option | **Obligation:** $50 | **Description:** This exercises option year.",
->>>>>>> formatting
             "wrap": True,
         },
         {
@@ -112,7 +183,7 @@ def test_format_results():
     assert items == search.format_results(raw_results)
 
 
-def test_process_search_contract_naics_results(mocker):
+def test_process_search_contract_naics_results(mocker, sync_settings):
     contract_list = "123456789: Test Contract Name"
     naics_list = "541512:Test+Agency:Test Agency"
     contract_details = [
@@ -149,11 +220,7 @@ def test_process_search_contract_naics_results(mocker):
         },
         {
             "type": "TextBlock",
-<<<<<<< HEAD
             "text": "**2. Test Agency - all of NAICS 541512 - [View updates](https://example.com)**\n\n- **Date Signed:** 02/25/2024 | **Company:** [Test Company](https://example.com) | **Reason:** Exercise An Option | **Obligation:** $50 | **Description:** This exercises option year.",
-=======
-            "text": "**2. Test Agency - all of NAICS 541512 -** [View updates](https://example.com)\n\n- **Date Signed:** 02/25/2024 | **Company:** [Test Company](https://example.com) | **Reason:** Exercise An Option | **Obligation:** $50 | **Description:** This exercises option year.",
->>>>>>> formatting
             "wrap": True,
         },
         {
@@ -166,10 +233,10 @@ def test_process_search_contract_naics_results(mocker):
     mocker.patch(
         "search.search", return_value=(contract_details, "https://example.com")
     )
-    assert items == search.process_search(contract_list, naics_list)
+    assert items == search.process_search(contract_list, naics_list, sync_settings)
 
 
-def test_process_search_contract_results(mocker):
+def test_process_search_contract_results(mocker, sync_settings):
     contract_list = "123456789: Test Contract Name"
     naics_list = ""
     contract_details = [
@@ -209,10 +276,10 @@ def test_process_search_contract_results(mocker):
     mocker.patch(
         "search.search", return_value=(contract_details, "https://example.com")
     )
-    assert items == search.process_search(contract_list, naics_list)
+    assert items == search.process_search(contract_list, naics_list, sync_settings)
 
 
-def test_process_search_zero(mocker):
+def test_process_search_zero(mocker, sync_settings):
     contract_list = "123456789: Test Contract Name,098765432: Test Contract Name 2"
     naics_list = "541512:Test+Agency:Test Agency,541511:Test+Agency+2:Test Agency 2"
     contract_details = []
@@ -220,7 +287,7 @@ def test_process_search_zero(mocker):
     mocker.patch(
         "search.search", return_value=(contract_details, "https://example.com")
     )
-    assert [] == search.process_search(contract_list, naics_list)
+    assert [] == search.process_search(contract_list, naics_list, sync_settings)
 
 
 def test_teams_post(mocker):
@@ -247,11 +314,7 @@ def test_teams_post(mocker):
         },
         {
             "type": "TextBlock",
-<<<<<<< HEAD
             "text": "**2. Agency Name - all of NAICS 541512 - [View updates](https://example.com)**\n\n- **Date Signed:** 02/25/2024 | **Company:** [Test Company](https://example.com) | **Reason:** Exercise An Option | **Obligation:** $50 | **Description:** This exercises option year.",
-=======
-            "text": "**2. Agency Name - all of NAICS 541512 -** [View updates](https://example.com)\n\n- **Date Signed:** 02/25/2024 | **Company:** [Test Company](https://example.com) | **Reason:** Exercise An Option | **Obligation:** $50 | **Description:** This exercises option year.",
->>>>>>> formatting
             "wrap": True,
         },
         {
@@ -278,3 +341,1706 @@ def test_teams_post(mocker):
     mock_teams_post = mocker.patch("search.client.MsApi.teams_post")
     search.teams_post(api_client, items)
     mock_teams_post.assert_called_once_with(body=body)
+
+
+def test_browser_session_lazy_launch(mocker):
+    mock_playwright = mocker.patch("playwright.sync_api.sync_playwright")
+
+    with search.BrowserSession():
+        pass
+
+    mock_playwright.assert_not_called()
+
+
+def test_browser_session_reuses_browser(mocker):
+    mock_playwright = mocker.patch("playwright.sync_api.sync_playwright")
+    mock_started = mock_playwright.return_value.start.return_value
+    mock_browser = mock_started.chromium.launch.return_value
+
+    with search.BrowserSession() as session:
+        session.new_page()
+        session.new_page()
+
+    mock_started.chromium.launch.assert_called_once_with(headless=True)
+    assert mock_browser.new_context.call_count == 2
+    mock_browser.close.assert_called_once()
+    mock_started.stop.assert_called_once()
+
+
+def test_process_search_shares_session(mocker):
+    contract_list = "123456789: Test Contract Name,098765432: Test Contract Name 2"
+    naics_list = "541512:Test+Agency:Test Agency"
+    mock_search = mocker.patch("search.search", return_value=([], "https://example.com"))
+    settings = search.SearchSettings(concurrency=1, contract_batch_size=1)
+
+    search.process_search(contract_list, naics_list, settings)
+
+    sessions = {id(call.args[2]) for call in mock_search.call_args_list}
+    assert mock_search.call_count == 3
+    assert len(sessions) == 1
+
+
+def test_search_settings_from_env():
+    settings = search.SearchSettings.from_env({"FPDS_CONCURRENCY": "4"})
+    assert settings.concurrency == 4
+    assert search.SearchSettings.from_env({}) == search.SearchSettings()
+
+
+def test_build_search_url():
+    assert (
+        search.build_search_url({"contract_no": "123456789"}, "2024/02/25")
+        == "https://www.fpds.gov/ezsearch/fpdsportal?q=123456789%20%20SIGNED_DATE%3A%5B2024/02/25%2C%29&templateName=1.5.3&indexName=awardfull&sortBy=SIGNED_DATE&desc=Y"
+    )
+    assert (
+        search.build_search_url(
+            {"naics": "541512", "agency": "Test+Agency"}, "2024/02/25"
+        )
+        == "https://www.fpds.gov/ezsearch/fpdsportal?q=CONTRACTING_AGENCY_NAME%3A%22Test+Agency%22+PRINCIPAL_NAICS_CODE%3A%22541512%22++SIGNED_DATE%3A%5B2024/02/25%2C%29&templateName=1.5.3&indexName=awardfull&sortBy=SIGNED_DATE&desc=Y"
+    )
+
+
+def test_process_search_async_preserves_order(mocker):
+    contract_list = "111: First,222: Second,333: Third"
+    in_flight = []
+    peak = []
+
+    async def fake_search(criteria, yday, session, settings, state):
+        in_flight.append(criteria)
+        peak.append(len(in_flight))
+        # Finish in reverse order of submission
+        for _ in range(4 - int(criteria["contract_no"][0])):
+            await search.asyncio.sleep(0)
+        in_flight.remove(criteria)
+        detail = {
+            "date": "02/25/2024",
+            "company": criteria["contract_no"],
+            "company_url": "https://example.com",
+            "reason": "Exercise An Option",
+            "obligation": "$50",
+            "desc": "This exercises option year.",
+        }
+        return [detail], "https://example.com"
+
+    mocker.patch("search.async_search", side_effect=fake_search)
+    mock_sync_search = mocker.patch("search.search")
+    real_sleep = search.asyncio.sleep
+
+    async def no_pause(delay):
+        await real_sleep(0)
+
+    mocker.patch("search.asyncio.sleep", side_effect=no_pause)
+
+    items = search.process_search(
+        contract_list, "", search.SearchSettings(concurrency=2, contract_batch_size=1)
+    )
+
+    mock_sync_search.assert_not_called()
+    assert max(peak) == 2
+    assert [item["text"][:9] for item in items[2::2]] == [
+        "**1. Firs",
+        "**2. Seco",
+        "**3. Thir",
+    ]
+
+
+class FakeDetailPage:
+    # Stand-in for a Playwright page serving detail fields for its url
+
+    def __init__(self):
+        self.url = None
+        self.closed = False
+
+    def goto(self, url, **kwargs):
+        self.url = url
+
+    def wait_for_load_state(self, *args, **kwargs):
+        pass
+
+    def locator(self, selector):
+        field = "reason" if "reason" in selector else "desc"
+        return type("Field", (), {"input_value": lambda _: f"{field} {self.url}"})()
+
+    def close(self):
+        self.closed = True
+
+
+class FakeAsyncDetailPage(FakeDetailPage):
+    async def goto(self, url, **kwargs):
+        self.url = url
+        await search.asyncio.sleep(0.01 if url.endswith("0") else 0)
+
+    def locator(self, selector):
+        field = "reason" if "reason" in selector else "desc"
+        url = self.url
+
+        async def input_value():
+            return f"{field} {url}"
+
+        return type("Field", (), {"input_value": lambda _: input_value()})()
+
+    async def close(self):
+        self.closed = True
+
+
+def test_resolve_view_url():
+    page_url = "https://www.fpds.gov/ezsearch/fpdsportal?q=1"
+    assert (
+        search.resolve_view_url(page_url, "jsp/viewLinkController.jsp?PIID=1", None)
+        == "https://www.fpds.gov/ezsearch/jsp/viewLinkController.jsp?PIID=1"
+    )
+    assert (
+        search.resolve_view_url(
+            page_url,
+            "javascript:void(0)",
+            "window.open('/common/jsp/LaunchWebPage.jsp?id=2','_blank')",
+        )
+        == "https://www.fpds.gov/common/jsp/LaunchWebPage.jsp?id=2"
+    )
+    assert search.resolve_view_url(page_url, "javascript:void(0)", None) is None
+
+
+def test_fetch_details_worker_pool(mocker):
+    context = mocker.MagicMock()
+    pages = []
+
+    def new_page():
+        pages.append(FakeDetailPage())
+        return pages[-1]
+
+    context.new_page.side_effect = new_page
+    urls = [f"https://example.com/{i}" for i in range(5)]
+
+    details = search.fetch_details(context, urls, 2)
+
+    assert len(pages) == 2
+    assert all(page.closed for page in pages)
+    assert details == [(f"reason {url}", f"desc {url}") for url in urls]
+    assert search.fetch_details(context, [], 2) == []
+
+
+def test_async_fetch_details_order(mocker):
+    context = mocker.MagicMock()
+    pages = []
+
+    async def new_page():
+        pages.append(FakeAsyncDetailPage())
+        return pages[-1]
+
+    context.new_page.side_effect = new_page
+    urls = [f"https://example.com/{i}" for i in range(6)]
+
+    details = search.asyncio.run(search.async_fetch_details(context, urls, 3))
+
+    assert len(pages) == 3
+    assert all(page.closed for page in pages)
+    assert details == [(f"reason {url}", f"desc {url}") for url in urls]
+
+    # A width of 0 still loads every page on one worker
+    details = search.asyncio.run(search.async_fetch_details(context, urls, 0))
+
+    assert len(pages) == 4
+    assert details == [(f"reason {url}", f"desc {url}") for url in urls]
+    assert search.asyncio.run(search.async_fetch_details(context, [], 3)) == []
+
+
+DETAIL_HTML = """
+<html><body><form>
+<input type="text" name="reasonForModification" value="Exercise An Option" readonly>
+<textarea id="descriptionOfContractRequirement">
+This exercises option year &amp; funds it.</textarea>
+</form></body></html>
+"""
+
+
+def test_parse_detail_html():
+    assert search.parse_detail_html(DETAIL_HTML) == (
+        "Exercise An Option",
+        "This exercises option year & funds it.",
+    )
+    assert search.parse_detail_html("<html></html>") == ("", "")
+
+
+def test_http_fetch_details(mocker):
+    mock_http = mocker.patch("search.fpds_http")
+    response = mocker.MagicMock()
+    response.data = DETAIL_HTML.encode("iso-8859-1")
+    response.getheader.return_value = "text/html; charset=ISO-8859-1"
+    mock_http.return_value.GET.return_value = response
+    urls = ["https://example.com/1", "https://example.com/2"]
+
+    details = search.http_fetch_details(urls, 4)
+
+    assert details == [
+        ("Exercise An Option", "This exercises option year & funds it.")
+    ] * 2
+    mock_http.return_value.GET.assert_any_call(
+        "https://example.com/2", headers={"Accept": "text/html"}, _request_timeout=60
+    )
+
+
+def read_fixture(name):
+    with open(os.path.join(FIXTURES, name), encoding="utf-8") as f:
+        return f.read()
+
+
+def test_parse_result_html():
+    tables = search.parse_result_html(read_fixture("ezsearch_results.html"))
+    page_url = "https://www.fpds.gov/ezsearch/fpdsportal?q=1"
+
+    assert len(tables) == 3
+    assert [search.table_value(t, "Date Signed:") for t in tables] == [
+        "02/25/2024",
+        "02/24/2024",
+        "02/24/2024",
+    ]
+    assert [search.table_value(t, "Legal Business Name:") for t in tables] == [
+        "Test Company, LLC",
+        "Other & Sons Inc",
+        "No Link Corp",
+    ]
+    assert search.table_value(tables[1], "Action Obligation:") == "-$1,250.00"
+    assert search.table_value(tables[0], "Missing Label:") == ""
+    assert [search.table_view_url(t, page_url) for t in tables] == [
+        "https://www.fpds.gov/ezsearch/jsp/viewLinkController.jsp?agencyID=7529&PIID=123456789&modNumber=P00012&contractType=AWARD",
+        "https://www.fpds.gov/common/jsp/LaunchWebPage.jsp?command=execute&requestid=4242",
+        None,
+    ]
+
+
+def test_http_search(mocker, tmp_path):
+    pages = {
+        "results": read_fixture("ezsearch_results.html"),
+        "results_page2": read_fixture("ezsearch_results_page2.html"),
+        "detail": read_fixture("detail.html"),
+    }
+
+    def get(url, **kwargs):
+        response = mocker.MagicMock()
+
+        if "start=30" in url:
+            page = "results_page2"
+        elif "fpdsportal" in url:
+            page = "results"
+        else:
+            page = "detail"
+
+        response.data = pages[page].encode("utf-8")
+        response.getheader.return_value = "text/html;charset=UTF-8"
+        return response
+
+    mocker.patch("search.fpds_http").return_value.GET.side_effect = get
+
+    contract_details, url = search.http_search(
+        {"contract_no": "123456789"}, "2024/02/24"
+    )
+
+    assert url == search.build_search_url({"contract_no": "123456789"}, "2024/02/24")
+    assert contract_details[0] == {
+        "date": "02/25/2024",
+        "company": "Test Company, LLC",
+        "company_url": search.build_company_url("Test Company, LLC"),
+        "obligation": "$50.00",
+        "view_url": "https://www.fpds.gov/ezsearch/jsp/viewLinkController.jsp"
+        "?agencyID=7529&PIID=123456789&modNumber=P00012&contractType=AWARD",
+        "piid": "123456789",
+        "idv": "",
+        "mod": "P00012",
+        "naics": "",
+        "reason": "Exercise An Option",
+        "desc": "This exercises option year\ntwo & funds it.",
+    }
+    assert contract_details[1]["reason"] == "Exercise An Option"
+    assert (contract_details[2]["reason"], contract_details[2]["desc"]) == ("", "")
+    assert len(contract_details) == 4
+    assert (contract_details[3]["mod"], contract_details[3]["obligation"]) == (
+        "P00011",
+        "$10.00",
+    )
+
+    # A query cut short by max_pages keeps its rows but not its watermark
+    settings = search.SearchSettings(
+        max_pages=1, state_path=str(tmp_path / "state.sqlite3")
+    )
+    state = search.RunState(settings)
+    state.since({"contract_no": "123456789"}, "2024/02/24")
+    failed = search.FAILED_SEARCHES.value(error="ResultsTruncated") or 0
+
+    contract_details, _ = search.http_search(
+        {"contract_no": "123456789"}, "2024/02/24", settings, state
+    )
+    assert len(contract_details) == 3
+    assert state.watermarks.pending_marks == {}
+    assert search.FAILED_SEARCHES.value(error="ResultsTruncated") == failed + 1
+    state.close()
+
+
+def test_process_search_http_engine(mocker):
+    mock_http_search = mocker.patch(
+        "search.http_search", return_value=([], "https://example.com")
+    )
+    mock_search = mocker.patch("search.search")
+    settings = search.SearchSettings(engine="http")
+
+    assert [] == search.process_search("123: A,456: B", "541512:X:Y", settings)
+    queried = [call.args[0] for call in mock_http_search.call_args_list]
+    assert len(queried) == 2
+    assert {"contract_nos": ["123", "456"]} in queried
+    assert {"naics": "541512", "agency": "X"} in queried
+    mock_search.assert_not_called()
+
+
+def test_search_extracts_rows_in_one_call(mocker):
+    session = mocker.MagicMock()
+    page = session.new_page.return_value
+    page.url = "https://www.fpds.gov/ezsearch/fpdsportal?q=1"
+    rows = [
+        {
+            "date": "02/25/2024",
+            "company": "Test Company",
+            "obligation": "$50",
+            "href": "jsp/viewLinkController.jsp?PIID=1",
+            "onclick": None,
+        }
+    ]
+    page.evaluate.side_effect = lambda js, *args: (
+        rows if js == search.EXTRACT_ROWS_JS else None
+    )
+    mock_fetch = mocker.patch(
+        "search.http_fetch_details",
+        return_value=[("Exercise An Option", "This exercises option year.")],
+    )
+
+    contract_details, _ = search.search(
+        {"contract_no": "1"},
+        "2024/02/24",
+        session,
+        search.SearchSettings(detail_mode="http"),
+    )
+
+    page.evaluate.assert_any_call(search.EXTRACT_ROWS_JS, search.ROW_LABELS)
+    assert page.evaluate.call_count == 2
+    mock_fetch.assert_called_once_with(
+        ["https://www.fpds.gov/ezsearch/jsp/viewLinkController.jsp?PIID=1"], 4, None
+    )
+    page.context.close.assert_called_once()
+    assert contract_details == [
+        {
+            "date": "02/25/2024",
+            "company": "Test Company",
+            "company_url": search.build_company_url("Test Company"),
+            "obligation": "$50",
+            "view_url": (
+                "https://www.fpds.gov/ezsearch/jsp/viewLinkController.jsp?PIID=1"
+            ),
+            "piid": "1",
+            "idv": "",
+            "mod": "",
+            "naics": "",
+            "reason": "Exercise An Option",
+            "desc": "This exercises option year.",
+        }
+    ]
+
+
+def test_resource_policy_blocks(mocker):
+    policy = search.ResourcePolicy.from_settings(
+        search.SearchSettings(allowed_urls="fpds.gov/ezsearch/images/needed")
+    )
+
+    assert policy.should_block("https://www.fpds.gov/logo.png", "image")
+    assert policy.should_block("https://ssl.google-analytics.com/ga.js", "script")
+    assert not policy.should_block("https://www.fpds.gov/ezsearch/fpdsportal", "document")
+    assert not policy.should_block(
+        "https://www.fpds.gov/ezsearch/images/needed.gif", "image"
+    )
+
+    blocked = mocker.MagicMock()
+    blocked.request.url = "https://www.fpds.gov/font.woff"
+    blocked.request.resource_type = "font"
+    allowed = mocker.MagicMock()
+    allowed.request.url = "https://www.fpds.gov/ezsearch/fpdsportal"
+    allowed.request.resource_type = "document"
+
+    policy.handle(blocked)
+    policy.handle(allowed)
+
+    blocked.abort.assert_called_once()
+    allowed.continue_.assert_called_once()
+    assert policy.blocked == {"font": 1}
+    assert policy.continued == 1
+
+
+def test_resource_policy_disabled():
+    settings = search.SearchSettings(blocked_resources="", blocked_hosts="")
+    assert search.ResourcePolicy.from_settings(settings) is None
+
+
+def test_browser_session_installs_policy(mocker):
+    mock_playwright = mocker.patch("playwright.sync_api.sync_playwright")
+    mock_browser = mock_playwright.return_value.start.return_value.chromium.launch.return_value
+    policy = search.ResourcePolicy.from_settings(search.SearchSettings())
+
+    with search.BrowserSession(policy=policy) as session:
+        session.new_page()
+
+    mock_browser.new_context.return_value.route.assert_called_once_with(
+        "**/*", policy.handle
+    )
+
+
+def test_plan_queries_batches_contracts():
+    jobs = search.parse_criteria(
+        "111: A,222: B,333: C,444: D,555: E", "541512:Test+Agency:Test Agency"
+    )
+    settings = search.SearchSettings(contract_batch_size=2)
+
+    assert search.plan_queries(jobs, "2024/02/24", settings) == [
+        ({"contract_nos": ["111", "222"]}, [0, 1]),
+        ({"contract_nos": ["333", "444"]}, [2, 3]),
+        ({"contract_no": "555"}, [4]),
+        ({"naics": "541512", "agency": "Test+Agency"}, [5]),
+    ]
+
+
+def test_plan_queries_max_url_length():
+    jobs = search.parse_criteria("111: A,222: B,333: C", "")
+    max_url_length = len(
+        search.build_search_url({"contract_nos": ["111", "222"]}, "2024/02/24")
+    )
+    settings = search.SearchSettings(max_url_length=max_url_length)
+
+    assert search.plan_queries(jobs, "2024/02/24", settings) == [
+        ({"contract_nos": ["111", "222"]}, [0, 1]),
+        ({"contract_no": "333"}, [2]),
+    ]
+
+    # Measured against the configured portal, not the default one
+    base_url = "https://fpds-mirror.example.com/ezsearch/fpdsportal?q="
+    settings.base_url = base_url
+    settings.max_url_length = len(
+        search.build_search_url({"contract_nos": ["111", "222"]}, "2024/02/24", base_url)
+    )
+    queries = search.plan_queries(jobs, "2024/02/24", settings)
+
+    assert [batch for _, batch in queries] == [[0, 1], [2]]
+    settings.max_url_length -= 1
+    queries = search.plan_queries(jobs, "2024/02/24", settings)
+    assert [batch for _, batch in queries] == [[0], [1], [2]]
+
+
+def test_process_search_routes_batched_contracts(mocker, sync_settings):
+    details = [
+        {"piid": "222", "idv": "", "company": "B Co"},
+        {"piid": "999", "idv": "111", "company": "A Task Order Co"},
+        {"piid": "777", "idv": "", "company": "Unrelated Co"},
+    ]
+
+    for detail in details:
+        detail.update(
+            date="02/25/2024",
+            company_url="https://example.com",
+            reason="Exercise An Option",
+            obligation="$50",
+            desc="Mentions 333 in passing.",
+            mod="",
+        )
+
+    mock_search = mocker.patch(
+        "search.search", return_value=(details, "https://example.com/batch")
+    )
+    route = mocker.spy(search, "route_details")
+
+    items = search.process_search("111: A,222: B,333: C", "", sync_settings)
+
+    assert mock_search.call_args.args[0] == {"contract_nos": ["111", "222", "333"]}
+    assert route.spy_return == {
+        "111": [details[1]],
+        "222": [details[0]],
+        "333": [details[2]],
+    }
+    assert items[2]["text"].startswith(
+        "**1. A -** 111 - [View updates]("
+        + search.build_search_url({"contract_no": "111"}, mock_search.call_args.args[1])
+    )
+
+
+def test_plan_queries_groups_naics_by_agency():
+    jobs = search.parse_criteria(
+        "",
+        "541512:Agency+A:A,541511:Agency+B:B,541519:Agency+A:A,518210:Agency+A:A",
+    )
+    settings = search.SearchSettings(naics_batch_size=2)
+
+    assert search.plan_queries(jobs, "2024/02/24", settings) == [
+        ({"naics_codes": ["541512", "541519"], "agency": "Agency+A"}, [0, 2]),
+        ({"naics": "518210", "agency": "Agency+A"}, [3]),
+        ({"naics": "541511", "agency": "Agency+B"}, [1]),
+    ]
+    assert search.build_search_url(
+        {"naics_codes": ["541512", "541519"], "agency": "Agency+A"}, "2024/02/24"
+    ) == (
+        "https://www.fpds.gov/ezsearch/fpdsportal?q=CONTRACTING_AGENCY_NAME%3A%22Agency+A%22"
+        "+%28PRINCIPAL_NAICS_CODE%3A%22541512%22+OR+PRINCIPAL_NAICS_CODE%3A%22541519%22%29"
+        "++SIGNED_DATE%3A%5B2024/02/24%2C%29&templateName=1.5.3&indexName=awardfull&sortBy=SIGNED_DATE&desc=Y"
+    )
+
+
+def test_process_search_routes_grouped_naics(mocker, sync_settings):
+    details = [
+        {"naics": "541519", "company": "B Co", "piid": "2", "mod": "P00002"},
+        {"naics": "541512", "company": "A Co", "piid": "1", "mod": "P00001"},
+    ]
+
+    for detail in details:
+        detail.update(
+            date="02/25/2024",
+            company_url="https://example.com",
+            reason="Exercise An Option",
+            obligation="$50",
+            desc="This exercises option year.",
+            idv="",
+        )
+
+    mock_search = mocker.patch(
+        "search.search", return_value=(details, "https://example.com/batch")
+    )
+
+    items = search.process_search(
+        "", "541512:Agency+A:A,541519:Agency+A:A", sync_settings
+    )
+
+    assert mock_search.call_count == 1
+    assert "A Co" in items[2]["text"] and "B Co" not in items[2]["text"]
+    assert "B Co" in items[4]["text"] and "A Co" not in items[4]["text"]
+
+
+def test_process_search_unroutable_naics_falls_back(mocker, sync_settings):
+    mock_search = mocker.patch(
+        "search.search",
+        return_value=([{"naics": "", "piid": "1"}], "https://example.com"),
+    )
+    mocker.patch("search.format_results", side_effect=lambda raw: raw)
+
+    raw_results = search.process_search(
+        "", "541512:Agency+A:A,541519:Agency+A:A", sync_settings
+    )
+
+    assert [call.args[0] for call in mock_search.call_args_list] == [
+        {"naics_codes": ["541512", "541519"], "agency": "Agency+A"},
+        {"naics": "541512", "agency": "Agency+A"},
+        {"naics": "541519", "agency": "Agency+A"},
+    ]
+    assert [result["naics"] for result in raw_results] == ["541512", "541519"]
+
+
+def test_unroutable_naics_stops_grouping(mocker, sync_settings):
+    mock_search = mocker.patch(
+        "search.search",
+        return_value=([{"naics": "", "piid": "1"}], "https://example.com"),
+    )
+    mocker.patch("search.format_results", side_effect=lambda raw: raw)
+    state = search.RunState()
+    naics_list = (
+        "541512:Agency+A:A,541519:Agency+A:A,541511:Agency+B:B,541513:Agency+B:B"
+    )
+
+    search.process_search("", naics_list, sync_settings, state)
+
+    # Agency B's OR query waited for agency A's and never ran
+    assert [call.args[0] for call in mock_search.call_args_list] == [
+        {"naics_codes": ["541512", "541519"], "agency": "Agency+A"},
+        {"naics": "541512", "agency": "Agency+A"},
+        {"naics": "541519", "agency": "Agency+A"},
+        {"naics": "541511", "agency": "Agency+B"},
+        {"naics": "541513", "agency": "Agency+B"},
+    ]
+    assert state.naics_routable is False
+
+    # Later groups of the run search code by code straight away
+    mock_search.reset_mock()
+    search.process_search("", naics_list, sync_settings, state)
+    assert mock_search.call_count == 4
+
+    # Rows with NAICS codes keep every agency combined
+    mock_search.side_effect = lambda criteria, *args: (
+        [{"naics": criteria["naics_codes"][0], "piid": "1"}],
+        "https://example.com",
+    )
+    mock_search.reset_mock()
+    state = search.RunState()
+    search.process_search("", naics_list, sync_settings, state)
+
+    assert [call.args[0]["agency"] for call in mock_search.call_args_list] == [
+        "Agency+A",
+        "Agency+B",
+    ]
+    assert state.naics_routable is True
+
+
+class FakeResultPage:
+    # Stand-in for a results page tab, serving rows for its url
+
+    def __init__(self, context, pages):
+        self.context = context
+        self.pages = pages
+        self.url = None
+
+    def goto(self, url, **kwargs):
+        self.url = url
+
+    def wait_for_load_state(self, *args, **kwargs):
+        pass
+
+    def evaluate(self, js, *args):
+        rows, next_url = self.pages[self.url]
+        return rows if js == search.EXTRACT_ROWS_JS else next_url
+
+
+def test_result_pages_prefetches_next_page(mocker):
+    pages = {
+        "https://example.com/1": ([{"n": 1}], "https://example.com/2"),
+        "https://example.com/2": ([{"n": 2}], "https://example.com/3"),
+        "https://example.com/3": ([{"n": 3}], None),
+    }
+    context = mocker.MagicMock()
+    tabs = [FakeResultPage(context, pages)]
+
+    def new_page():
+        tabs.append(FakeResultPage(context, pages))
+        return tabs[-1]
+
+    context.new_page.side_effect = new_page
+    seen = []
+
+    for result_page, rows in search.result_pages(tabs[0], "https://example.com/1", 10):
+        seen.append((result_page.url, rows))
+        spare = tabs[1] if result_page is tabs[0] else tabs[0]
+
+        if len(seen) < 3:
+            # Next page already requested in the spare tab
+            assert spare.url == f"https://example.com/{len(seen) + 1}"
+
+    assert len(tabs) == 2
+
+    assert seen == [
+        ("https://example.com/1", [{"n": 1}]),
+        ("https://example.com/2", [{"n": 2}]),
+        ("https://example.com/3", [{"n": 3}]),
+    ]
+
+    capped = []
+
+    with pytest.raises(search.ResultsTruncated):
+        for _, rows in search.result_pages(tabs[0], "https://example.com/1", 2):
+            capped.append(rows)
+
+    assert capped == [[{"n": 1}], [{"n": 2}]]
+
+
+class FakeAsyncResultPage(FakeResultPage):
+    async def goto(self, url, **kwargs):
+        self.url = url
+
+    async def evaluate(self, js, *args):
+        return FakeResultPage.evaluate(self, js, *args)
+
+
+def test_async_result_pages(mocker):
+    pages = {
+        "https://example.com/1": ([{"n": 1}], "https://example.com/2"),
+        "https://example.com/2": ([{"n": 2}], None),
+    }
+    context = mocker.MagicMock()
+
+    async def new_page():
+        return FakeAsyncResultPage(context, pages)
+
+    context.new_page.side_effect = new_page
+
+    async def walk():
+        page = FakeAsyncResultPage(context, pages)
+        return [
+            rows
+            async for _, rows in search.async_result_pages(
+                page, "https://example.com/1", 10
+            )
+        ]
+
+    assert search.asyncio.run(walk()) == [[{"n": 1}], [{"n": 2}]]
+
+    async def walk_capped(capped):
+        page = FakeAsyncResultPage(context, pages)
+
+        async for _, rows in search.async_result_pages(
+            page, "https://example.com/1", 1
+        ):
+            capped.append(rows)
+
+    capped = []
+
+    with pytest.raises(search.ResultsTruncated):
+        search.asyncio.run(walk_capped(capped))
+
+    assert capped == [[{"n": 1}]]
+
+
+def test_detail_cache_ttl_and_eviction(mocker, tmp_path):
+    clock = mocker.patch("search.time.time", return_value=1000.0)
+    cache = search.DetailCache(str(tmp_path / "cache.sqlite3"), 1, 2)
+
+    assert cache.get(":1::P00001") is None
+    cache.put(":1::P00001", "Exercise An Option", "Option year.")
+    assert cache.get(":1::P00001") == ("Exercise An Option", "Option year.")
+
+    clock.return_value = 1000.0 + 86401
+    assert cache.get(":1::P00001") is None
+    assert (cache.hits, cache.misses) == (1, 2)
+
+    for n in range(3):
+        clock.return_value += 1
+        cache.put(f"2::P0000{n}", "Reason", "Desc")
+
+    cache.close()
+    reopened = search.DetailCache(str(tmp_path / "cache.sqlite3"), 1, 2)
+    assert [reopened.get(f"2::P0000{n}") for n in range(3)] == [
+        None,
+        ("Reason", "Desc"),
+        ("Reason", "Desc"),
+    ]
+
+
+def test_detail_key():
+    view_url = "https://example.com/view?agencyID=7529&PIID=1&modNumber=P1"
+
+    assert search.detail_key({"piid": "1", "idv": "2", "mod": "P1"}, "u") == ":1:2:P1"
+    assert (
+        search.detail_key({"piid": "1", "idv": "2", "mod": "P1"}, view_url)
+        == "7529:1:2:P1"
+    )
+    assert search.detail_key({"piid": "1", "mod": ""}, "https://example.com/1") == (
+        "https://example.com/1"
+    )
+    assert search.detail_key({"piid": ""}, "https://example.com/1") == "https://example.com/1"
+
+
+def test_page_details_tells_apart_mods_without_mod_numbers(mocker, tmp_path):
+    # Two mods of one PIID whose rows carry no mod number, only their View
+    # links differ
+    settings = search.SearchSettings(
+        detail_mode="http",
+        cache_path=str(tmp_path / "cache.sqlite3"),
+        state_path=str(tmp_path / "state.sqlite3"),
+    )
+    state = search.RunState(settings)
+    page = mocker.MagicMock()
+    page.url = "https://www.fpds.gov/ezsearch/fpdsportal?q=1"
+    rows = [
+        {
+            "date": "02/25/2024",
+            "company": "Test Company",
+            "obligation": "$50",
+            "piid": "098765432",
+            "href": None,
+            "onclick": "window.open('/common/jsp/LaunchWebPage.jsp"
+            f"?command=execute&requestid={n}','_blank')",
+        }
+        for n in (1, 2)
+    ]
+    mock_fetch = mocker.patch(
+        "search.http_fetch_details",
+        side_effect=lambda urls, *args: [(f"Reason {u[-1]}", "Desc.") for u in urls],
+    )
+
+    details = search.page_details(page, rows[:1], settings, state)
+    state.commit()
+    state.close()
+    state = search.RunState(settings)
+    details += search.page_details(page, rows, settings, state)
+
+    assert mock_fetch.call_args.args[0] == [
+        "https://www.fpds.gov/common/jsp/LaunchWebPage.jsp?command=execute&requestid=2"
+    ]
+    assert [d["reason"] for d in details] == ["Reason 1", "Reason 2"]
+    assert state.cache.get(details[1]["view_url"]) == ("Reason 2", "Desc.")
+    state.close()
+
+
+def test_page_details_uses_cache(mocker, tmp_path):
+    settings = search.SearchSettings(
+        detail_mode="http", cache_path=str(tmp_path / "cache.sqlite3")
+    )
+    state = search.RunState(settings)
+    state.cache.put(":1::P00001", "Cached Reason", "Cached desc.")
+    page = mocker.MagicMock()
+    page.url = "https://www.fpds.gov/ezsearch/fpdsportal?q=1"
+    rows = [
+        {
+            "date": "02/25/2024",
+            "company": "Test Company",
+            "obligation": "$50",
+            "href": f"jsp/viewLinkController.jsp?PIID=1&modNumber={mod}",
+            "onclick": None,
+        }
+        for mod in ("P00001", "P00002")
+    ]
+    mock_fetch = mocker.patch(
+        "search.http_fetch_details", return_value=[("Fetched Reason", "Fetched desc.")]
+    )
+
+    details = search.page_details(page, rows, settings, state)
+
+    mock_fetch.assert_called_once_with(
+        ["https://www.fpds.gov/ezsearch/jsp/viewLinkController.jsp?PIID=1&modNumber=P00002"],
+        4,
+        state.navigator,
+    )
+    assert [d["reason"] for d in details] == ["Cached Reason", "Fetched Reason"]
+    assert state.cache.get(":1::P00002") == ("Fetched Reason", "Fetched desc.")
+    state.close()
+
+
+def test_watermarks_since_and_commit(mocker, tmp_path):
+    mocker.patch("search.datetime").now.return_value = datetime(2024, 3, 20)
+    path = str(tmp_path / "state.sqlite3")
+    criteria = {"contract_no": "1"}
+    marks = search.Watermarks(path, 14)
+
+    assert marks.since(criteria, "2024/03/19") == "2024/03/19"
+    marks.add(":1::P00001")
+    marks.close()
+
+    # Nothing is stored until commit
+    marks = search.Watermarks(path, 14)
+    assert marks.since(criteria, "2024/03/19") == "2024/03/19"
+    assert not marks.is_seen(":1::P00001")
+    marks.add(":1::P00001")
+    marks.commit()
+    marks.close()
+
+    marks = search.Watermarks(path, 14)
+    assert marks.since(criteria, "2024/03/25") == "2024/03/19"
+    assert marks.is_seen(":1::P00001")
+    marks.close()
+
+    with sqlite3.connect(path) as db:
+        db.execute("UPDATE watermarks SET since = '2024/01/01'")
+
+    marks = search.Watermarks(path, 14)
+    assert marks.since(criteria, "2024/03/19") == "2024/03/06"
+    marks.close()
+
+
+def test_page_details_skips_seen_actions(mocker, tmp_path):
+    settings = search.SearchSettings(
+        detail_mode="http", state_path=str(tmp_path / "state.sqlite3")
+    )
+    state = search.RunState(settings)
+    state.watermarks.add(":1::P00001")
+    state.commit()
+    page = mocker.MagicMock()
+    page.url = "https://www.fpds.gov/ezsearch/fpdsportal?q=1"
+    rows = [
+        {
+            "date": "02/25/2024",
+            "company": "Test Company",
+            "obligation": "$50",
+            "href": f"jsp/viewLinkController.jsp?PIID=1&modNumber={mod}",
+            "onclick": None,
+        }
+        for mod in ("P00001", "P00002")
+    ]
+    mock_fetch = mocker.patch(
+        "search.http_fetch_details", return_value=[("Reason", "Desc.")]
+    )
+
+    details = search.page_details(page, rows, settings, state)
+
+    assert mock_fetch.call_args.args[0] == [
+        "https://www.fpds.gov/ezsearch/jsp/viewLinkController.jsp?PIID=1&modNumber=P00002"
+    ]
+    assert [d["mod"] for d in details] == ["P00002"]
+    assert state.watermarks.pending_seen == {":1::P00002"}
+    state.close()
+
+
+def test_run_state_tells_apart_mods_without_mod_numbers(tmp_path):
+    settings = search.SearchSettings(state_path=str(tmp_path / "state.sqlite3"))
+    view_urls = [
+        "https://www.fpds.gov/common/jsp/LaunchWebPage.jsp"
+        f"?command=execute&requestid={n}"
+        for n in (1, 2)
+    ]
+    details = [{"piid": "098765432", "idv": "", "mod": ""} for _ in view_urls]
+    state = search.RunState(settings)
+    state.mark_seen(details[:1], view_urls[:1])
+    state.commit()
+    state.close()
+
+    state = search.RunState(settings)
+    assert not state.is_new(details[0], view_urls[0])
+    assert state.is_new(details[1], view_urls[1])
+    assert not state.watermarks.is_seen("098765432::")
+    state.close()
+
+
+def test_run_jobs_searches_from_watermarks(mocker):
+    settings = search.SearchSettings(concurrency=1)
+    state = search.RunState(settings)
+    mocker.patch.object(
+        state,
+        "since",
+        side_effect=lambda criteria, yday: "2024/03/10"
+        if criteria["contract_no"] == "2"
+        else yday,
+    )
+    mock_group = mocker.patch(
+        "search.run_job_group",
+        side_effect=lambda jobs, since, settings, state: [
+            (i, ([], f'{criteria["contract_no"]}@{since}'))
+            for i, (criteria, _) in enumerate(jobs)
+        ],
+    )
+    jobs = [({"contract_no": n}, {}) for n in ("1", "2", "3")]
+
+    results = list(search.run_jobs(jobs, "2024/03/19", settings, state))
+
+    assert [r[1] for r in results] == ["1@2024/03/19", "2@2024/03/10", "3@2024/03/19"]
+    assert mock_group.call_count == 2
+    state.close()
+
+
+def iter_results(results: list[dict]):
+    # Generator standing in for stream_results()
+    yield from results
+
+
+def test_main_commits_watermarks_after_post(mocker):
+    mocker.patch(
+        "search.stream_results",
+        side_effect=lambda *args: iter_results([{"contract": 1}]),
+    )
+    mocker.patch(
+        "search.iter_format_results", return_value=[search.build_textblock("1.")]
+    )
+    mocker.patch("search.client.ApiClient")
+    mock_post = mocker.patch("search.teams_post", side_effect=RuntimeError("down"))
+    mock_commit = mocker.patch("search.RunState.commit")
+
+    with pytest.raises(RuntimeError):
+        search.main("1", "", "https://www.example.com")
+
+    mock_commit.assert_not_called()
+
+    mock_post.side_effect = None
+    search.main("1", "", "https://www.example.com")
+    mock_commit.assert_called_once()
+
+
+def test_main_closes_async_engine_when_a_post_fails(mocker, caplog):
+    # One card per result, so the first post fails while searches are queued
+    settings = search.SearchSettings(
+        concurrency=2,
+        contract_batch_size=1,
+        cache_path="",
+        state_path="",
+        card_max_bytes=1200,
+    )
+    sessions = []
+
+    class FakeSession:
+        def __init__(self, headless: bool = True, policy=None) -> None:
+            self.closed = False
+            sessions.append(self)
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *exc) -> None:
+            await asyncio.sleep(0)
+            self.closed = True
+
+    async def fake_search(criteria, yday, session, settings, state):
+        await asyncio.sleep(0.01)
+        detail = {
+            "date": "02/25/2024",
+            "company": "Test Company",
+            "company_url": "https://example.com/company",
+            "obligation": "$50",
+            "piid": criteria["contract_no"],
+            "idv": "",
+            "mod": "P00001",
+            "reason": "Funding Only Action",
+            "desc": "x" * 600,
+        }
+        return [detail], "https://example.com"
+
+    mocker.patch("search.AsyncBrowserSession", FakeSession)
+    mocker.patch("search.async_search", side_effect=fake_search)
+    mocker.patch("search.client.ApiClient")
+    mocker.patch("search.teams_post", side_effect=RuntimeError("down"))
+    contract_list = ",".join(f"C{n}: Contract {n}" for n in range(6))
+
+    unraisable = []
+    mocker.patch("sys.unraisablehook", side_effect=unraisable.append)
+
+    with pytest.raises(RuntimeError, match="down"):
+        search.main(contract_list, "", "https://www.example.com", settings)
+
+    gc.collect()
+    assert unraisable == []
+    # The browser session shut down on the run's loop before it closed,
+    # cancelling the queued searches
+    assert len(sessions) == 1 and sessions[0].closed
+    assert not [r for r in caplog.records if r.name == "asyncio"]
+
+
+def test_main_stores_posted_cards_when_a_post_fails(mocker, tmp_path):
+    settings = search.SearchSettings(
+        cache_path="",
+        state_path=str(tmp_path / "state.sqlite3"),
+        card_max_bytes=1500,
+        post_concurrency=2,
+    )
+    results = [
+        {
+            "contract_no": f"C{n}",
+            "contract_nm": f"Contract {n}",
+            "url": "https://example.com",
+            "index": n + 1,
+            "contract_details": [
+                {
+                    "date": "02/25/2024",
+                    "company": "Test Company",
+                    "company_url": "https://example.com/company",
+                    "obligation": "$50",
+                    "piid": f"C{n}",
+                    "idv": "",
+                    "mod": f"P0000{m}",
+                    "reason": "Funding Only Action",
+                    "desc": "x" * 400,
+                }
+                for m in range(2)
+            ],
+        }
+        for n in range(3)
+    ]
+    # Every result reports the same action lines, told apart by posting order
+    mocker.patch("search.stream_results", return_value=iter_results(results))
+    mocker.patch("search.client.ApiClient")
+    cards = []
+
+    def fake_post(api_client, items, async_req):
+        # Header, C0, C1 and C2 cards: C1 fails, C2 is in flight and lands
+        thread = mocker.Mock()
+        thread.successful.return_value = len(cards) != 2
+
+        if len(cards) == 2:
+            thread.get.side_effect = RuntimeError("down")
+
+        cards.append(items)
+        return thread
+
+    mocker.patch("search.teams_post", side_effect=fake_post)
+
+    with pytest.raises(RuntimeError):
+        search.main("C0: Contract 0", "", "https://www.example.com", settings)
+
+    assert len(cards) == 4
+    watermarks = search.Watermarks(settings.state_path, settings.max_lookback_days)
+    assert [watermarks.is_seen(f":C{n}::P00000") for n in range(3)] == [True, False, True]
+    assert watermarks.is_seen(":C2::P00001")
+    assert not watermarks.is_seen(":C1::P00001")
+    # The search window only advances once the whole run succeeded
+    assert watermarks._connect().execute("SELECT * FROM watermarks").fetchall() == []
+    watermarks.close()
+
+
+def test_rate_limiter_paces_and_adapts(mocker):
+    clock = mocker.patch("search.time.monotonic", return_value=100.0)
+    mock_sleep = mocker.patch("search.time.sleep")
+    limiter = search.RateLimiter(2.0, 2, 0.5, 5.0)
+
+    for _ in range(3):
+        limiter.call(lambda: None)
+
+    # Burst of two, then one token every half second
+    mock_sleep.assert_called_once_with(0.5)
+
+    with pytest.raises(ApiException):
+        limiter.call(mocker.Mock(side_effect=ApiException(status=503)))
+
+    assert (limiter.rate, limiter.backoffs) == (1.0, 1)
+
+    with pytest.raises(ApiException):
+        limiter.call(mocker.Mock(side_effect=ApiException(status=404)))
+
+    limiter.call(mocker.Mock(return_value=mocker.Mock(status=502)))
+    limiter.call(mocker.Mock(return_value=mocker.Mock(status=502)))
+    assert limiter.rate == 0.5
+
+    limiter.call(lambda: None)
+    assert limiter.rate == 0.7
+
+    def slow():
+        clock.return_value += 10
+
+    limiter.call(slow)
+    assert limiter.rate == 0.7
+
+    # Errors that say nothing about the portal's load never back off
+    with pytest.raises(KeyError):
+        limiter.call(mocker.Mock(side_effect=KeyError("x")))
+
+    assert limiter.rate == pytest.approx(0.9)
+    assert limiter.backoffs == 3
+
+
+def test_overloaded():
+    assert search.overloaded(PlaywrightTimeoutError("Timeout 60000ms exceeded"))
+    assert search.overloaded(PlaywrightError("net::ERR_CONNECTION_RESET at https://x"))
+    assert search.overloaded(urllib3.exceptions.ProtocolError("reset"))
+    assert search.overloaded(ConnectionResetError())
+    assert search.overloaded(ApiException(status=0))
+    assert search.overloaded(ApiException(status=503))
+    assert not search.overloaded(ApiException(status=404))
+    assert not search.overloaded(PlaywrightError("Target page has been closed"))
+    assert not search.overloaded(KeyError("x"))
+    assert not search.overloaded(TypeError())
+
+
+def test_result_pages_paced_by_limiter(mocker):
+    limiter = search.RateLimiter(1.0, 1, 0.5, 5.0)
+    mock_call = mocker.spy(limiter, "call")
+    page = mocker.MagicMock()
+    page.evaluate.side_effect = lambda js, *args: None if js == search.NEXT_PAGE_JS else []
+
+    list(
+        search.result_pages(
+            page, "https://example.com/1", 10, search.Navigator(limiter)
+        )
+    )
+
+    mock_call.assert_called_once_with(page.goto, "https://example.com/1")
+
+
+def test_navigator_retries_with_backoff(mocker):
+    mock_sleep = mocker.patch("search.time.sleep")
+    mocker.patch("search.random.uniform", return_value=1.0)
+    navigator = search.Navigator(retries=3, backoff=2.0)
+    timeout = PlaywrightTimeoutError("Timeout 60000ms exceeded")
+    goto = mocker.Mock(side_effect=[timeout, timeout, "loaded"])
+
+    assert navigator.call(goto, "https://example.com/1") == "loaded"
+    assert [c.args[0] for c in mock_sleep.call_args_list] == [2.0, 4.0]
+
+    goto = mocker.Mock(side_effect=ApiException(status=404))
+
+    with pytest.raises(ApiException):
+        navigator.call(goto, "https://example.com/1")
+
+    goto.assert_called_once()
+
+
+def test_navigator_raises_other_errors_at_once(mocker):
+    mock_sleep = mocker.patch("search.time.sleep")
+    navigator = search.Navigator(breaker=search.CircuitBreaker(2, 60.0), retries=3)
+    parse = mocker.Mock(side_effect=KeyError("x"))
+
+    with pytest.raises(KeyError):
+        navigator.call(parse)
+
+    async def async_parse():
+        raise TypeError("bad page")
+
+    with pytest.raises(TypeError):
+        asyncio.run(navigator.async_call(async_parse))
+
+    parse.assert_called_once()
+    mock_sleep.assert_not_called()
+    assert navigator.breaker.failures == 0
+
+
+def test_circuit_breaker_opens_after_failures(mocker):
+    clock = mocker.patch("search.time.monotonic", return_value=100.0)
+    navigator = search.Navigator(breaker=search.CircuitBreaker(2, 60.0), retries=1)
+    goto = mocker.Mock(side_effect=PlaywrightTimeoutError("Timeout"))
+
+    with pytest.raises(PlaywrightTimeoutError):
+        navigator.call(goto, "https://example.com/1")
+
+    with pytest.raises(search.CircuitOpenError):
+        navigator.call(goto, "https://example.com/2")
+
+    assert goto.call_count == 2
+
+    clock.return_value += 61
+    goto.side_effect = None
+    navigator.call(goto, "https://example.com/3")
+    assert navigator.breaker.failures == 0
+
+
+def test_search_keeps_partial_results(mocker, tmp_path):
+    settings = search.SearchSettings(
+        concurrency=1, retries=0, state_path=str(tmp_path / "state.sqlite3")
+    )
+    state = search.RunState(settings)
+    state.since({"contract_no": "1"}, "2024/02/24")
+    contract = {"date": "02/25/2024", "piid": "1", "reason": "", "desc": ""}
+    mocker.patch(
+        "search.result_pages",
+        return_value=iter([(mocker.MagicMock(), []), (mocker.MagicMock(), [])]),
+    )
+    mocker.patch(
+        "search.page_details",
+        side_effect=[[contract], PlaywrightError("Timeout 60000ms exceeded")],
+    )
+    session = mocker.MagicMock()
+
+    contract_details, _ = search.search(
+        {"contract_no": "1"}, "2024/02/24", session, settings, state
+    )
+
+    assert contract_details == [contract]
+    session.new_page.return_value.context.close.assert_called_once()
+    assert state.watermarks.pending_marks == {}
+    state.close()
+
+
+def test_stream_results_yields_before_later_searches(mocker):
+    settings = search.SearchSettings(concurrency=1, contract_batch_size=1)
+    details = [{"date": "02/25/2024", "piid": "1"}]
+    mock_search = mocker.patch(
+        "search.search", return_value=(details, "https://example.com")
+    )
+
+    results = search.stream_results("111: A,222: B,333: C", "", settings)
+    first = next(results)
+
+    assert (first["contract_no"], first["index"]) == ("111", 1)
+    assert mock_search.call_count == 1
+    assert [r["index"] for r in results] == [2, 3]
+    assert mock_search.call_count == 3
+
+
+def test_pack_cards_under_byte_limit():
+    items = []
+
+    for n in range(6):
+        items += [
+            search.build_textblock(f"**{n}.** " + "x" * 300),
+            search.build_textblock(""),
+        ]
+
+    cards = list(search.pack_cards(iter(items), 1200))
+
+    assert len(cards) > 1
+    assert all(search.json_size(search.build_card(card)) <= 1200 for card in cards)
+    assert [block for card in cards for block in card if block["text"]] == items[::2]
+    assert all(card[0]["text"] for card in cards)
+
+    # An oversized entry is split between its actions
+    actions = "".join(f"\n\n- action {n} " + "y" * 200 for n in range(10))
+    cards = list(search.pack_cards([search.build_textblock("**1.** A" + actions)], 1200))
+
+    assert len(cards) > 1
+    assert "\n\n".join(b["text"] for card in cards for b in card) == "**1.** A" + actions
+
+
+def test_post_cards_posts_in_order(mocker):
+    mock_client = mocker.patch("search.client.ApiClient")
+    order = []
+    mock_api = mocker.patch("search.client.MsApi")
+    threads = []
+
+    def fake_post(body, async_req):
+        thread = mocker.Mock()
+        thread.get.side_effect = lambda: order.append(body)
+        threads.append(thread)
+        return thread
+
+    mock_api.return_value.teams_post.side_effect = fake_post
+    items = [search.build_textblock(f"{n} " + "x" * 500) for n in range(6)]
+
+    posted = search.post_cards("https://www.example.com", iter(items), 1500, 2)
+
+    assert posted == len(order) == 3
+    texts = [
+        block["text"]
+        for body in order
+        for block in body["attachments"][0]["content"]["body"][0]["items"]
+    ]
+    assert texts == [item["text"] for item in items]
+    mock_client.assert_called_once()
+    assert mock_client.call_args.args[0].pool_threads == 2
+    mock_client.return_value.close.assert_called_once()
+
+    mock_client.reset_mock()
+    assert search.post_cards("https://www.example.com", iter([]), 1500) == 0
+    mock_client.assert_not_called()
+
+
+def test_api_client_pool_is_lazy(mocker):
+    mock_call = mocker.patch.object(
+        client.ApiClient, "_ApiClient__call_api", return_value="sent"
+    )
+    config = client.Configuration()
+    config.pool_threads = 3
+
+    with client.ApiClient(config) as api_client:
+        assert api_client._pool is None
+        assert api_client.call_api("/", "POST") == "sent"
+        assert api_client._pool is None
+
+        thread = api_client.call_api("/", "POST", async_req=True)
+        assert thread.get(timeout=5) == "sent"
+        assert api_client.pool is api_client._pool
+        assert api_client._pool._processes == 3
+
+    assert api_client._pool is None
+    assert mock_call.call_count == 2
+    # Closing twice, or a client that never went async, is harmless
+    api_client.close()
+    client.ApiClient(config).close()
+
+
+def test_teams_post_async_reuses_connections(webhook):
+    host, port = webhook.server_address[:2]
+    config = client.Configuration()
+    config.host = f"http://{host}:{port}"
+
+    async def post_all():
+        async with client.ApiClient(config) as api_client:
+            api = client.MsApi(api_client)
+            results = [await api.teams_post_async(body={"n": n}) for n in range(3)]
+
+            config.host = f"http://{host}:{port}/chunked"
+            results.append(await api.teams_post_async(body={"n": 3}))
+
+            config.host = f"http://{host}:{port}/fail"
+            with pytest.raises(ApiException) as failed:
+                await api.teams_post_async(body={"n": 4})
+
+            config.host = f"http://{host}:{port}/slow"
+            with pytest.raises(ApiException) as timed_out:
+                await api.teams_post_async(body={"n": 5}, _request_timeout=0.2)
+
+        return results, failed.value, timed_out.value
+
+    results, failed, timed_out = asyncio.run(post_all())
+
+    assert results == ["1"] * 4
+    assert [body["n"] for _, body in webhook.posts] == [0, 1, 2, 3, 4, 5]
+    # One keep-alive connection until the timeout drops it
+    assert len({address for address, _ in webhook.posts[:5]}) == 1
+    assert failed.status == 500
+    assert timed_out.status == 0
+
+
+def test_async_transport_resends_only_unsent_or_idempotent_requests():
+    # The server answers the first request on each connection, then closes
+    # it on the next one after reading it
+    received = []
+
+    async def handle(reader, writer):
+        for n in range(2):
+            head = await reader.readuntil(b"\r\n\r\n")
+            lines = head.decode("latin-1").split("\r\n")
+            fields = dict(line.split(": ", 1) for line in lines[1:] if line)
+            await reader.readexactly(int(fields.get("Content-Length", 0)))
+            received.append(lines[0].split(" ", 1)[0])
+
+            if n == 0:
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 1\r\n\r\n1")
+                await writer.drain()
+
+        writer.close()
+
+    async def send_all():
+        server = await asyncio.start_server(handle, "127.0.0.1", 0)
+        host, port = server.sockets[0].getsockname()[:2]
+        url = f"http://{host}:{port}/"
+        api_client = client.ApiClient(client.Configuration())
+
+        async with server, api_client:
+            transport = api_client.async_rest_client
+            await transport.request("GET", url)
+            # Resent on a fresh connection
+            assert (await transport.request("GET", url)).data == b"1"
+
+            with pytest.raises(ApiException) as dropped:
+                await transport.request("POST", url, body={"n": 1})
+
+        return dropped.value
+
+    dropped = asyncio.run(send_all())
+
+    assert dropped.status == 0
+    assert received == ["GET", "GET", "GET", "POST"]
+
+
+def test_teams_post_serializes_cards_once(mocker, webhook):
+    host, port = webhook.server_address[:2]
+    config = client.Configuration()
+    config.host = f"http://{host}:{port}"
+    card = search.build_card([search.build_textblock("Café ✓ " * 50)])
+    api_client = client.ApiClient(config)
+
+    # JSON-native bodies skip the recursive walk, anything else still takes it
+    assert api_client.sanitize_for_serialization(card) is card
+    assert api_client.sanitize_for_serialization(
+        {"signed": datetime(2024, 2, 25, 8, 30), "ids": (1, 2), 3: None}
+    ) == {"signed": "2024-02-25T08:30:00", "ids": (1, 2), 3: None}
+
+    # orjson when installed, json.dumps for what it cannot encode or without it
+    assert json.loads(rest.dumps(card)) == card
+    assert len(rest.dumps(card)) <= len(json.dumps(card))
+    assert rest.dumps({"n": 2**70}) == '{"n": 1180591620717411303424}'
+    mocker.patch.object(rest, "orjson", None)
+    assert rest.dumps(card) == json.dumps(card)
+
+    spy = mocker.spy(api_client.rest_client.pool_manager, "request")
+    api = client.MsApi(api_client)
+    api.teams_post(body=card)
+    # Pre-serialized bodies reach urllib3 untouched
+    data = json.dumps(card).encode("utf-8")
+    api.teams_post(body=data)
+    assert spy.call_args.kwargs["body"] is data
+    # Only bytes pass through; a bytearray is refused before anything is sent
+    spy.reset_mock()
+
+    with pytest.raises(TypeError):
+        api_client.rest_client.request(
+            "POST", config.host, body=bytearray(data), _preload_content=False
+        )
+
+    spy.assert_not_called()
+
+    async def post_bytes():
+        async with api_client:
+            with pytest.raises(TypeError):
+                await api_client.async_rest_client.request(
+                    "POST", config.host, body=bytearray(data)
+                )
+
+            return await api.teams_post_async(body=data)
+
+    assert asyncio.run(post_bytes()) == "1"
+    assert [body for _, body in webhook.posts] == [card] * 3
+
+
+def test_post_cards_on_event_loop(mocker):
+    mock_client = mocker.patch("search.client.ApiClient")
+    mock_client.return_value.aclose = mocker.AsyncMock()
+    mock_api = mocker.patch("search.client.MsApi")
+    order = []
+
+    async def fake_post(body):
+        await asyncio.sleep(0)
+        order.append(body)
+
+    mock_api.return_value.teams_post_async.side_effect = fake_post
+    items = [search.build_textblock(f"{n} " + "x" * 500) for n in range(6)]
+    loop = asyncio.new_event_loop()
+
+    try:
+        posted = search.post_cards("https://www.example.com", iter(items), 1500, 2, loop)
+    finally:
+        loop.close()
+
+    assert posted == len(order) == 3
+    texts = [
+        block["text"]
+        for body in order
+        for block in body["attachments"][0]["content"]["body"][0]["items"]
+    ]
+    assert texts == [item["text"] for item in items]
+    mock_api.return_value.teams_post.assert_not_called()
+    mock_client.return_value.aclose.assert_awaited_once()
+    mock_client.return_value.close.assert_called_once()
+
+
+def test_split_textblock_matches_serialized_size():
+    text = "**1.** A" + "".join(f'\n\n- action {n} "é"\t' + "y" * 90 for n in range(40))
+    blocks = search.split_textblock(search.build_textblock(text), 1000)
+
+    assert "\n\n".join(b["text"] for b in blocks) == text
+    assert all(search.json_size(b) <= 1000 for b in blocks)
+    # Each block is as full as the next paragraph allows
+    for block, following in zip(blocks, blocks[1:]):
+        first = following["text"].split("\n\n")[0]
+        merged = search.build_textblock(f'{block["text"]}\n\n{first}')
+        assert search.json_size(merged) > 1000
+
+
+def test_http_engine_against_standin(fpds_standin):
+    settings = search.SearchSettings(
+        engine="http", base_url=fpds_standin.base_url, rate_limit=0
+    )
+
+    results = list(
+        search.stream_results("111: A,222: B", "541512:Agency A:AA", settings)
+    )
+
+    assert [r["index"] for r in results] == [1, 2, 3]
+    assert [r["url"].startswith(fpds_standin.base_url) for r in results] == [True] * 3
+    # Batched contracts are routed back; every action carries its detail fields
+    assert {d["piid"] for d in results[0]["contract_details"]} == {"111"}
+    assert len(results[2]["contract_details"]) == 6
+    assert all(
+        d["reason"] and d["desc"].startswith("Stand-in action")
+        for r in results
+        for d in r["contract_details"]
+    )
+    assert fpds_standin.requests[RESULTS_PATH] == 4
+    assert fpds_standin.requests[DETAIL_PATH] == 12
+
+
+def test_spans_are_noops_until_enabled():
+    assert search.span("search") is search.NO_SPAN
+
+    with search.criteria_span({"contract_no": "111"}), search.span("search"):
+        pass
+
+    assert search.TIMINGS.stages == {}
+
+
+def test_timings_per_stage_and_criterion(fpds_standin, mocker):
+    mocker.patch("search.client.ApiClient")
+    mocker.patch("search.client.MsApi")
+    settings = search.SearchSettings(
+        engine="http",
+        base_url=fpds_standin.base_url,
+        rate_limit=0,
+        state_path="",
+        cache_path="",
+        timings_path="timings.json",
+    )
+
+    search.main("111: A,222: B", "541512:Agency A:AA", "https://example.com", settings)
+
+    with open("timings.json", encoding="utf-8") as f:
+        timings = json.load(f)
+
+    assert not search.TIMINGS.enabled
+    assert timings["stages"]["search"]["count"] == 2
+    assert timings["stages"]["result_page"]["count"] == 4
+    # main() times its wait for each watchlist entry's searches, then for the
+    # engine to finish
+    assert timings["stages"]["process_search"]["count"] == 4
+    assert {"extract_rows", "detail_pages", "format_results", "teams_post"} <= set(
+        timings["stages"]
+    )
+    # Batched contracts share one search
+    assert set(timings["criteria"]) == {
+        "contract_no:111,contract_no:222",
+        "naics:541512:Agency A",
+    }
+    assert timings["criteria"]["naics:541512:Agency A"]["search"] > 0
+
+
+def test_metrics_render_in_exposition_format():
+    registry = metrics.Registry()
+    requests = registry.counter("requests_total", "Requests", ("status",))
+    latency = registry.histogram("latency_seconds", "Latency", (), (0.1, 1))
+
+    requests.inc(status=200)
+    requests.inc(2, status='5"x')
+    latency.observe(0.05)
+    latency.observe(0.5)
+    latency.observe(5)
+
+    assert registry.counter("requests_total", "Again") is requests
+    assert latency.value() == (3, 5.55)
+    assert registry.render() == (
+        "# HELP latency_seconds Latency\n"
+        "# TYPE latency_seconds histogram\n"
+        'latency_seconds_bucket{le="0.1"} 1\n'
+        'latency_seconds_bucket{le="1.0"} 2\n'
+        'latency_seconds_bucket{le="+Inf"} 3\n'
+        "latency_seconds_sum 5.55\n"
+        "latency_seconds_count 3\n"
+        "# HELP requests_total Requests\n"
+        "# TYPE requests_total counter\n"
+        'requests_total{status="200"} 1\n'
+        'requests_total{status="5\\"x"} 2\n'
+    )
+
+    with pytest.raises(ValueError):
+        requests.inc()
+
+
+def test_main_exports_metrics(fpds_standin, mocker):
+    mocker.patch("search.client.ApiClient")
+    mocker.patch("search.client.MsApi")
+    mock_push = mocker.patch(
+        "search.REGISTRY.push", side_effect=urllib3.exceptions.HTTPError("down")
+    )
+    settings = search.SearchSettings(
+        engine="http",
+        base_url=fpds_standin.base_url,
+        rate_limit=0,
+        state_path="",
+        cache_path="",
+        metrics_path="metrics.prom",
+        metrics_push_url="http://127.0.0.1:9091/metrics/job/test",
+    )
+    search.REGISTRY.clear()
+
+    search.main("111: A,222: B", "541512:Agency A:AA", "https://example.com", settings)
+
+    with open("metrics.prom", encoding="utf-8") as f:
+        exposition = f.read()
+
+    mock_push.assert_called_once_with(settings.metrics_push_url)
+    assert 'fpds_result_pages_total{engine="http"} 4\n' in exposition
+    assert "fpds_rows_extracted_total 12\n" in exposition
+    assert 'fpds_details_total{source="page"} 12\n' in exposition
+    assert "fpds_navigations_total 16\n" in exposition
+    assert "teams_cards_posted_total 1\n" in exposition
+    assert "fpds_run_success 1\n" in exposition
+    assert (
+        'http_client_requests_total{method="GET",host="127.0.0.1",status="200"} 16\n'
+        in exposition
+    )
+    assert (
+        'http_client_request_duration_seconds_count{method="GET",host="127.0.0.1"} 16\n'
+        in exposition
+    )
+
+
+# Imported only once a search runs or a Teams post is made
+DEFERRED_MODULES = (
+    "playwright",
+    "urllib3",
+    "six",
+    "dateutil",
+    "multiprocessing",
+    "client.api_client",
+    "client.configuration",
+    "client.rest",
+)
+
+
+def test_no_op_run_defers_heavy_imports():
+    # -X importtime lists every module a fresh interpreter imports
+    code = "import search; search.main('', '', 'https://www.example.com')"
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        env={**os.environ, "PYTHONPATH": os.path.dirname(search.__file__)},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    modules = {
+        line.split("|")[-1].strip()
+        for line in result.stderr.splitlines()
+        if line.startswith("import time:")
+    }
+
+    assert "search" in modules
+    assert not {
+        module
+        for module in modules
+        for deferred in DEFERRED_MODULES
+        if module == deferred or module.startswith(deferred + ".")
+    }